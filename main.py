@@ -1,20 +1,38 @@
 import streamlit as st
+from streamlit.errors import StreamlitAPIException
 import sqlite3
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg2.errors
+import psycopg2.pool
+from psycopg2.extras import RealDictCursor, execute_values
 import re  # 正規表現用
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, timedelta
 import hashlib
+import secrets
 import os
 from PIL import Image
 import base64
-from io import BytesIO
+import binascii
+from io import BytesIO, StringIO
 import json
+import csv
+import html
+from html.parser import HTMLParser
 import zipfile
 from io import BytesIO
 import tempfile
 import shutil
+import threading
+import atexit
+import math
+import unicodedata
+from collections import defaultdict
+import time
+import functools
+import select
+from contextlib import contextmanager
+import logging
 
 # リッチテキストエディタのインポート
 try:
@@ -23,6 +41,8 @@ try:
 except ImportError:
     RICH_EDITOR_AVAILABLE = False
 
+logger = logging.getLogger(__name__)
+
 # ページ設定
 st.set_page_config(
     page_title="How to CT - 診療放射線技師向けCT検査マニュアル",
@@ -31,173 +51,220 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-query_params = st.query_params
-if 'page' in query_params:
-    st.session_state.page = query_params['page']
+# 表示できるページ（URLの page パラメータの値）
+PAGES = (
+    'login', 'welcome', 'home', 'search', 'detail', 'create_disease', 'edit_disease',
+    'notices', 'notice_detail', 'create_notice', 'edit_notice',
+    'protocols', 'protocol_detail', 'create_protocol', 'edit_protocol', 'admin',
+)
 
-def save_session_to_db(user_id, session_data):
-    """セッション情報をデータベースに保存（強化版）"""
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        session_json = json.dumps(session_data)
-        cursor.execute('''
-            INSERT INTO user_sessions (user_id, session_data, last_updated)
-            VALUES (%s, %s, CURRENT_TIMESTAMP)
-            ON CONFLICT (user_id) DO UPDATE SET
-            session_data = EXCLUDED.session_data,
-            last_updated = EXCLUDED.last_updated
-        ''', (user_id, session_json))
-        
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        return False
+# DBに保存するセッションキー
+SESSION_KEYS = (
+    'page', 'selected_sick_id', 'selected_notice_id', 'selected_protocol_id',
+    'edit_sick_id', 'edit_notice_id', 'edit_protocol_id',
+)
+SESSION_TOKEN_PARAM = "sid"  # ブラウザごとのセッショントークンを運ぶURLパラメータ
+SESSION_MAX_AGE_HOURS = 24
+
+def new_session_token():
+    """推測できないセッショントークンを発行"""
+    return secrets.token_urlsafe(32)
+
+SESSION_SWEEP_SQL = "DELETE FROM browser_sessions WHERE last_updated < NOW() - make_interval(hours => %s)"
+
+class SessionWriter(threading.Thread):
+    """セッション保存を描画処理から切り離し、短時間の連続した変更を1回の書き込みにまとめるスレッド
 
-def load_session_from_db():
-    """データベースからセッション情報を復元（強化版）"""
+    期限切れセッションの定期削除も行う。
+    """
+
+    def __init__(self, pool, delay_seconds=1.0, sweep_seconds=600):
+        super().__init__(name="ct-session-writer", daemon=True)
+        self.pool = pool
+        self.delay_seconds = delay_seconds
+        self.sweep_seconds = sweep_seconds
+        self._pending = {}  # トークン -> (ユーザーID, 最新のセッション情報)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def submit(self, token, user_id, session_data):
+        """保存を予約（同じトークンの未書き込み分は上書き）"""
+        with self._lock:
+            self._pending[token] = (user_id, session_data)
+        self._wakeup.set()
+
+    def discard(self, token):
+        """未書き込みの保存を取り消す（書き込み中なら完了を待つ）"""
+        with self._write_lock, self._lock:
+            self._pending.pop(token, None)
+
+    def run(self):
+        last_sweep = 0.0
+        while True:
+            if self._wakeup.wait(timeout=self.sweep_seconds):
+                time.sleep(self.delay_seconds)
+                self._wakeup.clear()
+                self.flush()
+            if time.monotonic() - last_sweep >= self.sweep_seconds:
+                self.sweep()
+                last_sweep = time.monotonic()
+
+    def _execute(self, callback):
+        conn = None
+        try:
+            conn = self.pool.getconn()
+            with conn.cursor() as cursor:
+                callback(cursor)
+            conn.commit()
+            return True
+        except Exception:
+            return False
+        finally:
+            if conn is not None:
+                self.pool.putconn(conn)
+
+    def flush(self):
+        """予約済みのセッション情報をまとめて保存"""
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            rows = [(token, user_id, json.dumps(data)) for token, (user_id, data) in pending.items()]
+            saved = self._execute(lambda cursor: execute_values(cursor, '''
+                INSERT INTO browser_sessions (token, user_id, session_data, last_updated)
+                VALUES %s
+                ON CONFLICT (token) DO UPDATE SET
+                user_id = EXCLUDED.user_id,
+                session_data = EXCLUDED.session_data,
+                last_updated = EXCLUDED.last_updated
+            ''', rows, template="(%s, %s, %s::jsonb, CURRENT_TIMESTAMP)"))
+            if not saved:
+                # 失敗分は次回の保存で再試行（その間に届いた新しい情報を優先）
+                with self._lock:
+                    for token, entry in pending.items():
+                        self._pending.setdefault(token, entry)
+
+    def sweep(self):
+        """期限切れのセッションを削除（last_updated のインデックスで範囲削除）"""
+        self._execute(lambda cursor: cursor.execute(SESSION_SWEEP_SQL, (SESSION_MAX_AGE_HOURS,)))
+
+@st.cache_resource
+def get_session_writer():
+    """セッション保存スレッドを開始（プロセスごとに1つ、終了時に残りを書き込む）"""
+    writer = SessionWriter(get_connection_pool())
+    writer.start()
+    atexit.register(writer.flush)
+    return writer
+
+SESSION_LOAD_SQL = """
+    SELECT user_id, session_data FROM browser_sessions
+    WHERE token = %s AND last_updated > NOW() - make_interval(hours => %s)
+"""
+
+def load_session_from_db(token):
+    """セッショントークンに対応するセッション情報を復元（主キーでの1行取得）"""
+    if not token:
+        return None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # PostgreSQL用のテーブル存在チェック
-        cursor.execute('''
-            SELECT EXISTS (
-                SELECT FROM information_schema.tables 
-                WHERE table_name = 'user_sessions'
-            )
-        ''')
-        if not cursor.fetchone()[0]:
-            conn.close()
-            return None
-        
-        # 最新のセッション情報を取得（過去24時間以内）
-        cursor.execute('''
-            SELECT user_id, session_data FROM user_sessions
-            WHERE last_updated > NOW() - INTERVAL '1 day'
-            ORDER BY last_updated DESC LIMIT 1
-        ''')
-        
-        result = cursor.fetchone()
-        conn.close()
+        with get_db_connection() as conn:
+            if not conn:
+                return None
+            cursor = conn.cursor()
+            cursor.execute(SESSION_LOAD_SQL, (token, SESSION_MAX_AGE_HOURS))
+            result = cursor.fetchone()
         
         if result:
-            user_id, session_json = result
-            session_data = json.loads(session_json)
+            user_id, session_data = result
             
             # ユーザー情報が有効かチェック
             user = get_user_by_id(user_id)
             if user:
-                return {
-                    'user': {
-                        'id': user[0],
-                        'name': user[1],
-                        'email': user[2]
-                    },
-                    'page': session_data.get('page', 'home'),
-                    'selected_sick_id': session_data.get('selected_sick_id'),
-                    'selected_notice_id': session_data.get('selected_notice_id'),
-                    'selected_protocol_id': session_data.get('selected_protocol_id'),
-                    'edit_sick_id': session_data.get('edit_sick_id'),
-                    'edit_notice_id': session_data.get('edit_notice_id'),
-                    'edit_protocol_id': session_data.get('edit_protocol_id')
-                }
+                restored = {key: session_data.get(key) for key in SESSION_KEYS}
+                restored['page'] = session_data.get('page', 'home')
+                restored['user'] = {'id': user[0], 'name': user[1], 'email': user[2]}
+                return restored
         
         return None
     except Exception as e:
+        # 復元できなくてもログインし直せばよいので画面には出さず、記録だけ残す
+        logger.warning("セッション情報の復元に失敗しました: %s", e)
         return None
 
 def get_user_by_id(user_id):
     """IDでユーザー情報を取得 - PostgreSQL版"""
     try:
-        conn = get_db_connection()
-        if not conn:
-            return None
-        
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name, email FROM users WHERE id = %s", (user_id,))
-        user = cursor.fetchone()
-        conn.close()
+        with get_db_connection() as conn:
+            if not conn:
+                return None
+            
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, name, email FROM users WHERE id = %s", (user_id,))
+            user = cursor.fetchone()
         return user
     except Exception as e:
         st.error(f"ユーザー取得エラー: {e}")
         return None
 
 def update_session_in_db():
-    """現在のセッション状態をデータベースに更新（強化版）"""
+    """現在のセッション状態を保存（前回から変わった場合のみ、書き込みはバックグラウンドで実行）"""
     if 'user' in st.session_state:
-        session_data = {
-            'page': st.session_state.get('page', 'home'),
-            'selected_sick_id': st.session_state.get('selected_sick_id'),
-            'selected_notice_id': st.session_state.get('selected_notice_id'),
-            'selected_protocol_id': st.session_state.get('selected_protocol_id'),
-            'edit_sick_id': st.session_state.get('edit_sick_id'),
-            'edit_notice_id': st.session_state.get('edit_notice_id'),
-            'edit_protocol_id': st.session_state.get('edit_protocol_id')
-        }
-        save_session_to_db(st.session_state.user['id'], session_data)
-# ページ履歴管理関数
-def add_to_page_history(page):
-    """ページ履歴に追加"""
-    if 'page_history' not in st.session_state:
-        st.session_state.page_history = []
-    
-    # 同じページの連続追加を避ける
-    if not st.session_state.page_history or st.session_state.page_history[-1] != page:
-        st.session_state.page_history.append(page)
-        
-    # 履歴が長くなりすぎないように制限（最大10ページ）
-    if len(st.session_state.page_history) > 10:
-        st.session_state.page_history = st.session_state.page_history[-10:]
-
-def go_back():
-    """前のページに戻る（改善版）"""
-    if 'page_history' not in st.session_state or len(st.session_state.page_history) <= 1:
-        st.session_state.page = "home"
-        return
-    
-    # 現在のページを履歴から削除
-    st.session_state.page_history.pop()
+        session_data = {key: st.session_state.get(key) for key in SESSION_KEYS}
+        session_data['page'] = st.session_state.get('page', 'home')
+        token = st.session_state.get('session_token')
+        if not token or st.session_state.get('persisted_session') == session_data:
+            return
+        st.session_state.persisted_session = session_data
+        get_session_writer().submit(token, st.session_state.user['id'], session_data)
+
+def set_page_query_params(page):
+    """URLパラメータをページとセッショントークンだけにする（書いたページは戻る/進むの検知用に記録）"""
+    st.query_params.clear()
+    st.query_params["page"] = page
+    st.session_state.url_page = page
+    token = st.session_state.get('session_token')
+    if token:
+        st.query_params[SESSION_TOKEN_PARAM] = token
+
+# ページ遷移（URLの page パラメータと st.session_state.page を同期する）
+def clear_page_states(page):
+    """ページ遷移時に不要な状態をクリア"""
+    clear_states = {
+        "search": ['selected_sick_id', 'edit_sick_id'],
+        "notices": ['selected_notice_id', 'edit_notice_id'], 
+        "protocols": ['selected_protocol_id', 'edit_protocol_id']
+    }
     
-    # 前のページに戻る
-    if st.session_state.page_history:
-        previous_page = st.session_state.page_history[-1]
-        st.session_state.page = previous_page
-        
-        # ページ遷移後に選択状態をクリア（遷移完了後）
-        if previous_page == "protocols":
-            if 'selected_protocol_id' in st.session_state:
-                del st.session_state.selected_protocol_id
-        elif previous_page == "notices":
-            if 'selected_notice_id' in st.session_state:
-                del st.session_state.selected_notice_id
-        elif previous_page == "search":
-            if 'selected_sick_id' in st.session_state:
-                del st.session_state.selected_sick_id
-    else:
-        st.session_state.page = "home"
+    if page in clear_states:
+        for state in clear_states[page]:
+            if state in st.session_state:
+                del st.session_state[state]
 
 def navigate_to_page(page):
-    """ページナビゲーション（デバッグ版）"""
-    st.write(f"Debug: Navigating to {page}")  # デバッグ用
-    
-    # 現在のページを履歴に追加
-    current_page = st.session_state.get('page', 'home')
-    add_to_page_history(current_page)
-    
-    # セッション状態を更新
+    """ページ遷移（セッションとURLを更新して1回だけ再実行する）"""
+    clear_page_states(page)
     st.session_state.page = page
-    st.write(f"Debug: Session page set to {st.session_state.page}")  # デバッグ用
-    
-    # URLパラメータを更新
-    st.query_params.update({"page": page})
-    st.write(f"Debug: URL params set to {dict(st.query_params)}")  # デバッグ用
-    
-    # 強制再読み込み
+    set_page_query_params(page)
     st.rerun()
 
+def sync_page_route():
+    """URLとセッションのページを同期（戻る/進む・URL直接入力によるURLだけの変化を再実行時に検知）"""
+    url_page = st.query_params.get('page')
+    if url_page and url_page != st.session_state.get('url_page'):
+        # アプリが最後に書いたURLから変わっていればURLに従う
+        st.session_state.url_page = url_page
+        if 'user' in st.session_state:
+            clear_page_states(url_page)
+            st.session_state.page = url_page
+    
+    if 'user' not in st.session_state:
+        return
+    if st.session_state.get('page') not in PAGES:
+        st.session_state.page = 'home'
+    if st.session_state.page != url_page:
+        set_page_query_params(st.session_state.page)
+
 # カスタムCSS
 st.markdown("""
 <style>
@@ -327,6 +394,70 @@ def display_rich_content(content):
     else:
         st.info("内容が設定されていません")
 
+# 一覧の表示列（列名 → 列の設定）。一覧は1つの表として描画し、行を選択すると詳細ページを開く
+SICK_LIST_COLUMNS = {
+    'diesease': st.column_config.TextColumn("疾患名", width="medium"),
+    'keyword': st.column_config.TextColumn("症状・キーワード"),
+    'protocol': st.column_config.TextColumn("撮影プロトコル"),
+    'preview': st.column_config.TextColumn("内容", width="large"),
+}
+NOTICE_LIST_COLUMNS = {
+    'title': st.column_config.TextColumn("タイトル", width="medium"),
+    'preview': st.column_config.TextColumn("内容", width="large"),
+    'created_at': st.column_config.DatetimeColumn("作成日", format="YYYY/MM/DD HH:mm"),
+}
+PROTOCOL_LIST_COLUMNS = {
+    'category': st.column_config.TextColumn("カテゴリー"),
+    'title': st.column_config.TextColumn("タイトル", width="medium"),
+    'preview': st.column_config.TextColumn("内容", width="large"),
+    'updated_at': st.column_config.DatetimeColumn("更新日", format="YYYY/MM/DD HH:mm"),
+}
+
+def select_from_list(df, columns, key):
+    """一覧を1つの st.dataframe で表示し、選択された行のIDを返す（行ごとのボタンは作らない）"""
+    event = st.dataframe(df, column_order=list(columns), column_config=columns, hide_index=True, use_container_width=True,
+                         on_select="rerun", selection_mode="single-row", key=key)
+    rows = event.selection.rows
+    return int(df['id'].iloc[rows[0]]) if rows else None
+
+def rerun_fragment():
+    """操作したフラグメントだけ再実行（フラグメント外からの全体実行中なら全体を再実行）"""
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+# ページ送り（キーセット方式）
+PAGE_SIZE_OPTIONS = [10, 20, 50]
+
+def reset_pager(key):
+    """ページ送りを1ページ目に戻す"""
+    st.session_state[f"{key}_cursors"] = [None]
+
+def get_page_cursor(key):
+    """現在ページのカーソル（1ページ目は None）"""
+    return st.session_state.setdefault(f"{key}_cursors", [None])[-1]
+
+def select_page_size(key):
+    """表示件数の選択（変更時は1ページ目に戻す）"""
+    return st.selectbox("表示件数", PAGE_SIZE_OPTIONS, index=1, key=f"{key}_page_size",
+                        on_change=reset_pager, args=(key,))
+
+def render_pager(key, next_cursor):
+    """前へ/次へボタン（辿ったカーソルを session_state に積む。一覧のフラグメント内で呼び、その一覧だけ再実行する）"""
+    cursors = st.session_state.setdefault(f"{key}_cursors", [None])
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        if len(cursors) > 1 and st.button("← 前へ", key=f"{key}_prev"):
+            cursors.pop()
+            rerun_fragment()
+    with col2:
+        st.caption(f"{len(cursors)}ページ目")
+    with col3:
+        if next_cursor is not None and st.button("次へ →", key=f"{key}_next"):
+            cursors.append(next_cursor)
+            rerun_fragment()
+
 # 画像処理関数
 def resize_image(image, max_size=(600, 400)):
     """画像をリサイズして容量を削減"""
@@ -334,51 +465,84 @@ def resize_image(image, max_size=(600, 400)):
         image.thumbnail(max_size, Image.Resampling.LANCZOS)
     return image
 
-def image_to_base64(uploaded_file):
-    """アップロードファイルをBase64文字列に変換"""
+# 派生画像のサイズ（表示幅に合わせておくと st.image が再エンコードせずにそのまま配信する）
+IMAGE_FULL_SIZE = (2000, 2000)
+IMAGE_VARIANTS = {
+    'thumb': (200, 400),    # 編集画面のプレビュー（width=200）
+    'display': (300, 400),  # 詳細画面（width=300）
+}
+
+def encode_jpeg(image, quality):
+    """PIL ImageをJPEGのバイト列に変換"""
+    buffered = BytesIO()
+    image.save(buffered, format="JPEG", quality=quality, optimize=True)
+    return buffered.getvalue()
+
+def build_image_variants(image_data):
+    """元画像から full / display / thumb とハッシュを作成（保存時に1回だけ実行）"""
+    image = Image.open(BytesIO(image_data))
+    source_format = image.format
+
+    if image.mode == 'RGBA':
+        rgb_image = Image.new('RGB', image.size, (255, 255, 255))
+        rgb_image.paste(image, mask=image.split()[-1])
+        image = rgb_image
+    elif image.mode not in ['RGB', 'L']:
+        image = image.convert('RGB')
+
+    # JPEGで上限サイズ内なら元のバイト列をそのまま原本として保持
+    if source_format == 'JPEG' and image.size[0] <= IMAGE_FULL_SIZE[0] and image.size[1] <= IMAGE_FULL_SIZE[1]:
+        full = image_data
+    else:
+        full = encode_jpeg(resize_image(image.copy(), IMAGE_FULL_SIZE), 85)
+
+    variants = {'data': full, 'content_hash': hashlib.sha256(full).hexdigest()}
+    for variant, size in IMAGE_VARIANTS.items():
+        variants[variant] = encode_jpeg(resize_image(image.copy(), size), 80)
+    return variants
+
+def image_to_variants(uploaded_file):
+    """アップロードファイルから保存用の派生画像を作成"""
     try:
-        image = Image.open(uploaded_file)
-        resized_image = resize_image(image.copy())
-        
-        if resized_image.mode == 'RGBA':
-            rgb_image = Image.new('RGB', resized_image.size, (255, 255, 255))
-            rgb_image.paste(resized_image, mask=resized_image.split()[-1])
-            resized_image = rgb_image
-        elif resized_image.mode not in ['RGB', 'L']:
-            resized_image = resized_image.convert('RGB')
-        
-        buffered = BytesIO()
-        resized_image.save(buffered, format="JPEG", quality=50, optimize=True)
-        img_str = base64.b64encode(buffered.getvalue()).decode()
-        
-        if len(img_str) > 500000:  # 500KB
-            buffered = BytesIO()
-            resized_image.save(buffered, format="JPEG", quality=30, optimize=True)
-            img_str = base64.b64encode(buffered.getvalue()).decode()
-        
-        return img_str
+        return build_image_variants(uploaded_file.getvalue())
     except Exception as e:
         st.error(f"画像の変換に失敗しました: {str(e)}")
         return None
 
-def base64_to_image(base64_str):
-    """Base64文字列をPIL Imageに変換"""
-    if base64_str:
-        try:
-            image_data = base64.b64decode(base64_str)
-            return Image.open(BytesIO(image_data))
-        except Exception as e:
-            st.error(f"画像データの読み込みに失敗しました: {str(e)}")
-            return None
-    return None
+IMAGE_VARIANT_SQL = "SELECT {variant} FROM images WHERE content_hash = %s LIMIT 1"
+
+@st.cache_data(max_entries=64)
+def load_image_variant(content_hash, variant):
+    """派生画像のバイト列を読み込む（内容ハッシュがキーなので更新時の無効化は不要）
 
-def display_image_with_caption(base64_str, caption="", width=300):
-    """Base64画像を表示"""
-    if base64_str:
+    見つからない場合・接続できない場合は、後から作成された画像が表示されるよう結果をキャッシュせず LookupError にする。
+    """
+    with get_db_connection() as conn:
+        if not conn:
+            raise LookupError("データベースに接続できません")
+        cursor = conn.cursor()
+        cursor.execute(IMAGE_VARIANT_SQL.format(variant=variant), (content_hash,))
+        row = cursor.fetchone()
+        cursor.close()
+    if not row or row[0] is None:
+        raise LookupError(f"派生画像がありません: {content_hash} ({variant})")
+    return bytes(row[0])
+
+def get_image_variant(content_hash, variant):
+    """派生画像のバイト列を取得（なければ None）"""
+    try:
+        return load_image_variant(content_hash, variant)
+    except LookupError:
+        return None
+
+def display_image_with_caption(content_hash, caption="", width=300):
+    """画像を表示（表示幅に合った派生画像をデコードせずに配信）"""
+    if content_hash:
         try:
-            image = base64_to_image(base64_str)
-            if image:
-                st.image(image, caption=caption, width=width)
+            variant = 'thumb' if width <= IMAGE_VARIANTS['thumb'][0] else 'display'
+            image_data = get_image_variant(content_hash, variant)
+            if image_data:
+                st.image(image_data, caption=caption, width=width, output_format="JPEG")
             else:
                 st.warning("画像の表示に失敗しました")
         except Exception as e:
@@ -408,224 +572,327 @@ def validate_and_process_image(uploaded_file):
         test_image.verify()
         uploaded_file.seek(0)
         
-        base64_str = image_to_base64(uploaded_file)
-        if base64_str is None:
+        variants = image_to_variants(uploaded_file)
+        if variants is None:
             return None, "画像の変換に失敗しました"
         
-        return base64_str, "OK"
+        return variants, "OK"
         
     except Exception as e:
         return None, f"無効な画像ファイルです: {str(e)}"
 
+# コネクションプール設定（secrets.toml の [pool] セクションで上書き可能）
+DEFAULT_POOL_SETTINGS = {
+    'minconn': 1,                 # 起動時に確保しておく接続数
+    'maxconn': 10,                # 同時に貸し出せる最大接続数
+    'max_idle_seconds': 300,      # これ以上使われていない接続は破棄して張り直す
+    'health_check_seconds': 30,   # これ以上アイドルだった接続は貸し出し前にSELECT 1で確認
+    'checkout_timeout': 10,       # プール枯渇時に空きを待つ秒数
+}
+
+class ConnectionPool:
+    """プロセス全体で共有するPostgreSQLコネクションプール"""
+
+    def __init__(self, connect_params, minconn=1, maxconn=10, max_idle_seconds=300,
+                 health_check_seconds=30, checkout_timeout=10):
+        self.connect_params = dict(connect_params)
+        self.minconn = max(0, int(minconn))
+        self.maxconn = max(1, int(maxconn), self.minconn)
+        self.max_idle_seconds = float(max_idle_seconds)
+        self.health_check_seconds = float(health_check_seconds)
+        self.checkout_timeout = float(checkout_timeout)
+        self._idle = []  # (接続, 最終返却時刻) のスタック
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.maxconn)
+        for _ in range(self.minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        return psycopg2.connect(**self.connect_params)
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn, idle_seconds):
+        """貸し出し前の接続チェック"""
+        if conn.closed:
+            return False
+        if conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if idle_seconds < self.health_check_seconds:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn(self):
+        """プールから接続を借りる（枯渇時は checkout_timeout 秒まで待機）"""
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            raise psycopg2.pool.PoolError("コネクションプールが枯渇しています")
+        try:
+            while True:
+                with self._lock:
+                    entry = self._idle.pop() if self._idle else None
+                if entry is None:
+                    return self._connect()
+                conn, returned_at = entry
+                idle_seconds = time.monotonic() - returned_at
+                if idle_seconds <= self.max_idle_seconds and self._is_healthy(conn, idle_seconds):
+                    return conn
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        """接続をプールに返却（未完了のトランザクションはロールバック）"""
+        try:
+            if not conn.closed:
+                status = conn.info.transaction_status
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    self._discard(conn)
+                else:
+                    if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                    with self._lock:
+                        self._idle.append((conn, time.monotonic()))
+            self._recycle_idle()
+        except Exception:
+            self._discard(conn)
+        finally:
+            self._slots.release()
+
+    def _recycle_idle(self):
+        """max_idle_seconds を超えた余剰のアイドル接続を閉じる（minconn 本は残す）"""
+        now = time.monotonic()
+        keep, expired = [], []
+        with self._lock:
+            for conn, returned_at in reversed(self._idle):
+                if len(keep) >= self.minconn and now - returned_at > self.max_idle_seconds:
+                    expired.append(conn)
+                else:
+                    keep.append((conn, returned_at))
+            self._idle = list(reversed(keep))
+        for conn in expired:
+            self._discard(conn)
+
+    def closeall(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+@st.cache_resource
+def get_connection_pool():
+    """全セッションで共有するコネクションプールを取得（プロセスごとに1つ）"""
+    settings = dict(DEFAULT_POOL_SETTINGS)
+    if "pool" in st.secrets:
+        settings.update(st.secrets["pool"])
+    return ConnectionPool(st.secrets["postgres"], **settings)
+
+@contextmanager
 def get_db_connection():
-    """新しいPostgreSQL接続を取得"""
+    """プールからPostgreSQL接続を借りる（with文の終了時に例外があっても必ず返却）"""
     try:
-        return psycopg2.connect(**st.secrets["postgres"])
+        db_pool = get_connection_pool()
+        conn = db_pool.getconn()
     except Exception as e:
         st.error(f"データベース接続エラー: {e}")
-        return None
+        db_pool, conn = None, None
+
+    try:
+        yield conn
+    finally:
+        if conn is not None:
+            db_pool.putconn(conn)
 
 # データベース初期化
-@st.cache_resource
 def init_connection():
     """PostgreSQL接続テスト（表示用のみ）"""
     try:
-        conn = psycopg2.connect(**st.secrets["postgres"])
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1")
-        cursor.close()
-        conn.close()
+        with get_db_connection() as conn:
+            if not conn:
+                return False
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
         return True
     except Exception as e:
         st.error(f"データベース接続エラー: {e}")
         return False
 
-def init_database():
-    """PostgreSQLテーブルを初期化"""
-    conn = get_db_connection()
-    if not conn:
-        return
-    
+def create_base_tables(conn):
+    """基本テーブルと一覧用インデックスを作成"""
     cursor = conn.cursor()
-    
-    try:
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                name TEXT NOT NULL,
-                email TEXT UNIQUE NOT NULL,
-                userid TEXT,
-                password TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            userid TEXT,
+            password TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
 
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_sessions (
-                user_id INTEGER UNIQUE,
-                session_data TEXT,
-                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS sicks (
-                id SERIAL PRIMARY KEY,
-                diesease TEXT NOT NULL,
-                diesease_text TEXT NOT NULL,
-                keyword TEXT,
-                protocol TEXT,
-                protocol_text TEXT,
-                processing TEXT,
-                processing_text TEXT,
-                contrast TEXT,
-                contrast_text TEXT,
-                diesease_img TEXT,
-                protocol_img TEXT,
-                processing_img TEXT,
-                contrast_img TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS forms (
-                id SERIAL PRIMARY KEY,
-                title TEXT,
-                main TEXT,
-                post_img TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS browser_sessions (
+            token TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            session_data JSONB NOT NULL,
+            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_browser_sessions_last_updated ON browser_sessions (last_updated)')
 
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS protocols (
-                id SERIAL PRIMARY KEY,
-                category TEXT NOT NULL,
-                title TEXT NOT NULL,
-                content TEXT NOT NULL,
-                protocol_img TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        conn.commit()
-        
-    except Exception as e:
-        st.error(f"テーブル作成エラー: {e}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sicks (
+            id SERIAL PRIMARY KEY,
+            diesease TEXT NOT NULL,
+            diesease_text TEXT NOT NULL,
+            keyword TEXT,
+            protocol TEXT,
+            protocol_text TEXT,
+            processing TEXT,
+            processing_text TEXT,
+            contrast TEXT,
+            contrast_text TEXT,
+            diesease_img TEXT,
+            protocol_img TEXT,
+            processing_img TEXT,
+            contrast_img TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS forms (
+            id SERIAL PRIMARY KEY,
+            title TEXT,
+            main TEXT,
+            post_img TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS protocols (
+            id SERIAL PRIMARY KEY,
+            category TEXT NOT NULL,
+            title TEXT NOT NULL,
+            content TEXT NOT NULL,
+            protocol_img TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 一覧のキーセットページング用インデックス
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sicks_diesease_id ON sicks (diesease, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_forms_created_at_id ON forms (created_at DESC, id DESC)")
+    cursor.close()
 
 # 初期データ投入
-def insert_sample_data():
-    """サンプルデータを挿入"""
-    try:
-        conn = get_db_connection()
-        if not conn:
-            st.warning("データベース接続なし、サンプルデータ作成をスキップ")
-            return
-        
-        cursor = conn.cursor()
-        
-        # サンプルユーザーデータ
-        sample_users = [
-            ("管理者", "admin@hospital.jp", "Okiyoshi1126"),
-            ("技師", "tech@hospital.jp", "Tech123")
-        ]
-        
-        try:
-            for user_data in sample_users:
-                cursor.execute("SELECT COUNT(*) FROM users WHERE email = %s", (user_data[1],))
-                if cursor.fetchone()[0] == 0:
-                    cursor.execute("INSERT INTO users (name, email, password) VALUES (%s, %s, %s)",
-                                  (user_data[0], user_data[1], hash_password(user_data[2])))
-        except Exception as e:
-            st.warning(f"ユーザーデータ作成スキップ: {e}")
-        
-        # 疾患サンプルデータ
-        sample_sicks = [
-            ("脳梗塞", "脳血管が詰まる疾患", "脳梗塞,stroke", "頭部造影CT", "造影剤使用", "緊急検査", "迅速な対応", "あり", "造影剤注入", "", "", "", ""),
-            ("肺炎", "肺の感染症", "肺炎,pneumonia", "胸部CT", "単純CT", "標準撮影", "呼吸停止", "なし", "造影不要", "", "", "", "")
-        ]
-        
-        try:
-            for sick in sample_sicks:
-                cursor.execute("SELECT COUNT(*) FROM sicks WHERE diesease = %s", (sick[0],))
-                if cursor.fetchone()[0] == 0:
-                    cursor.execute('''
-                        INSERT INTO sicks (
-                            diesease, diesease_text, keyword, protocol, protocol_text,
-                            processing, processing_text, contrast, contrast_text,
-                            diesease_img, protocol_img, processing_img, contrast_img
-                        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    ''', sick)
-        except Exception as e:
-            st.warning(f"疾患データ作成スキップ: {e}")
-        
-        # お知らせサンプルデータ
-        sample_forms = [
-            ("システム運用開始", "CT医療システムの運用を開始しました。", ""),
-            ("利用方法について", "疾患検索機能をご活用ください。", "")
-        ]
-        
-        try:
-            for form in sample_forms:
-                cursor.execute("SELECT COUNT(*) FROM forms WHERE title = %s", (form[0],))
-                if cursor.fetchone()[0] == 0:
-                    cursor.execute("INSERT INTO forms (title, main, post_img) VALUES (%s, %s, %s)", form)
-        except Exception as e:
-            st.warning(f"お知らせデータ作成スキップ: {e}")
-        
-        # CTプロトコルサンプルデータ
-        sample_protocols = [
-            ("頭部", "頭部単純CT", "スライス厚: 5mm\n電圧: 120kV\n電流: 250mA", ""),
-            ("胸部", "胸部造影CT", "スライス厚: 1mm\n電圧: 120kV\n造影剤: 100ml", "")
-        ]
-        
-        try:
-            for protocol in sample_protocols:
-                cursor.execute("SELECT COUNT(*) FROM protocols WHERE title = %s AND category = %s", (protocol[1], protocol[0]))
-                if cursor.fetchone()[0] == 0:
-                    cursor.execute("INSERT INTO protocols (category, title, content, protocol_img) VALUES (%s, %s, %s, %s)", protocol)
-        except Exception as e:
-            st.warning(f"プロトコルデータ作成スキップ: {e}")
-        
-        conn.commit()
-        
-    except Exception as e:
-        st.error(f"❌ サンプルデータ作成エラー: {e}")
-        if 'conn' in locals():
-            conn.rollback()
-    finally:
-        if 'conn' in locals():
-            cursor.close()
-            conn.close()
+def seed_default_users(conn):
+    """初期ユーザーを作成"""
+    cursor = conn.cursor()
+    sample_users = [
+        ("管理者", "admin@hospital.jp", "Okiyoshi1126"),
+        ("技師", "tech@hospital.jp", "Tech123")
+    ]
+
+    for user_data in sample_users:
+        cursor.execute("SELECT COUNT(*) FROM users WHERE email = %s", (user_data[1],))
+        if cursor.fetchone()[0] == 0:
+            cursor.execute("INSERT INTO users (name, email, password) VALUES (%s, %s, %s)",
+                           (user_data[0], user_data[1], hash_password(user_data[2])))
+    cursor.close()
+
+def insert_sample_data(conn):
+    """サンプルデータを挿入（secrets.toml の [migrations] sample_data = true の場合のみ）"""
+    cursor = conn.cursor()
+
+    # 疾患サンプルデータ
+    sample_sicks = [
+        ("脳梗塞", "脳血管が詰まる疾患", "脳梗塞,stroke", "頭部造影CT", "造影剤使用", "緊急検査", "迅速な対応", "あり", "造影剤注入", "", "", "", ""),
+        ("肺炎", "肺の感染症", "肺炎,pneumonia", "胸部CT", "単純CT", "標準撮影", "呼吸停止", "なし", "造影不要", "", "", "", "")
+    ]
+
+    for sick in sample_sicks:
+        cursor.execute("SELECT COUNT(*) FROM sicks WHERE diesease = %s", (sick[0],))
+        if cursor.fetchone()[0] == 0:
+            cursor.execute('''
+                INSERT INTO sicks (
+                    diesease, diesease_text, keyword, protocol, protocol_text,
+                    processing, processing_text, contrast, contrast_text,
+                    diesease_img, protocol_img, processing_img, contrast_img
+                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ''', sick)
+
+    # お知らせサンプルデータ
+    sample_forms = [
+        ("システム運用開始", "CT医療システムの運用を開始しました。", ""),
+        ("利用方法について", "疾患検索機能をご活用ください。", "")
+    ]
+
+    for form in sample_forms:
+        cursor.execute("SELECT COUNT(*) FROM forms WHERE title = %s", (form[0],))
+        if cursor.fetchone()[0] == 0:
+            cursor.execute("INSERT INTO forms (title, main, post_img) VALUES (%s, %s, %s)", form)
+
+    # CTプロトコルサンプルデータ
+    sample_protocols = [
+        ("頭部", "頭部単純CT", "スライス厚: 5mm\n電圧: 120kV\n電流: 250mA", ""),
+        ("胸部", "胸部造影CT", "スライス厚: 1mm\n電圧: 120kV\n造影剤: 100ml", "")
+    ]
+
+    for protocol in sample_protocols:
+        cursor.execute("SELECT COUNT(*) FROM protocols WHERE title = %s AND category = %s", (protocol[1], protocol[0]))
+        if cursor.fetchone()[0] == 0:
+            cursor.execute("INSERT INTO protocols (category, title, content, protocol_img) VALUES (%s, %s, %s, %s)", protocol)
+    conn.commit()
+    cursor.close()
+
+    # サンプル行の検索用プレーンテキストを作成
+    for table in RICH_TEXT_FIELDS:
+        backfill_plain_text(conn, table)
+    # preview 列の追加後にサンプルデータを有効にした場合は、一覧用プレビューも作成する
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM information_schema.columns WHERE table_name = 'sicks' AND column_name = 'preview'")
+    has_preview = cursor.fetchone() is not None
+    cursor.close()
+    if has_preview:
+        for table in PREVIEW_SOURCES:
+            backfill_previews(conn, table)
 
 # 認証機能
 def hash_password(password):
     """パスワードをハッシュ化"""
     return hashlib.sha256(password.encode()).hexdigest()
 
+LOGIN_SQL = "SELECT id, name, email FROM users WHERE email = %s AND password = %s"
+
 def authenticate_user(email, password):
     """ユーザー認証 - PostgreSQL版"""
     try:
-        conn = get_db_connection()
-        if not conn:
-            return None
+        with get_db_connection() as conn:
+            if not conn:
+                return None
         
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT id, name, email FROM users WHERE email = %s AND password = %s", 
-            (email, hash_password(password))
-        )
-        user = cursor.fetchone()
-        conn.close()
+            cursor = conn.cursor()
+            cursor.execute(LOGIN_SQL, (email, hash_password(password)))
+            user = cursor.fetchone()
         return user
     except Exception as e:
         st.error(f"認証エラー: {e}")
@@ -634,198 +901,1524 @@ def authenticate_user(email, password):
 def register_user(name, email, password):
     """新規ユーザー登録 - PostgreSQL版"""
     try:
-        conn = get_db_connection()
-        if not conn:
-            return False
-        
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO users (name, email, password) VALUES (%s, %s, %s)",
-            (name, email, hash_password(password))
-        )
-        conn.commit()
-        conn.close()
+        with get_db_connection() as conn:
+            if not conn:
+                return False
+        
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO users (name, email, password) VALUES (%s, %s, %s)",
+                (name, email, hash_password(password))
+            )
+            conn.commit()
         return True
     except Exception as e:
         st.error(f"ユーザー登録エラー: {e}")
         return False
 
-# データベース操作関数
-@st.cache_data(ttl=300)  # 5分間キャッシュ
-def get_all_sicks():
-    """全疾患データを取得"""
-    conn = get_db_connection()
-    df = pd.read_sql_query("SELECT * FROM sicks ORDER BY diesease", conn)
-    conn.close()
-    return df
+# HTMLを含むリッチテキスト項目（検索用に <項目>_plain 列へタグを除いたテキストを保持する）
+RICH_TEXT_FIELDS = {
+    'sicks': ['keyword', 'diesease_text', 'protocol_text', 'processing_text', 'contrast_text'],
+    'forms': ['main'],
+    'protocols': ['content'],
+}
 
-@st.cache_data(ttl=300)
-def get_all_forms():
-    """全お知らせを取得"""
-    conn = get_db_connection()
-    df = pd.read_sql_query("SELECT * FROM forms ORDER BY created_at DESC", conn)
-    conn.close()
-    return df
+class RichTextExtractor(HTMLParser):
+    """HTMLから本文テキストだけを取り出すパーサー"""
 
-@st.cache_data(ttl=300)
-def search_sicks(search_term):
-    """疾患データを検索"""
-    conn = get_db_connection()
-    query = """
-        SELECT * FROM sicks 
-        WHERE diesease LIKE %s OR diesease_text LIKE %s OR keyword LIKE %s 
-        OR protocol LIKE %s OR protocol_text LIKE %s OR processing LIKE %s 
-        OR processing_text LIKE %s OR contrast LIKE %s OR contrast_text LIKE %s
-        ORDER BY diesease
-    """
-    search_pattern = f"%{search_term}%"
-    params = [search_pattern] * 9
-    df = pd.read_sql_query(query, conn, params=params)
-    conn.close()
-    return df
+    BLOCK_TAGS = {'p', 'div', 'br', 'li', 'ul', 'ol', 'tr', 'td', 'th', 'table', 'blockquote', 'pre',
+                  'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr'}
+    SKIP_TAGS = {'script', 'style'}
 
-def get_sick_by_id(sick_id):
-    """IDで疾患データを取得"""
-    conn = get_db_connection()
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append(' ')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in self.BLOCK_TAGS:
+            self.parts.append(' ')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append(' ')
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self.parts.append(data)
+
+def html_to_text(content):
+    """リッチテキスト(HTML)からタグを除去し、空白を正規化したプレーンテキストを返す"""
+    if not content:
+        return ""
+    text = str(content)
+    if '<' in text and '>' in text:
+        parser = RichTextExtractor()
+        parser.feed(text)
+        parser.close()
+        text = ''.join(parser.parts)
+    # 全角スペース・NBSP・ゼロ幅文字も含めて1つの空白にまとめる
+    return re.sub(r'[\s\u200b\ufeff]+', ' ', text).strip()
+
+def plain_text_values(table, values):
+    """リッチテキスト項目の値から <項目>_plain 列の値を作成"""
+    return {f"{field}_plain": html_to_text(values.get(field)) for field in RICH_TEXT_FIELDS[table]}
+
+# リッチテキストの正規化（保存時に1回だけ行い、表示・キャッシュ・バックアップの容量を減らす）
+RICH_TEXT_INLINE_TAGS = {'span', 'font', 'b', 'strong', 'i', 'em', 'u', 's', 'strike', 'sub', 'sup', 'a', 'code', 'mark',
+                         'small', 'ruby', 'rb', 'rt', 'rp'}
+RICH_TEXT_TAGS = RICH_TEXT_INLINE_TAGS | RichTextExtractor.BLOCK_TAGS | {'img', 'dl', 'dt', 'dd', 'thead', 'tbody', 'tfoot',
+                                                                          'caption', 'col', 'colgroup'}
+RICH_TEXT_VOID_TAGS = {'br', 'hr', 'img', 'col'}
+RICH_TEXT_ATTRIBUTES = {
+    'a': {'href'},
+    'font': {'color'},
+    'img': {'src', 'alt', 'width', 'height'},
+    'ol': {'start'},
+    'td': {'colspan', 'rowspan'},
+    'th': {'colspan', 'rowspan'},
+}
+# streamlit_quill は配置・インデント・文字サイズ・フォントを ql-* クラスで保存するため、そのクラスだけ残す
+RICH_TEXT_CLASS_PREFIX = 'ql-'
+# 属性を残さない場合はタグを外して中身だけ残す（意味を持たない装飾用のタグ）
+RICH_TEXT_BARE_UNWRAP_TAGS = {'span', 'font', 'a'}
+# 開くと閉じていない <p> を閉じるブロック要素
+RICH_TEXT_P_CLOSERS = {'p', 'div', 'ul', 'ol', 'dl', 'table', 'blockquote', 'pre', 'hr',
+                       'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+
+def parse_css_color(value):
+    """CSSの色指定を (正規化した値, (r, g, b)) にする（透明・継承は (None, None)、解釈できない名前は (値, None)）"""
+    value = value.strip().lower()
+    match = re.fullmatch(r'#([0-9a-f]{3}|[0-9a-f]{6})', value)
+    if match:
+        digits = match.group(1)
+        if len(digits) == 3:
+            digits = ''.join(digit * 2 for digit in digits)
+        rgb = tuple(int(digits[i:i + 2], 16) for i in (0, 2, 4))
+    else:
+        match = re.fullmatch(r'rgba?\(\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*(?:,\s*([\d.]+)\s*)?\)', value)
+        if match:
+            if match.group(4) is not None and float(match.group(4)) == 0:
+                return None, None
+            rgb = tuple(min(int(match.group(i)), 255) for i in (1, 2, 3))
+        elif value in ('', 'transparent', 'inherit', 'initial', 'unset', 'currentcolor') or value.startswith('var('):
+            return None, None
+        else:
+            rgb = {'black': (0, 0, 0), 'white': (255, 255, 255)}.get(value)
+            if rgb is None:
+                return value, None
+    return '#%02x%02x%02x' % rgb, rgb
+
+def is_body_text_color(rgb):
+    """本文の文字色と区別できない黒〜濃いグレー（コピー元ページの文字色がそのまま残ったもの）"""
+    return rgb is not None and max(rgb) <= 0x55 and max(rgb) - min(rgb) <= 16
+
+def is_page_background_color(rgb):
+    """ページ背景と区別できない白〜薄いグレー"""
+    return rgb is not None and min(rgb) >= 0xef and max(rgb) - min(rgb) <= 16
+
+def normalize_rich_style(style):
+    """style属性から強調に関係する指定（文字色・背景色・太字・斜体・下線・中央/右寄せ）だけを残す"""
+    kept = {}
+    for declaration in style.split(';'):
+        name, _, value = declaration.partition(':')
+        name, value = name.strip().lower(), value.strip().lower()
+        if name == 'color':
+            color, rgb = parse_css_color(value)
+            if color and not is_body_text_color(rgb):
+                kept['color'] = color
+        elif name == 'background-color':
+            color, rgb = parse_css_color(value)
+            if color and not is_page_background_color(rgb):
+                kept['background-color'] = color
+        elif name == 'font-weight':
+            if value in ('bold', 'bolder') or (value.isdigit() and int(value) >= 600):
+                kept['font-weight'] = 'bold'
+        elif name == 'font-style':
+            if value in ('italic', 'oblique'):
+                kept['font-style'] = 'italic'
+        elif name in ('text-decoration', 'text-decoration-line'):
+            lines = [line for line in ('underline', 'line-through') if line in value]
+            if lines:
+                kept['text-decoration'] = ' '.join(lines)
+        elif name == 'text-align':
+            if value in ('center', 'right'):
+                kept['text-align'] = value
+    return ';'.join(f"{name}:{value}" for name, value in kept.items())
+
+def normalize_rich_attributes(tag, attrs):
+    """タグごとに表示に必要な属性だけを残す"""
+    allowed = RICH_TEXT_ATTRIBUTES.get(tag, set())
+    normalized = {}
+    for name, value in attrs:
+        value = (value or '').strip()
+        if name == 'style':
+            style = normalize_rich_style(value)
+            if style:
+                normalized['style'] = style
+        elif name == 'class':
+            classes = ' '.join(token for token in value.split() if token.startswith(RICH_TEXT_CLASS_PREFIX))
+            if classes:
+                normalized['class'] = classes
+        elif name in allowed and value:
+            if name == 'color':
+                color, rgb = parse_css_color(value)
+                if color and not is_body_text_color(rgb):
+                    normalized['color'] = color
+            elif name in ('href', 'src') and re.match(r'^\s*(?:javascript|vbscript):', value, re.IGNORECASE):
+                continue
+            else:
+                normalized[name] = value
+    return normalized
+
+class RichTextNormalizer(HTMLParser):
+    """HTMLを表示に必要なタグ・属性だけの木（[タグ, 属性, 子要素] と文字列）に読み込むパーサー"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.root = ['', {}, []]
+        self.stack = [self.root]
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in RichTextExtractor.SKIP_TAGS:
+            self._skip_depth += 1
+            return
+        if self._skip_depth or tag not in RICH_TEXT_TAGS:
+            # 未知のタグ（Wordの <o:p> など）はタグだけ外して中身を残す
+            return
+        if tag in RICH_TEXT_P_CLOSERS:
+            self._close_open_paragraph()
+        node = [tag, normalize_rich_attributes(tag, attrs), []]
+        self.stack[-1][2].append(node)
+        if tag not in RICH_TEXT_VOID_TAGS:
+            self.stack.append(node)
+
+    def handle_endtag(self, tag):
+        if tag in RichTextExtractor.SKIP_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+            return
+        for depth in range(len(self.stack) - 1, 0, -1):
+            if self.stack[depth][0] == tag:
+                del self.stack[depth:]
+                break
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self.stack[-1][2].append(data)
+
+    def _close_open_paragraph(self):
+        # 閉じていない <p> の中にブロック要素が来たら、ブラウザと同じく <p> を閉じる
+        for depth in range(len(self.stack) - 1, 0, -1):
+            tag = self.stack[depth][0]
+            if tag == 'p':
+                del self.stack[depth:]
+                return
+            if tag not in RICH_TEXT_INLINE_TAGS:
+                return
+
+def append_rich_node(nodes, node):
+    """子要素の列に追加し、隣り合う文字列と、同じタグ・属性の隣り合うインライン要素を1つにまとめる"""
+    previous = nodes[-1] if nodes else None
+    if isinstance(node, str):
+        if isinstance(previous, str):
+            nodes[-1] = previous + node
+        elif node:
+            nodes.append(node)
+    elif (isinstance(previous, list) and node[0] in RICH_TEXT_INLINE_TAGS
+          and previous[0] == node[0] and previous[1] == node[1]):
+        for child in node[2]:
+            append_rich_node(previous[2], child)
+    else:
+        nodes.append(node)
+
+def simplify_rich_nodes(nodes):
+    """属性のない span/font を外し、空のインライン要素を除き、隣り合う同じ装飾をまとめる"""
+    simplified = []
+    for node in nodes:
+        if isinstance(node, str):
+            append_rich_node(simplified, node)
+            continue
+        tag, attrs, children = node
+        children = simplify_rich_nodes(children)
+        if tag in RICH_TEXT_VOID_TAGS:
+            append_rich_node(simplified, [tag, attrs, []])
+        elif (tag in RICH_TEXT_BARE_UNWRAP_TAGS and not attrs) or (
+                tag in RICH_TEXT_INLINE_TAGS and all(isinstance(child, str) and not child.strip() for child in children)):
+            # 空白だけの装飾は空白を残してタグを外す
+            for child in children:
+                append_rich_node(simplified, child)
+        else:
+            append_rich_node(simplified, [tag, attrs, children])
+    return simplified
+
+def render_rich_nodes(nodes):
+    """木をHTML文字列に戻す"""
+    parts = []
+    for node in nodes:
+        if isinstance(node, str):
+            parts.append(html.escape(node, quote=False))
+            continue
+        tag, attrs, children = node
+        parts.append(f"<{tag}" + ''.join(f' {name}="{html.escape(value)}"' for name, value in attrs.items()) + ">")
+        if tag not in RICH_TEXT_VOID_TAGS:
+            parts.append(render_rich_nodes(children))
+            parts.append(f"</{tag}>")
+    return ''.join(parts)
+
+def normalize_rich_html(content):
+    """リッチテキスト(HTML)から不要なスタイル・属性を除き、冗長な span を整理した最小のHTMLを返す
+
+    文字色・背景色・太字などの強調は残す。HTMLを含まない値はそのまま返す。
+    """
+    if not content or not ('<' in content and '>' in content):
+        return content
+    parser = RichTextNormalizer()
+    parser.feed(content)
+    parser.close()
+    if all(isinstance(node, str) for node in parser.root[2]):
+        # 「<場所>」のような山括弧を含むだけのプレーンテキストは書き換えない
+        return content
+    return render_rich_nodes(simplify_rich_nodes(parser.root[2]))
+
+def normalize_rich_values(table, values):
+    """リッチテキスト項目の値を正規化した値を返す"""
+    return {field: normalize_rich_html(values.get(field)) for field in RICH_TEXT_FIELDS[table]}
+
+# 一覧用プレビュー（保存時にプレーンテキストから作成し、一覧の表にそのまま表示する）: テーブル → (元の列, 表示幅（半角=1, 全角=2）)
+PREVIEW_SOURCES = {
+    'sicks': ('diesease_text_plain', 300),
+    'forms': ('main_plain', 400),
+    'protocols': ('content_plain', 400),
+}
+
+def build_preview(text, width):
+    """プレーンテキストを表示幅 width 以内（超える場合は末尾を ... にする）に切り詰める"""
+    text = text or ''
+    used, cut = 0, None
+    for index, char in enumerate(text):
+        used += 2 if unicodedata.east_asian_width(char) in ('W', 'F') else 1
+        if cut is None and used > width - 3:
+            cut = index
+        if used > width:
+            return text[:cut].rstrip() + '...'
+    return text
+
+def preview_value(table, plain):
+    """plain_text_values の結果から preview 列の値を作成"""
+    column, width = PREVIEW_SOURCES[table]
+    return build_preview(plain.get(column), width)
+
+def backfill_previews(conn, table, batch_size=200):
+    """preview 列が未設定の行を一括で埋める"""
+    column, width = PREVIEW_SOURCES[table]
+    cursor = conn.cursor()
+    while True:
+        cursor.execute(f"SELECT id, {column} FROM {table} WHERE preview IS NULL ORDER BY id LIMIT %s", (batch_size,))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        execute_values(cursor, f'''
+            UPDATE {table} AS t SET preview = v.preview
+            FROM (VALUES %s) AS v(id, preview)
+            WHERE t.id = v.id
+        ''', [(row_id, build_preview(text, width)) for row_id, text in rows])
+        conn.commit()
+    cursor.close()
+
+def add_preview_columns(conn):
+    """一覧用の preview 列を追加し、既存行を埋める"""
+    cursor = conn.cursor()
+    for table in PREVIEW_SOURCES:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS preview TEXT")
+    conn.commit()
+    cursor.close()
+    for table in PREVIEW_SOURCES:
+        backfill_previews(conn, table)
+
+def backfill_plain_text(conn, table, batch_size=200):
+    """<項目>_plain 列が未設定の行を一括で埋める（更新件数を返す）"""
+    fields = RICH_TEXT_FIELDS[table]
+    plain_columns = [f"{field}_plain" for field in fields]
+    missing = " OR ".join(f"({field}_plain IS NULL AND {field} IS NOT NULL)" for field in fields)
+    assignments = ", ".join(f"{column} = v.{column}" for column in plain_columns)
+    cursor = conn.cursor()
+    updated = 0
+    while True:
+        cursor.execute(f"SELECT id, {', '.join(fields)} FROM {table} WHERE {missing} ORDER BY id LIMIT %s", (batch_size,))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        values = [(row[0], *[html_to_text(value) for value in row[1:]]) for row in rows]
+        execute_values(cursor, f'''
+            UPDATE {table} AS t SET {assignments}
+            FROM (VALUES %s) AS v(id, {', '.join(plain_columns)})
+            WHERE t.id = v.id
+        ''', values)
+        conn.commit()
+        updated += len(rows)
+    cursor.close()
+    return updated
+
+def normalize_stored_rich_text(batch_size=200):
+    """保存済みのリッチテキストを正規化し、テーブルごとの {'rows': 更新行数, 'before': 元のバイト数, 'after': 正規化後のバイト数} を返す
+
+    読み込んだ後に編集された行は上書きしないよう、updated_at が変わっていない行だけを更新する。
+    更新した行の updated_at は現在時刻にする（増分バックアップに含めるため）。
+    接続できない場合は None を返す。
+    """
+    report = {}
+    with get_db_connection() as conn:
+        if not conn:
+            return None
+        cursor = conn.cursor()
+        for table, fields in RICH_TEXT_FIELDS.items():
+            stats = {'rows': 0, 'before': 0, 'after': 0}
+            last_id = 0
+            while True:
+                cursor.execute(f"SELECT id, updated_at, {', '.join(fields)} FROM {table} WHERE id > %s ORDER BY id LIMIT %s",
+                               (last_id, batch_size))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                changed = []
+                for row_id, updated_at, *values in rows:
+                    normalized = [normalize_rich_html(value) for value in values]
+                    stats['before'] += sum(len(value.encode('utf-8')) for value in values if value)
+                    stats['after'] += sum(len(value.encode('utf-8')) for value in normalized if value)
+                    if normalized != values:
+                        changed.append((row_id, updated_at, *normalized))
+                if changed:
+                    execute_values(cursor, f'''
+                        UPDATE {table} AS t SET {', '.join(f"{field} = v.{field}" for field in fields)}, updated_at = CURRENT_TIMESTAMP
+                        FROM (VALUES %s) AS v(id, updated_at, {', '.join(fields)})
+                        WHERE t.id = v.id AND t.updated_at IS NOT DISTINCT FROM v.updated_at::timestamp
+                    ''', changed, page_size=len(changed))
+                    stats['rows'] += cursor.rowcount
+                conn.commit()
+            report[table] = stats
+        if any(stats['rows'] for stats in report.values()):
+            notify_change(cursor, list(RICH_TEXT_FIELDS))
+            conn.commit()
+        cursor.close()
+    bump_table_versions(*RICH_TEXT_FIELDS)
+    return report
+
+def add_plain_text_columns(conn):
+    """<項目>_plain 列を追加し、既存行をバックフィル"""
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM sicks WHERE id = %s", (sick_id,))
-    sick = cursor.fetchone()
-    conn.close()
+    for table, fields in RICH_TEXT_FIELDS.items():
+        for field in fields:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {field}_plain TEXT")
+    conn.commit()
+    cursor.close()
+    for table in RICH_TEXT_FIELDS:
+        backfill_plain_text(conn, table)
+
+# 画像スロット（旧: 各テーブルのBase64 TEXT列。現在は images テーブルにバイナリで保存）
+IMAGE_SLOTS = {
+    'sicks': ['diesease_img', 'protocol_img', 'processing_img', 'contrast_img'],
+    'forms': ['post_img'],
+    'protocols': ['protocol_img'],
+}
+
+def decode_image_data(value):
+    """Base64文字列（data URI も可）を画像バイト列に変換。不正な値は None"""
+    if not value:
+        return None
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value)
+    if value.startswith('data:') and ',' in value:
+        value = value.split(',', 1)[1]
+    try:
+        return base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+
+def image_row(table, owner_id, slot, image):
+    """images テーブルに書き込む1行を作成（値は派生画像の辞書か元画像のバイト列）"""
+    variants = image if isinstance(image, dict) else build_image_variants(image)
+    return (table, owner_id, slot, psycopg2.Binary(variants['data']), psycopg2.Binary(variants['display']),
+            psycopg2.Binary(variants['thumb']), variants['content_hash'])
+
+def save_images(cursor, table, owner_id, images):
+    """スロットごとの画像を保存（None のスロットは既存画像を維持）"""
+    upsert_image_rows(cursor, [image_row(table, owner_id, slot, image) for slot, image in images.items() if image])
+
+def upsert_image_rows(cursor, rows):
+    """image_row で作成した行をまとめて保存"""
+    if rows:
+        execute_values(cursor, '''
+            INSERT INTO images (owner_table, owner_id, slot, data, display, thumb, content_hash) VALUES %s
+            ON CONFLICT (owner_table, owner_id, slot) DO UPDATE SET
+                data = EXCLUDED.data,
+                display = EXCLUDED.display,
+                thumb = EXCLUDED.thumb,
+                content_hash = EXCLUDED.content_hash,
+                updated_at = CURRENT_TIMESTAMP
+        ''', rows)
+
+def delete_images(cursor, table, owner_id):
+    """レコードに紐づく画像をすべて削除"""
+    cursor.execute("DELETE FROM images WHERE owner_table = %s AND owner_id = %s", (table, owner_id))
+
+def migrate_base64_images(conn, table, batch_size=50):
+    """旧Base64列の画像を images テーブルへ移し、移した列を NULL にする（移行件数を返す）"""
+    slots = IMAGE_SLOTS[table]
+    pending = " OR ".join(f"({slot} IS NOT NULL AND {slot} <> '')" for slot in slots)
+    cursor = conn.cursor()
+    moved = 0
+    last_id = 0
+    while True:
+        cursor.execute(f"SELECT id, {', '.join(slots)} FROM {table} WHERE id > %s AND ({pending}) ORDER BY id LIMIT %s",
+                       (last_id, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        for row in rows:
+            images = {slot: decode_image_data(value) for slot, value in zip(slots, row[1:])}
+            for slot, data in images.items():
+                try:
+                    images[slot] = build_image_variants(data) if data else None
+                except Exception:
+                    images[slot] = None
+            save_images(cursor, table, row[0], images)
+            # 変換できなかった値は消さずに残す
+            cleared = [slot for slot, data in images.items() if data]
+            if cleared:
+                cursor.execute(f"UPDATE {table} SET {', '.join(f'{slot} = NULL' for slot in cleared)} WHERE id = %s", (row[0],))
+                moved += len(cleared)
+        conn.commit()
+        last_id = rows[-1][0]
+    cursor.close()
+    return moved
+
+def backfill_image_variants(conn, batch_size=50):
+    """派生画像が未作成の行に display / thumb / content_hash を作成（作成件数を返す）"""
+    cursor = conn.cursor()
+    updated = 0
+    last_id = 0
+    while True:
+        cursor.execute("SELECT id, data FROM images WHERE id > %s AND content_hash IS NULL ORDER BY id LIMIT %s",
+                       (last_id, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        values = []
+        for image_id, data in rows:
+            try:
+                variants = build_image_variants(bytes(data))
+            except Exception as e:
+                st.warning(f"画像ID {image_id} の派生画像を作成できませんでした: {e}")
+                continue
+            values.append((image_id, psycopg2.Binary(variants['data']), psycopg2.Binary(variants['display']),
+                           psycopg2.Binary(variants['thumb']), variants['content_hash']))
+        if values:
+            execute_values(cursor, '''
+                UPDATE images AS t SET data = v.data, display = v.display, thumb = v.thumb, content_hash = v.content_hash
+                FROM (VALUES %s) AS v(id, data, display, thumb, content_hash)
+                WHERE t.id = v.id
+            ''', values)
+        conn.commit()
+        updated += len(values)
+        last_id = rows[-1][0]
+    cursor.close()
+    return updated
+
+def create_image_store(conn):
+    """images テーブルを作成し、旧Base64列の画像を移行"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS images (
+            id SERIAL PRIMARY KEY,
+            owner_table TEXT NOT NULL,
+            owner_id INTEGER NOT NULL,
+            slot TEXT NOT NULL,
+            data BYTEA NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (owner_table, owner_id, slot)
+        )
+    ''')
+    # 派生画像（data は原本）
+    cursor.execute("ALTER TABLE images ADD COLUMN IF NOT EXISTS display BYTEA")
+    cursor.execute("ALTER TABLE images ADD COLUMN IF NOT EXISTS thumb BYTEA")
+    cursor.execute("ALTER TABLE images ADD COLUMN IF NOT EXISTS content_hash TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_content_hash ON images (content_hash)")
+    conn.commit()
+    cursor.close()
+    for table in IMAGE_SLOTS:
+        migrate_base64_images(conn, table)
+    backfill_image_variants(conn)
+
+def add_unique_constraint(conn, table, name, columns):
+    """UNIQUE制約を追加（重複データがある場合は重複している値を示して失敗する）"""
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM pg_constraint WHERE conname = %s", (name,))
+    if not cursor.fetchone():
+        key = ", ".join(columns)
+        cursor.execute(f"SELECT {key}, COUNT(*) FROM {table} GROUP BY {key} HAVING COUNT(*) > 1 ORDER BY {key} LIMIT 10")
+        duplicates = cursor.fetchall()
+        if duplicates:
+            listed = ", ".join(" / ".join(str(value) for value in row[:-1]) + f" ({row[-1]}件)" for row in duplicates)
+            raise ValueError(f"{table} の ({key}) に重複データがあるため制約を追加できません: {listed}")
+        cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {name} UNIQUE ({key})")
+    cursor.close()
+
+def add_unique_disease_constraint(conn):
+    """疾患名のUNIQUE制約を追加（復元・取り込みの ON CONFLICT (diesease) が使用）"""
+    add_unique_constraint(conn, 'sicks', 'unique_diesease', ['diesease'])
+
+def add_query_indexes(conn):
+    """復元が使う制約・インデックスを追加（カテゴリー別一覧もプロトコルの制約で絞り込み・並べ替える）"""
+    add_unique_constraint(conn, 'protocols', 'unique_protocol_category_title', ['category', 'title'])
+    # お知らせのタイトルは重複してよいので、復元時の照合（タイトルと作成日時）用にUNIQUEでないインデックスだけ作る
+    cursor = conn.cursor()
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_forms_title_created_at ON forms (title, created_at)")
+    cursor.close()
+
+def create_change_log(conn):
+    """増分バックアップ用に、削除・キー変更の記録トリガー、バックアップ履歴、更新日時のインデックスを作成"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS change_log (
+            id BIGSERIAL PRIMARY KEY,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            row_key JSONB NOT NULL,
+            changed_at TIMESTAMP NOT NULL DEFAULT LOCALTIMESTAMP
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_change_log_changed_at ON change_log (changed_at)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS backup_runs (
+            id SERIAL PRIMARY KEY,
+            kind TEXT NOT NULL,
+            watermark TIMESTAMP NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    for table, spec in RESTORE_TABLES.items():
+        # 復元先とはIDが一致しないため、復元時に突き合わせるキー（疾患名、お知らせはタイトルと作成日時など）で記録する
+        old_key = "jsonb_build_object(" + ", ".join(f"'{column}', OLD.{column}" for column in spec['key']) + ")"
+        key_changed = " OR ".join(f"OLD.{column} IS DISTINCT FROM NEW.{column}" for column in spec['key'])
+        cursor.execute(f'''
+            CREATE OR REPLACE FUNCTION log_{table}_removal() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    INSERT INTO change_log (table_name, row_id, row_key) VALUES ('{table}', OLD.id, {old_key});
+                ELSIF {key_changed} THEN
+                    INSERT INTO change_log (table_name, row_id, row_key) VALUES ('{table}', OLD.id, {old_key});
+                END IF;
+                RETURN NULL;
+            END $$ LANGUAGE plpgsql
+        ''')
+        cursor.execute(f"DROP TRIGGER IF EXISTS trg_{table}_change_log ON {table}")
+        cursor.execute(f'''
+            CREATE TRIGGER trg_{table}_change_log AFTER DELETE OR UPDATE OF {', '.join(spec['key'])} ON {table}
+            FOR EACH ROW EXECUTE FUNCTION log_{table}_removal()
+        ''')
+    for table in ('sicks', 'forms', 'protocols', 'images', 'users'):
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_updated_at ON {table} (updated_at)")
+    cursor.close()
+
+# 検索ドキュメント（生成カラム）の定義: 検索対象の全フィールドを連結し、検索語と同じく NFKC + 小文字化
+SEARCH_DOCUMENTS = {
+    'sicks': ['diesease', 'keyword_plain', 'protocol', 'processing', 'contrast',
+              'diesease_text_plain', 'protocol_text_plain', 'processing_text_plain', 'contrast_text_plain'],
+    'protocols': ['title', 'category', 'content_plain'],
+}
+
+# 日本語の短い語（2文字）にも効く pg_bigm を優先し、なければ pg_trgm を使う
+SEARCH_INDEX_EXTENSIONS = [('pg_bigm', 'gin_bigm_ops'), ('pg_trgm', 'gin_trgm_ops')]
+
+def search_fold_sql(expression):
+    """SQL式を検索用に正規化（parse_search_query と同じ NFKC + 小文字化、PostgreSQL 13以降）"""
+    return f"lower(normalize({expression}, NFKC))"
+
+def create_search_documents(conn):
+    """検索用の生成カラム search_doc と、拡張機能（pg_bigm / pg_trgm）を使えればGINインデックスを作成"""
+    cursor = conn.cursor()
+    extension, opclass = None, None
+    for candidate, candidate_opclass in SEARCH_INDEX_EXTENSIONS:
+        # 拡張機能がない・権限がない場合はこの文だけ取り消して次の候補を試す
+        cursor.execute("SAVEPOINT search_extension")
+        try:
+            cursor.execute(f"CREATE EXTENSION IF NOT EXISTS {candidate}")
+            extension, opclass = candidate, candidate_opclass
+            break
+        except psycopg2.Error:
+            cursor.execute("ROLLBACK TO SAVEPOINT search_extension")
+
+    for table, columns in SEARCH_DOCUMENTS.items():
+        # 定義の異なる古い search_doc（HTML列から生成・NFKC正規化なし）は作り直す
+        cursor.execute('''
+            SELECT generation_expression FROM information_schema.columns
+            WHERE table_name = %s AND column_name = 'search_doc'
+        ''', (table,))
+        current = cursor.fetchone()
+        if current and (not all(re.search(rf'\b{column}\b', current[0] or '') for column in columns)
+                        or 'normalize' not in (current[0] or '')):
+            cursor.execute(f"ALTER TABLE {table} DROP COLUMN search_doc")
+
+        # concat_ws は IMMUTABLE ではないため || で連結する
+        document = " || ' ' || ".join(f"coalesce({column}, '')" for column in columns)
+        cursor.execute(f'''
+            ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_doc TEXT
+            GENERATED ALWAYS AS ({search_fold_sql(document)}) STORED
+        ''')
+        if opclass:
+            cursor.execute(f'''
+                CREATE INDEX IF NOT EXISTS idx_{table}_search_doc_{extension}
+                ON {table} USING gin (search_doc {opclass})
+            ''')
+    cursor.close()
+
+# スキーマ移行（番号順に1度だけ適用し、schema_migrations に記録する）
+SCHEMA_MIGRATIONS = [
+    (1, 'base_tables', create_base_tables),
+    (2, 'default_users', seed_default_users),
+    (3, 'plain_text_columns', add_plain_text_columns),
+    (4, 'image_store', create_image_store),
+    (5, 'unique_disease', add_unique_disease_constraint),
+    (6, 'sample_data', insert_sample_data),
+    (7, 'query_indexes', add_query_indexes),
+    (8, 'change_log', create_change_log),
+    (9, 'preview_columns', add_preview_columns),
+    (10, 'search_documents', create_search_documents),
+]
+# secrets.toml の [migrations] で明示的に有効にした場合のみ適用する移行
+OPT_IN_MIGRATIONS = {'sample_data'}
+MIGRATION_LOCK_ID = 7301  # pg_advisory_lock のキー（レプリカ間で移行を直列化）
+MIGRATION_CONNECTION_ERROR = "データベースに接続できません"
+
+def migration_enabled(name):
+    """移行を適用するか（オプトインの移行は [migrations] <名前> = true のときのみ）"""
+    if name not in OPT_IN_MIGRATIONS:
+        return True
+    return bool(st.secrets.get("migrations", {}).get(name, False))
+
+@st.cache_resource
+def run_schema_migrations():
+    """未適用のスキーマ移行を順に適用（プロセスごとに1回）。失敗した場合はエラーメッセージを返す
+
+    失敗した移行はロールバックして残りの移行を続ける（失敗した移行は次回の実行で再び試行される）。
+    """
+    with get_db_connection() as conn:
+        if not conn:
+            return MIGRATION_CONNECTION_ERROR
+        cursor = conn.cursor()
+        # 他のレプリカが移行中なら終わるまで待つ（セッション単位のロックなので途中のコミットでは外れない）
+        cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        try:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            conn.commit()
+            cursor.execute("SELECT version FROM schema_migrations")
+            applied = {row[0] for row in cursor.fetchall()}
+            errors = []
+            for version, name, migrate in SCHEMA_MIGRATIONS:
+                if version in applied or not migration_enabled(name):
+                    continue
+                try:
+                    migrate(conn)
+                    cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    errors.append(f"スキーマ移行エラー（{version}: {name}）: {e}")
+            return "\n".join(errors) or None
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+            conn.commit()
+            cursor.close()
+
+def select_list(table, column_names):
+    """SELECT句を作成（画像スロットは本体を読まず、内容ハッシュだけ返す）"""
+    columns = []
+    for name in column_names:
+        if name in IMAGE_SLOTS.get(table, []):
+            columns.append(f"(SELECT content_hash FROM images WHERE images.owner_table = '{table}' "
+                           f"AND images.owner_id = {table}.id AND images.slot = '{name}') AS {name}")
+        else:
+            columns.append(name)
+    return ", ".join(columns)
+
+# 各テーブルの基本カラム（SELECT * だと検索用の追加カラムまで転送されるため明示する）
+SICK_COLUMN_NAMES = ['id', 'diesease', 'diesease_text', 'keyword', 'protocol', 'protocol_text',
+                     'processing', 'processing_text', 'contrast', 'contrast_text',
+                     'diesease_img', 'protocol_img', 'processing_img', 'contrast_img', 'created_at', 'updated_at']
+FORM_COLUMN_NAMES = ['id', 'title', 'main', 'post_img', 'created_at', 'updated_at']
+PROTOCOL_COLUMN_NAMES = ['id', 'category', 'title', 'content', 'protocol_img', 'created_at', 'updated_at']
+SICK_COLUMNS = select_list('sicks', SICK_COLUMN_NAMES)
+FORM_COLUMNS = select_list('forms', FORM_COLUMN_NAMES)
+PROTOCOL_COLUMNS = select_list('protocols', PROTOCOL_COLUMN_NAMES)
+
+# 一覧ページ用のカラム（本文は保存時に作成したプレビューだけ返し、全文は詳細ページで取得する）
+SICK_SUMMARY_COLUMNS = "id, diesease, keyword_plain AS keyword, protocol, preview"
+FORM_SUMMARY_COLUMNS = "id, title, created_at, preview"
+PROTOCOL_SUMMARY_COLUMNS = "id, category, title, created_at, updated_at, preview"
+
+@st.cache_resource
+def get_search_extension():
+    """検索のGINインデックスに使っている拡張機能名を返す（インデックスがなければ None、プロセスごとに1回）"""
+    if run_schema_migrations():
+        return None
+    with get_db_connection() as conn:
+        if not conn:
+            return None
+        cursor = conn.cursor()
+        cursor.execute("SELECT indexname FROM pg_indexes WHERE indexname LIKE 'idx_%_search_doc_%'")
+        indexes = {row[0] for row in cursor.fetchall()}
+        cursor.close()
+    for extension, _ in SEARCH_INDEX_EXTENSIONS:
+        if all(f"idx_{table}_search_doc_{extension}" in indexes for table in SEARCH_DOCUMENTS):
+            return extension
+    return None
+
+def parse_search_query(search_term):
+    """検索語を解析（空白区切りはAND、OR または | で区切るとOR）→ [[語, ...], ...]"""
+    groups, current = [], []
+    normalized = unicodedata.normalize('NFKC', search_term or '').lower().replace('|', ' | ')
+    for token in normalized.split():
+        if token in ('or', '|'):
+            if current:
+                groups.append(current)
+                current = []
+        else:
+            current.append(token)
+    if current:
+        groups.append(current)
+    return groups
+
+def to_like_pattern(term):
+    """LIKE用の部分一致パターン（ワイルドカードはエスケープ）"""
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{escaped}%"
+
+# インメモリ検索インデックスのフィールド重み（疾患名 > キーワード > 本文）
+SEARCH_FIELD_WEIGHTS = {
+    'sicks': {
+        'diesease': 3.0, 'keyword_plain': 2.0,
+        'protocol': 1.5, 'processing': 1.5, 'contrast': 1.5,
+        'diesease_text_plain': 1.0, 'protocol_text_plain': 1.0,
+        'processing_text_plain': 1.0, 'contrast_text_plain': 1.0,
+    },
+    'protocols': {'title': 3.0, 'category': 2.0, 'content_plain': 1.0},
+}
+
+class NgramIndex:
+    """文字n-gram（1〜2文字）の転置インデックス（BM25風スコアリング、逐次更新対応）"""
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, field_weights, ngram_sizes=(1, 2)):
+        self.field_weights = field_weights
+        self.ngram_sizes = ngram_sizes
+        self._docs = {}                          # doc_id -> {フィールド: 正規化済みテキスト}
+        self._postings = defaultdict(set)        # n-gram -> doc_id の集合
+        self._field_lengths = defaultdict(int)   # フィールド -> 全文書の合計文字数
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def normalize(text):
+        return unicodedata.normalize('NFKC', str(text or '')).lower()
+
+    def _grams(self, text):
+        grams = set()
+        for chunk in text.split():
+            for n in self.ngram_sizes:
+                for i in range(len(chunk) - n + 1):
+                    grams.add(chunk[i:i + n])
+        return grams
+
+    def __len__(self):
+        return len(self._docs)
+
+    def upsert(self, doc_id, fields):
+        """文書を追加・更新"""
+        texts = {field: self.normalize(fields.get(field)) for field in self.field_weights}
+        with self._lock:
+            self.remove(doc_id)
+            self._docs[doc_id] = texts
+            for field, text in texts.items():
+                self._field_lengths[field] += len(text)
+                for gram in self._grams(text):
+                    self._postings[gram].add(doc_id)
+
+    def remove(self, doc_id):
+        """文書を削除"""
+        with self._lock:
+            texts = self._docs.pop(doc_id, None)
+            if texts is None:
+                return
+            for field, text in texts.items():
+                self._field_lengths[field] -= len(text)
+                for gram in self._grams(text):
+                    postings = self._postings.get(gram)
+                    if postings is not None:
+                        postings.discard(doc_id)
+                        if not postings:
+                            del self._postings[gram]
+
+    def _match_term(self, term):
+        """語を含む文書と、フィールドごとの出現回数を返す"""
+        size = min(len(term), max(self.ngram_sizes))
+        grams = {term[i:i + size] for i in range(len(term) - size + 1)}
+        postings = sorted((self._postings.get(gram, set()) for gram in grams), key=len)
+        if not postings or not postings[0]:
+            return {}
+        candidates = set.intersection(*postings)
+
+        matches = {}
+        for doc_id in candidates:
+            counts = {field: text.count(term) for field, text in self._docs[doc_id].items()}
+            counts = {field: tf for field, tf in counts.items() if tf}
+            if counts:
+                matches[doc_id] = counts
+        return matches
+
+    def _score_term(self, matches):
+        """BM25（フィールド重み付き）で語のスコアを計算"""
+        total = len(self._docs)
+        idf = math.log(1 + (total - len(matches) + 0.5) / (len(matches) + 0.5))
+        scores = {}
+        for doc_id, counts in matches.items():
+            score = 0.0
+            for field, tf in counts.items():
+                average = (self._field_lengths[field] / total) or 1
+                length = len(self._docs[doc_id][field])
+                norm = tf * (self.K1 + 1) / (tf + self.K1 * (1 - self.B + self.B * length / average))
+                score += self.field_weights[field] * idf * norm
+            scores[doc_id] = score
+        return scores
+
+    def search(self, search_term):
+        """検索して (doc_id, スコア) をスコア順に返す"""
+        results = {}
+        with self._lock:
+            if not self._docs:
+                return []
+            for group in parse_search_query(search_term):
+                group_scores = None
+                for term in group:
+                    term_scores = self._score_term(self._match_term(term))
+                    if group_scores is None:
+                        group_scores = term_scores
+                    else:
+                        group_scores = {doc_id: score + term_scores[doc_id]
+                                        for doc_id, score in group_scores.items() if doc_id in term_scores}
+                    if not group_scores:
+                        break
+                for doc_id, score in (group_scores or {}).items():
+                    results[doc_id] = max(score, results.get(doc_id, 0.0))
+        return sorted(results.items(), key=lambda item: (-item[1], item[0]))
+
+@st.cache_resource
+def get_search_index():
+    """インメモリ検索インデックスを構築（プロセスごとに1回、以降は書き込み時に逐次更新）
+
+    接続できない場合は空のインデックスをキャッシュしないよう例外にする。
+    """
+    run_schema_migrations()
+    indexes = {}
+    with get_db_connection() as conn:
+        if not conn:
+            raise RuntimeError("PostgreSQL接続に失敗しました")
+        cursor = conn.cursor()
+        for table, weights in SEARCH_FIELD_WEIGHTS.items():
+            index = NgramIndex(weights)
+            fields = list(weights)
+            cursor.execute(f"SELECT id, {', '.join(fields)} FROM {table}")
+            for row in cursor.fetchall():
+                index.upsert(row[0], dict(zip(fields, row[1:])))
+            indexes[table] = index
+        cursor.close()
+    return indexes
+
+def get_search_backend():
+    """検索バックエンドを決定（secrets.toml の [search] backend = "auto" | "postgres" | "memory"）"""
+    configured = st.secrets.get("search", {}).get("backend", "auto")
+    if configured in ('postgres', 'memory'):
+        return configured
+    return 'postgres' if get_search_extension() else 'memory'
+
+def update_search_index(table, doc_id, fields=None):
+    """書き込み後にインメモリ検索インデックスを逐次更新（fields=None で削除）"""
+    if get_search_backend() != 'memory':
+        return
+    index = get_search_index()[table]
+    if fields is None:
+        index.remove(doc_id)
+    else:
+        index.upsert(doc_id, fields)
+
+def sync_search_index():
+    """他プロセスで変更された行をインメモリ検索インデックスに反映"""
+    pending = get_change_listener().drain()
+    if any(doc_id is None and table in SEARCH_FIELD_WEIGHTS for table, doc_id in pending):
+        get_search_index.clear()  # 一括変更は再構築
+        return
+    pending = [(table, doc_id) for table, doc_id in pending if table in SEARCH_FIELD_WEIGHTS]
+    if not pending:
+        return
+    with get_db_connection() as conn:
+        if not conn:
+            get_search_index.clear()  # 取り出した変更は次回の再構築で反映する
+            return
+        cursor = conn.cursor()
+        for table, doc_id in pending:
+            fields = list(SEARCH_FIELD_WEIGHTS[table])
+            cursor.execute(f"SELECT {', '.join(fields)} FROM {table} WHERE id = %s", (doc_id,))
+            row = cursor.fetchone()
+            update_search_index(table, doc_id, dict(zip(fields, row)) if row else None)
+        cursor.close()
+
+SEARCH_HITS_SQL = "SELECT {columns} FROM {table} WHERE id = ANY(%s::integer[])"
+
+def fetch_search_hits(table, columns, hits):
+    """インデックスの検索結果（ID, スコア）の行だけをDBから取得し、スコア順に並べる"""
+    with get_db_connection() as conn:
+        df = pd.read_sql_query(SEARCH_HITS_SQL.format(columns=columns, table=table), conn,
+                               params=[[doc_id for doc_id, _ in hits]])
+    scores = dict(hits)
+    df['score'] = df['id'].map(scores)
+    return df.sort_values('score', ascending=False, kind='stable').reset_index(drop=True)
+
+# キャッシュの無効化（テーブルごとの版数）
+class TableVersions:
+    """テーブルごとのデータ版数。書き込みのたびに単調増加し、キャッシュのキーに使う"""
+    
+    TABLES = ('sicks', 'forms', 'protocols', 'images', 'users')
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = defaultdict(int, {table: 0 for table in self.TABLES})
+    
+    def tables(self):
+        """版数を管理しているテーブル（キャッシュのキーに使われたテーブルを含む）"""
+        with self._lock:
+            return list(self._versions)
+    
+    def get(self, tables):
+        with self._lock:
+            return tuple(self._versions[table] for table in tables)
+    
+    def bump(self, tables):
+        with self._lock:
+            for table in tables:
+                self._versions[table] += 1
+
+@st.cache_resource
+def get_table_versions():
+    """プロセス内で共有する版数レジストリ"""
+    return TableVersions()
+
+def bump_table_versions(*tables):
+    """テーブルの版数を上げ、そのテーブルを読むキャッシュを無効にする"""
+    get_table_versions().bump(tables)
+
+# プロセス間のキャッシュ無効化（PostgreSQL の LISTEN/NOTIFY）
+CHANGE_CHANNEL = "ct_data_changes"
+
+class ChangeListener(threading.Thread):
+    """他プロセスの変更通知を LISTEN し、版数を上げて検索インデックスの反映待ちに積むスレッド
+
+    Streamlit のAPIはスクリプト実行スレッド以外から呼ばないため、版数レジストリは受け取って直接更新する。
+    反映待ちはPostgreSQL検索では取り出されないため、MAX_PENDING 件を超えたら再構築の印にまとめる。
+    """
+
+    MAX_PENDING = 1000
+
+    def __init__(self, connect_params, versions, reconnect_seconds=5):
+        super().__init__(name="ct-change-listener", daemon=True)
+        self.connect_params = dict(connect_params)
+        self.versions = versions
+        self.reconnect_seconds = reconnect_seconds
+        self.origin = f"{os.getpid()}-{os.urandom(4).hex()}"  # 自プロセスの通知を見分ける
+        self._pending = []  # (テーブル, ID) 検索インデックスへの反映待ち
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def run(self):
+        connected_before = False
+        while not self._stopped.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.connect_params)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {CHANGE_CHANNEL}")
+                # 切断中の通知は届かないため、再接続時は版数を管理している全テーブルを変更扱いにする
+                if connected_before:
+                    self._apply({'tables': self.versions.tables(), 'id': None})
+                connected_before = True
+                while not self._stopped.is_set():
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._dispatch(conn.notifies.pop(0).payload)
+            except Exception:
+                self._stopped.wait(self.reconnect_seconds)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+    def _dispatch(self, payload):
+        try:
+            change = json.loads(payload)
+        except ValueError:
+            return
+        if change.get('origin') != self.origin:
+            self._apply(change)
+
+    def _apply(self, change):
+        with self._lock:
+            self._pending.extend((table, change.get('id')) for table in change['tables'] if table in SEARCH_FIELD_WEIGHTS)
+            if len(self._pending) > self.MAX_PENDING:
+                # ID が None の変更は sync_search_index でインデックスの再構築になる
+                self._pending = [(table, None) for table in SEARCH_FIELD_WEIGHTS]
+        self.versions.bump(change['tables'])
+
+    def drain(self):
+        """反映待ちの変更を取り出す"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        return pending
+
+    def stop(self):
+        self._stopped.set()
+
+@st.cache_resource
+def get_change_listener():
+    """変更通知の LISTEN スレッドを開始（プロセスごとに1つ）"""
+    listener = ChangeListener(st.secrets["postgres"], get_table_versions())
+    listener.start()
+    return listener
+
+def notify_change(cursor, tables, doc_id=None):
+    """他プロセスへ変更を通知（NOTIFY はコミット時に配信されるため、書き込みと同じトランザクションで呼ぶ）"""
+    payload = json.dumps({'origin': get_change_listener().origin, 'tables': list(tables), 'id': doc_id})
+    cursor.execute("SELECT pg_notify(%s, %s)", (CHANGE_CHANNEL, payload))
+
+def versioned_cache(*tables, max_entries=128):
+    """tables の版数をキーに含めて st.cache_data でキャッシュするデコレーター
+
+    書き込みで版数が上がれば次の呼び出しで再取得されるため、TTLや個別の .clear() は不要。
+    古い版のエントリは max_entries で押し出される。
+    """
+    def decorator(func):
+        def cached_with_version(data_version, *args, **kwargs):
+            return func(*args, **kwargs)
+        # st.cache_data は関数名とソースでキャッシュを区別するため、元の関数名を引き継ぐ
+        cached_with_version.__qualname__ = func.__qualname__
+        cached_with_version.__name__ = func.__name__
+        cached = st.cache_data(max_entries=max_entries, show_spinner=False)(cached_with_version)
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return cached(get_table_versions().get(tables), *args, **kwargs)
+        wrapper.clear = cached.clear
+        return wrapper
+    return decorator
+
+# データベース操作関数（一覧・詳細のSQLは実行計画の検査 QUERY_PLAN_CHECKS と共有する）
+SICKS_PAGE_SQL = f"SELECT {SICK_SUMMARY_COLUMNS} FROM sicks {{seek}} ORDER BY diesease, id LIMIT %s"
+SICKS_PAGE_SEEK = "WHERE (diesease, id) > (%s, %s)"
+LATEST_FORMS_SQL = f"SELECT {FORM_SUMMARY_COLUMNS} FROM forms ORDER BY created_at DESC, id DESC LIMIT %s"
+FORMS_PAGE_SQL = f"SELECT {FORM_SUMMARY_COLUMNS} FROM forms {{seek}} ORDER BY created_at DESC, id DESC LIMIT %s"
+FORMS_PAGE_SEEK = "WHERE (created_at, id) < (%s, %s)"
+SICK_BY_ID_SQL = f"SELECT {SICK_COLUMNS} FROM sicks WHERE id = %s"
+FORM_BY_ID_SQL = f"SELECT {FORM_COLUMNS} FROM forms WHERE id = %s"
+PROTOCOL_BY_ID_SQL = f"SELECT {PROTOCOL_COLUMNS} FROM protocols WHERE id = %s"
+PROTOCOLS_BY_CATEGORY_SQL = f"SELECT {PROTOCOL_SUMMARY_COLUMNS} FROM protocols WHERE category = %s ORDER BY title"
+
+@versioned_cache('sicks')
+def get_sicks_page(after=None, limit=20):
+    """疾患一覧を1ページ分取得（疾患名・IDのキーセット）。(DataFrame, 次ページのカーソル) を返す"""
+    seek = SICKS_PAGE_SEEK if after else ""
+    with get_db_connection() as conn:
+        df = pd.read_sql_query(SICKS_PAGE_SQL.format(seek=seek), conn, params=[*(after or ()), limit + 1])
+    if len(df) <= limit:
+        return df, None
+    last = df.iloc[limit - 1]
+    return df.head(limit), (last['diesease'], int(last['id']))
+
+@versioned_cache('forms')
+def get_latest_forms(limit=7):
+    """ホーム用に最新のお知らせを limit 件だけ取得（forms(created_at DESC, id DESC) のインデックスを使用）"""
+    with get_db_connection() as conn:
+        df = pd.read_sql_query(LATEST_FORMS_SQL, conn, params=[limit])
+    return df
+
+@versioned_cache('forms')
+def get_forms_page(before=None, limit=20):
+    """お知らせ一覧を新しい順に1ページ分取得（作成日時・IDのキーセット）。(DataFrame, 次ページのカーソル) を返す"""
+    seek = FORMS_PAGE_SEEK if before else ""
+    with get_db_connection() as conn:
+        df = pd.read_sql_query(FORMS_PAGE_SQL.format(seek=seek), conn, params=[*(before or ()), limit + 1])
+    if len(df) <= limit:
+        return df, None
+    last = df.iloc[limit - 1]
+    return df.head(limit), (last['created_at'].to_pydatetime(), int(last['id']))
+
+def build_sick_search_query(groups):
+    """疾患検索のSQLとパラメーター（search_doc のGINインデックスで絞り込み、語ごとのフィールド別ヒットで加点する）"""
+    terms = [term for group in groups for term in group]
+    conditions = " OR ".join("(" + " AND ".join(["search_doc LIKE %s"] * len(group)) + ")" for group in groups)
+    score = " + ".join([f"""
+            CASE WHEN {search_fold_sql("diesease")} LIKE %s THEN 8 ELSE 0 END
+            + CASE WHEN {search_fold_sql("coalesce(keyword_plain, '')")} LIKE %s THEN 4 ELSE 0 END
+            + CASE WHEN {search_fold_sql("coalesce(protocol, '') || ' ' || coalesce(processing, '') || ' ' || coalesce(contrast, '')")} LIKE %s THEN 2 ELSE 0 END
+            + CASE WHEN search_doc LIKE %s THEN 1 ELSE 0 END"""] * len(terms))
+    query = f"""
+        SELECT {SICK_SUMMARY_COLUMNS}, ({score}) AS score
+        FROM sicks
+        WHERE {conditions}
+        ORDER BY score DESC, diesease
+    """
+    params = [to_like_pattern(term) for term in terms for _ in range(4)] + [to_like_pattern(term) for term in terms]
+    return query, params
+
+@versioned_cache('sicks')
+def search_sicks(search_term):
+    """疾患データを検索（疾患名 > キーワード > 本文の順で重み付け）"""
+    if get_search_backend() == 'memory':
+        sync_search_index()
+        return fetch_search_hits('sicks', SICK_SUMMARY_COLUMNS, get_search_index()['sicks'].search(search_term))
+
+    groups = parse_search_query(search_term)
+    if not groups:
+        return fetch_search_hits('sicks', SICK_SUMMARY_COLUMNS, [])
+
+    query, params = build_sick_search_query(groups)
+    with get_db_connection() as conn:
+        df = pd.read_sql_query(query, conn, params=params)
+    return df
+
+def get_sick_by_id(sick_id):
+    """IDで疾患データを取得"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SICK_BY_ID_SQL, (sick_id,))
+        sick = cursor.fetchone()
     return sick
 
 def get_form_by_id(form_id):
     """IDでお知らせを取得"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM forms WHERE id = %s", (form_id,))
-    form = cursor.fetchone()
-    conn.close()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(FORM_BY_ID_SQL, (form_id,))
+        form = cursor.fetchone()
     return form
 
 def add_sick(diesease, diesease_text, keyword, protocol, protocol_text, processing, processing_text, contrast, contrast_text, diesease_img=None, protocol_img=None, processing_img=None, contrast_img=None):
     """新しい疾患データを追加"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO sicks (diesease, diesease_text, keyword, protocol, protocol_text, processing, processing_text, contrast, contrast_text, diesease_img, protocol_img, processing_img, contrast_img)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-    ''', (diesease, diesease_text, keyword, protocol, protocol_text, processing, processing_text, contrast, contrast_text, diesease_img, protocol_img, processing_img, contrast_img))
-    conn.commit()
-    conn.close()
+    diesease_text, keyword, protocol_text, processing_text, contrast_text = (
+        normalize_rich_html(value) for value in (diesease_text, keyword, protocol_text, processing_text, contrast_text)
+    )
+    plain = plain_text_values('sicks', {
+        'keyword': keyword, 'diesease_text': diesease_text, 'protocol_text': protocol_text,
+        'processing_text': processing_text, 'contrast_text': contrast_text,
+    })
+    preview = preview_value('sicks', plain)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO sicks (diesease, diesease_text, keyword, protocol, protocol_text, processing, processing_text, contrast, contrast_text,
+                               keyword_plain, diesease_text_plain, protocol_text_plain, processing_text_plain, contrast_text_plain, preview)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING id
+        ''', (diesease, diesease_text, keyword, protocol, protocol_text, processing, processing_text, contrast, contrast_text, *plain.values(), preview))
+        sick_id = cursor.fetchone()[0]
+        save_images(cursor, 'sicks', sick_id, {
+            'diesease_img': diesease_img, 'protocol_img': protocol_img,
+            'processing_img': processing_img, 'contrast_img': contrast_img,
+        })
+        notify_change(cursor, ['sicks'], sick_id)
+        conn.commit()
+    update_search_index('sicks', sick_id, {
+        'diesease': diesease, 'protocol': protocol, 'processing': processing, 'contrast': contrast, **plain,
+    })
+    bump_table_versions('sicks')
+    return sick_id
 
 def add_form(title, main, post_img=None):
     """新しいお知らせを追加"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO forms (title, main, post_img) VALUES (%s, %s, %s)', (title, main, post_img))
-    conn.commit()
-    conn.close()
+    main = normalize_rich_html(main)
+    plain = plain_text_values('forms', {'main': main})
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('INSERT INTO forms (title, main, main_plain, preview) VALUES (%s, %s, %s, %s) RETURNING id',
+                       (title, main, plain['main_plain'], preview_value('forms', plain)))
+        form_id = cursor.fetchone()[0]
+        save_images(cursor, 'forms', form_id, {'post_img': post_img})
+        notify_change(cursor, ['forms'], form_id)
+        conn.commit()
+    bump_table_versions('forms')
 
 def update_sick(sick_id, diesease, diesease_text, keyword, protocol, protocol_text, processing, processing_text, contrast, contrast_text, diesease_img=None, protocol_img=None, processing_img=None, contrast_img=None):
     """疾患データを更新"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE sicks SET diesease=%s, diesease_text=%s, keyword=%s, protocol=%s, protocol_text=%s, 
-        processing=%s, processing_text=%s, contrast=%s, contrast_text=%s, diesease_img=%s, protocol_img=%s, processing_img=%s, contrast_img=%s, updated_at=CURRENT_TIMESTAMP
-        WHERE id=%s
-    ''', (diesease, diesease_text, keyword, protocol, protocol_text, processing, processing_text, contrast, contrast_text, diesease_img, protocol_img, processing_img, contrast_img, sick_id))
-    conn.commit()
-    conn.close()
+    diesease_text, keyword, protocol_text, processing_text, contrast_text = (
+        normalize_rich_html(value) for value in (diesease_text, keyword, protocol_text, processing_text, contrast_text)
+    )
+    plain = plain_text_values('sicks', {
+        'keyword': keyword, 'diesease_text': diesease_text, 'protocol_text': protocol_text,
+        'processing_text': processing_text, 'contrast_text': contrast_text,
+    })
+    preview = preview_value('sicks', plain)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE sicks SET diesease=%s, diesease_text=%s, keyword=%s, protocol=%s, protocol_text=%s, 
+            processing=%s, processing_text=%s, contrast=%s, contrast_text=%s,
+            keyword_plain=%s, diesease_text_plain=%s, protocol_text_plain=%s, processing_text_plain=%s, contrast_text_plain=%s,
+            preview=%s, updated_at=CURRENT_TIMESTAMP
+            WHERE id=%s
+        ''', (diesease, diesease_text, keyword, protocol, protocol_text, processing, processing_text, contrast, contrast_text, *plain.values(), preview, sick_id))
+        save_images(cursor, 'sicks', sick_id, {
+            'diesease_img': diesease_img, 'protocol_img': protocol_img,
+            'processing_img': processing_img, 'contrast_img': contrast_img,
+        })
+        notify_change(cursor, ['sicks'], sick_id)
+        conn.commit()
+    update_search_index('sicks', sick_id, {
+        'diesease': diesease, 'protocol': protocol, 'processing': processing, 'contrast': contrast, **plain,
+    })
+    bump_table_versions('sicks')
 
 def update_form(form_id, title, main, post_img=None):
     """お知らせを更新"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE forms SET title=%s, main=%s, post_img=%s, updated_at=CURRENT_TIMESTAMP WHERE id=%s', (title, main, post_img, form_id))
-    conn.commit()
-    conn.close()
+    main = normalize_rich_html(main)
+    plain = plain_text_values('forms', {'main': main})
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE forms SET title=%s, main=%s, main_plain=%s, preview=%s, updated_at=CURRENT_TIMESTAMP WHERE id=%s',
+                       (title, main, plain['main_plain'], preview_value('forms', plain), form_id))
+        save_images(cursor, 'forms', form_id, {'post_img': post_img})
+        notify_change(cursor, ['forms'], form_id)
+        conn.commit()
+    bump_table_versions('forms')
 
 def delete_form(form_id):
     """お知らせを削除"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM forms WHERE id = %s', (form_id,))
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM forms WHERE id = %s', (form_id,))
+        delete_images(cursor, 'forms', form_id)
+        notify_change(cursor, ['forms'], form_id)
+        conn.commit()
+    bump_table_versions('forms')
 
 def delete_sick(sick_id):
     """疾患データを削除"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM sicks WHERE id = %s', (sick_id,))
-    conn.commit()
-    conn.close()
-
-@st.cache_data(ttl=300)
-def get_all_protocols():
-    """全CTプロトコルを取得"""
-    conn = get_db_connection()
-    df = pd.read_sql_query("SELECT * FROM protocols ORDER BY category, title", conn)
-    conn.close()
-    return df
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM sicks WHERE id = %s', (sick_id,))
+        delete_images(cursor, 'sicks', sick_id)
+        notify_change(cursor, ['sicks'], sick_id)
+        conn.commit()
+    update_search_index('sicks', sick_id)
+    bump_table_versions('sicks')
+
+# CTプロトコルの標準カテゴリー（表示順。データにある他のカテゴリーはこの後ろに並ぶ）
+PROTOCOL_CATEGORIES = ["頭部", "頸部", "胸部", "腹部", "下肢", "上肢", "特殊"]
+
+@versioned_cache('protocols')
+def get_protocol_category_counts():
+    """カテゴリーごとのプロトコル件数を1回のGROUP BYクエリで取得"""
+    with get_db_connection() as conn:
+        if not conn:
+            return {}
+        cursor = conn.cursor()
+        cursor.execute("SELECT category, COUNT(*) FROM protocols GROUP BY category")
+        counts = dict(cursor.fetchall())
+        cursor.close()
+    return counts
+
+def get_protocol_categories(counts=None):
+    """標準カテゴリーとデータ上のカテゴリーを表示順に並べる"""
+    if counts is None:
+        counts = get_protocol_category_counts()
+    return PROTOCOL_CATEGORIES + sorted(category for category in counts if category not in PROTOCOL_CATEGORIES)
 
-@st.cache_data(ttl=300)
+@versioned_cache('protocols')
 def get_protocols_by_category(category):
-    """カテゴリー別CTプロトコルを取得"""
-    conn = get_db_connection()
-    df = pd.read_sql_query("SELECT * FROM protocols WHERE category = %s ORDER BY title", conn, params=[category])
-    conn.close()
+    """カテゴリー別CTプロトコルの一覧（サマリー）を取得"""
+    with get_db_connection() as conn:
+        df = pd.read_sql_query(PROTOCOLS_BY_CATEGORY_SQL, conn, params=[category])
     return df
 
-@st.cache_data(ttl=300)
-def search_protocols(search_term):
-    """CTプロトコルを検索"""
-    conn = get_db_connection()
-    query = """
-        SELECT * FROM protocols 
-        WHERE title LIKE %s OR content LIKE %s OR category LIKE %s
-        ORDER BY category, title
+def build_protocol_search_query(groups):
+    """CTプロトコル検索のSQLとパラメーター"""
+    terms = [term for group in groups for term in group]
+    conditions = " OR ".join("(" + " AND ".join(["search_doc LIKE %s"] * len(group)) + ")" for group in groups)
+    score = " + ".join([f"""
+            CASE WHEN {search_fold_sql("title")} LIKE %s THEN 8 ELSE 0 END
+            + CASE WHEN {search_fold_sql("category")} LIKE %s THEN 4 ELSE 0 END
+            + CASE WHEN search_doc LIKE %s THEN 1 ELSE 0 END"""] * len(terms))
+    query = f"""
+        SELECT {PROTOCOL_SUMMARY_COLUMNS}, ({score}) AS score
+        FROM protocols
+        WHERE {conditions}
+        ORDER BY score DESC, category, title
     """
-    search_pattern = f"%{search_term}%"
-    params = [search_pattern] * 3
-    df = pd.read_sql_query(query, conn, params=params)
-    conn.close()
+    params = [to_like_pattern(term) for term in terms for _ in range(3)] + [to_like_pattern(term) for term in terms]
+    return query, params
+
+@versioned_cache('protocols')
+def search_protocols(search_term):
+    """CTプロトコルを検索（タイトル > カテゴリー > 内容の順で重み付け）"""
+    if get_search_backend() == 'memory':
+        sync_search_index()
+        return fetch_search_hits('protocols', PROTOCOL_SUMMARY_COLUMNS, get_search_index()['protocols'].search(search_term))
+
+    groups = parse_search_query(search_term)
+    if not groups:
+        return fetch_search_hits('protocols', PROTOCOL_SUMMARY_COLUMNS, [])
+
+    query, params = build_protocol_search_query(groups)
+    with get_db_connection() as conn:
+        df = pd.read_sql_query(query, conn, params=params)
     return df
 
 def get_protocol_by_id(protocol_id):
     """IDでCTプロトコルを取得"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM protocols WHERE id = %s", (protocol_id,))
-    protocol = cursor.fetchone()
-    conn.close()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(PROTOCOL_BY_ID_SQL, (protocol_id,))
+        protocol = cursor.fetchone()
     return protocol
 
 def add_protocol(category, title, content, protocol_img=None):
     """新しいCTプロトコルを追加"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO protocols (category, title, content, protocol_img)
-        VALUES (%s, %s, %s, %s)
-    ''', (category, title, content, protocol_img))
-    conn.commit()
-    conn.close()
+    content = normalize_rich_html(content)
+    plain = plain_text_values('protocols', {'content': content})
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO protocols (category, title, content, content_plain, preview)
+            VALUES (%s, %s, %s, %s, %s)
+            RETURNING id
+        ''', (category, title, content, plain['content_plain'], preview_value('protocols', plain)))
+        protocol_id = cursor.fetchone()[0]
+        save_images(cursor, 'protocols', protocol_id, {'protocol_img': protocol_img})
+        notify_change(cursor, ['protocols'], protocol_id)
+        conn.commit()
+    update_search_index('protocols', protocol_id, {'category': category, 'title': title, **plain})
+    bump_table_versions('protocols')
+    return protocol_id
 
 def update_protocol(protocol_id, category, title, content, protocol_img=None):
     """CTプロトコルを更新"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE protocols SET category=%s, title=%s, content=%s, protocol_img=%s, updated_at=CURRENT_TIMESTAMP
-        WHERE id=%s
-    ''', (category, title, content, protocol_img, protocol_id))
-    conn.commit()
-    conn.close()
+    content = normalize_rich_html(content)
+    plain = plain_text_values('protocols', {'content': content})
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE protocols SET category=%s, title=%s, content=%s, content_plain=%s, preview=%s, updated_at=CURRENT_TIMESTAMP
+            WHERE id=%s
+        ''', (category, title, content, plain['content_plain'], preview_value('protocols', plain), protocol_id))
+        save_images(cursor, 'protocols', protocol_id, {'protocol_img': protocol_img})
+        notify_change(cursor, ['protocols'], protocol_id)
+        conn.commit()
+    update_search_index('protocols', protocol_id, {'category': category, 'title': title, **plain})
+    bump_table_versions('protocols')
 
 def delete_protocol(protocol_id):
     """CTプロトコルを削除"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM protocols WHERE id = %s', (protocol_id,))
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM protocols WHERE id = %s', (protocol_id,))
+        delete_images(cursor, 'protocols', protocol_id)
+        notify_change(cursor, ['protocols'], protocol_id)
+        conn.commit()
+    update_search_index('protocols', protocol_id)
+    bump_table_versions('protocols')
+
+# 実行計画を検査するクエリ（各読み取り関数と同じSQL定数・SQL生成関数から作る）
+QUERY_PLAN_CHECKS = [
+    ("疾患一覧", SICKS_PAGE_SQL.format(seek=""), (21,)),
+    ("疾患一覧（次ページ）", SICKS_PAGE_SQL.format(seek=SICKS_PAGE_SEEK), ('synthetic-5', 0, 21)),
+    ("疾患詳細", SICK_BY_ID_SQL, (1,)),
+    ("疾患検索", *build_sick_search_query(parse_search_query('synthetic-5'))),
+    ("ホームのお知らせ", LATEST_FORMS_SQL, (7,)),
+    ("お知らせ一覧（次ページ）", FORMS_PAGE_SQL.format(seek=FORMS_PAGE_SEEK), (datetime(2000, 1, 1), 0, 21)),
+    ("お知らせ詳細", FORM_BY_ID_SQL, (1,)),
+    ("カテゴリー別プロトコル", PROTOCOLS_BY_CATEGORY_SQL, ('synthetic-1',)),
+    ("プロトコル詳細", PROTOCOL_BY_ID_SQL, (1,)),
+    ("プロトコル検索", *build_protocol_search_query(parse_search_query('synthetic-5'))),
+    ("検索結果の取得", SEARCH_HITS_SQL.format(columns=SICK_SUMMARY_COLUMNS, table='sicks'), ([1, 2, 3],)),
+    ("画像の取得", IMAGE_VARIANT_SQL.format(variant='display'), ('0' * 64,)),
+    ("セッション復元", SESSION_LOAD_SQL, ('synthetic', SESSION_MAX_AGE_HOURS)),
+    ("期限切れセッション削除", SESSION_SWEEP_SQL, (SESSION_MAX_AGE_HOURS,)),
+    ("ログイン", LOGIN_SQL, ('synthetic@example.invalid', '')),
+]
+
+# 検査用の合成データ（検査後にロールバックする）
+SYNTHETIC_DATA_SQL = [
+    "INSERT INTO sicks (diesease, diesease_text) SELECT 'synthetic-' || g, '' FROM generate_series(1, %(rows)s) g",
+    "INSERT INTO forms (title, main, created_at) SELECT 'synthetic-' || g, '', NOW() - g * INTERVAL '1 minute' FROM generate_series(1, %(rows)s) g",
+    # 1カテゴリー50件（カテゴリー別一覧の1画面分）
+    "INSERT INTO protocols (category, title, content) SELECT 'synthetic-' || (g / 50), 'synthetic-' || g, '' FROM generate_series(1, %(rows)s) g",
+    "INSERT INTO images (owner_table, owner_id, slot, data, content_hash) SELECT 'forms', -g, 'post_img', '', md5(g::text) "
+    "FROM generate_series(1, %(rows)s) g",
+    "INSERT INTO browser_sessions (token, user_id, session_data, last_updated) SELECT 'synthetic-' || g, 0, '{}', NOW() - g * INTERVAL '1 second' "
+    "FROM generate_series(1, %(rows)s) g",
+    "INSERT INTO users (name, email, password) SELECT 'synthetic', 'synthetic-' || g || '@example.invalid', '' FROM generate_series(1, %(rows)s) g",
+]
+
+def plan_nodes(plan):
+    """EXPLAIN (FORMAT JSON) の実行計画ノードを列挙"""
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+def check_query_plans(rows=10000):
+    """各テーブルに rows 件の合成データを入れた状態で主要クエリの実行計画を調べる（データはロールバック）
+
+    [(クエリ名, インデックス使用の可否, 走査ノードの一覧), ...] を返す。接続できない場合は None を返す。
+    """
+    results = []
+    with get_db_connection() as conn:
+        if not conn:
+            return None
+        cursor = conn.cursor()
+        try:
+            params = {'rows': int(rows)}
+            for statement in SYNTHETIC_DATA_SQL:
+                cursor.execute(statement, params)
+            cursor.execute("ANALYZE sicks, forms, protocols, images, browser_sessions, users")
+            for label, query, query_params in QUERY_PLAN_CHECKS:
+                cursor.execute(f"EXPLAIN (FORMAT JSON) {query}", query_params)
+                plan = cursor.fetchone()[0][0]['Plan']
+                scans = [(node['Node Type'], node.get('Index Name') or node.get('Relation Name'))
+                         for node in plan_nodes(plan) if node['Node Type'].endswith('Scan')]
+                uses_index = bool(scans) and all(node_type != 'Seq Scan' for node_type, _ in scans)
+                results.append((label, uses_index, ", ".join(f"{node_type} ({name})" for node_type, name in scans)))
+        finally:
+            conn.rollback()
+            cursor.close()
+    return results
 
 def is_admin_user():
     """現在のユーザーが管理者かどうかチェック"""
@@ -871,18 +2464,17 @@ def validate_email(email):
 def get_all_users():
     """全ユーザー情報を取得（管理者用）- PostgreSQL版"""
     try:
-        conn = get_db_connection()
-        if not conn:
-            return pd.DataFrame()
+        with get_db_connection() as conn:
+            if not conn:
+                return pd.DataFrame()
         
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name, email, created_at FROM users ORDER BY created_at DESC")
-        users = cursor.fetchall()
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, name, email, created_at FROM users ORDER BY created_at DESC")
+            users = cursor.fetchall()
         
-        # DataFrameに変換
-        df = pd.DataFrame(users, columns=['id', 'name', 'email', 'created_at'])
+            # DataFrameに変換
+            df = pd.DataFrame(users, columns=['id', 'name', 'email', 'created_at'])
         
-        conn.close()
         return df
     except Exception as e:
         st.error(f"ユーザー取得エラー: {e}")
@@ -891,14 +2483,13 @@ def get_all_users():
 def delete_user(user_id):
     """ユーザーを削除（管理者用）- PostgreSQL版"""
     try:
-        conn = get_db_connection()
-        if not conn:
-            return False
+        with get_db_connection() as conn:
+            if not conn:
+                return False
         
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM users WHERE id = %s', (user_id,))
-        conn.commit()
-        conn.close()
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM users WHERE id = %s', (user_id,))
+            conn.commit()
         return True
     except Exception as e:
         st.error(f"ユーザー削除エラー: {e}")
@@ -907,17 +2498,16 @@ def delete_user(user_id):
 def admin_register_user(name, email, password):
     """管理者による新規ユーザー登録 - PostgreSQL版"""
     try:
-        conn = get_db_connection()
-        if not conn:
-            return False
-        
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO users (name, email, password) VALUES (%s, %s, %s)",
-            (name, email, hash_password(password))
-        )
-        conn.commit()
-        conn.close()
+        with get_db_connection() as conn:
+            if not conn:
+                return False
+        
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO users (name, email, password) VALUES (%s, %s, %s)",
+                (name, email, hash_password(password))
+            )
+            conn.commit()
         return True
     except Exception as e:
         st.error(f"ユーザー登録エラー: {e}")
@@ -953,6 +2543,9 @@ def show_login_page():
     """ログインページ（新規登録無効化版）"""
     st.markdown('<div class="main-header"><h1>How to CT - ログイン</h1></div>', unsafe_allow_html=True)
     
+    if 'logout_error' in st.session_state:
+        st.error(st.session_state.pop('logout_error'))
+    
     # 新規登録タブを削除
     tab1 = st.tabs(["ログイン"])
     
@@ -967,8 +2560,9 @@ def show_login_page():
                     user = authenticate_user(email, password)
                     if user:
                         st.session_state.user = {'id': user[0], 'name': user[1], 'email': user[2]}
+                        st.session_state.session_token = new_session_token()
                         st.session_state.page = "home"
-                        st.query_params['page'] = "home"
+                        set_page_query_params("home")
                         st.success(f"ログインしました - {user[1]}さん")
                         st.rerun()
                     else:
@@ -978,7 +2572,6 @@ def show_login_page():
 
 def show_home_page():
     """ホームページ"""
-    update_session_in_db()
     st.markdown('<div class="main-header"><h1>How to CT - CT検査マニュアル</h1></div>', unsafe_allow_html=True)
     
     if 'user' in st.session_state:
@@ -996,17 +2589,13 @@ def show_home_page():
         navigate_to_page("search")
     
     st.markdown('<h3 class="section-title">最新のお知らせ</h3>', unsafe_allow_html=True)
-    df_forms = get_all_forms()
-    if not df_forms.empty:
-        latest_notices = df_forms.head(7)
-        for idx, row in latest_notices.iterrows():
-            with st.expander(f"{row['title']}"):
-                preview_text = row['main'][:150] + "..." if len(str(row['main'])) > 150 else row['main']
-                display_rich_content(preview_text)
-                st.caption(f"投稿日: {row['created_at']}")
-                if st.button("詳細を見る", key=f"home_notice_preview_{row['id']}"):
-                    st.session_state.selected_notice_id = row['id']
-                    navigate_to_page("notice_detail")
+    latest_notices = get_latest_forms(7)
+    if not latest_notices.empty:
+        st.caption("行を選択すると詳細を表示します")
+        notice_id = select_from_list(latest_notices, NOTICE_LIST_COLUMNS, "home_notice_list")
+        if notice_id is not None:
+            st.session_state.selected_notice_id = notice_id
+            navigate_to_page("notice_detail")
     else:
         st.info("お知らせがありません")
 
@@ -1016,7 +2605,8 @@ def show_search_page():
     
     # 検索フォーム
     with st.form("search_form"):
-        search_term = st.text_input("検索キーワード", placeholder="例：胸痛、大動脈解離、造影CT、MPRなど")
+        search_term = st.text_input("検索キーワード", placeholder="例：胸痛、大動脈解離、造影CT、MPRなど",
+                                    help="スペース区切りは全ての語を含む（AND）、OR 区切りはいずれかを含む（OR）検索になります")
         submitted = st.form_submit_button("検索", use_container_width=True)
     
     # 新規作成・全疾患表示ボタン
@@ -1027,6 +2617,7 @@ def show_search_page():
     with col2:
         if st.button("全疾患一覧を表示", key="search_show_all"):
             st.session_state.show_all_diseases = True
+            reset_pager('all_diseases')
             # 検索結果をクリア
             if 'search_results' in st.session_state:
                 del st.session_state.search_results
@@ -1036,43 +2627,41 @@ def show_search_page():
     if submitted and search_term:
         df = search_sicks(search_term)
         st.session_state.search_results = df
+        reset_pager('search_results')
         # 全疾患表示フラグをクリア
         if 'show_all_diseases' in st.session_state:
             del st.session_state.show_all_diseases
         st.rerun()
     
+    show_search_results_panel()
+
+@st.fragment
+def show_search_results_panel():
+    """検索結果・全疾患一覧（ページ送りやクリアではこの部分だけ再実行する）"""
     # 検索結果表示
     if 'search_results' in st.session_state:
         df = st.session_state.search_results
         if not df.empty:
             st.success(f"{len(df)}件の検索結果が見つかりました")
             
-            for idx, row in df.iterrows():
-                st.markdown(f'<div class="search-result">', unsafe_allow_html=True)
-                col1, col2 = st.columns([3, 1])
-                
-                with col1:
-                    st.markdown(f"**{row['diesease']}**")
-                    if row['keyword']:
-                        st.markdown(f"**症状・キーワード:** {row['keyword']}")
-                    if row['protocol']:
-                        st.markdown(f"**撮影プロトコル:** {row['protocol']}")
-                    
-                    preview_text = row['diesease_text'][:150] + "..." if len(str(row['diesease_text'])) > 150 else row['diesease_text']
-                    display_rich_content(preview_text)
-                
-                with col2:
-                    if st.button("詳細を見る", key=f"search_detail_{row['id']}"):
-                        st.session_state.selected_sick_id = int(row['id'])
-                        navigate_to_page("detail")
-                
-                st.markdown('</div>', unsafe_allow_html=True)
+            # 検索結果は取得済みなので、表示する範囲だけ切り出す（カーソル = 先頭行の位置）
+            page_size = select_page_size('search_results')
+            start = get_page_cursor('search_results') or 0
+            page_df = df.iloc[start:start + page_size]
+            
+            st.caption("行を選択すると詳細を表示します")
+            sick_id = select_from_list(page_df, SICK_LIST_COLUMNS, "search_result_list")
+            if sick_id is not None:
+                st.session_state.selected_sick_id = sick_id
+                navigate_to_page("detail")
+            
+            render_pager('search_results', start + page_size if start + page_size < len(df) else None)
             
             # 検索結果をクリアするボタン
             if st.button("検索結果をクリア", key="clear_search_results"):
                 if 'search_results' in st.session_state:
                     del st.session_state.search_results
-                st.rerun()
+                rerun_fragment()
         else:
             st.info("該当する疾患が見つかりませんでした")
             
@@ -1080,38 +2669,29 @@ def show_search_page():
             if st.button("検索結果をクリア", key="clear_no_results"):
                 if 'search_results' in st.session_state:
                     del st.session_state.search_results
-                st.rerun()
+                rerun_fragment()
     
     # 全疾患表示
     elif st.session_state.get('show_all_diseases', False):
-        df = get_all_sicks()
+        page_size = select_page_size('all_diseases')
+        df, next_cursor = get_sicks_page(get_page_cursor('all_diseases'), page_size)
         if not df.empty:
             st.subheader("全疾患一覧")
             
-            for idx, row in df.iterrows():
-                st.markdown(f'<div class="search-result">', unsafe_allow_html=True)
-                col1, col2 = st.columns([3, 1])
-                
-                with col1:
-                    st.markdown(f"**{row['diesease']}**")
-                    if row['keyword']:
-                        st.markdown(f"**キーワード:** {row['keyword']}")
-                    if row['protocol']:
-                        st.markdown(f"**プロトコル:** {row['protocol']}")
-                
-                with col2:
-                    if st.button("詳細を見る", key=f"all_detail_{row['id']}"):
-                        st.session_state.selected_sick_id = int(row['id'])
-                        if 'show_all_diseases' in st.session_state:
-                            del st.session_state.show_all_diseases
-                        navigate_to_page("detail")
-                
-                st.markdown('</div>', unsafe_allow_html=True)
+            st.caption("行を選択すると詳細を表示します")
+            sick_id = select_from_list(df, SICK_LIST_COLUMNS, "all_disease_list")
+            if sick_id is not None:
+                st.session_state.selected_sick_id = sick_id
+                if 'show_all_diseases' in st.session_state:
+                    del st.session_state.show_all_diseases
+                navigate_to_page("detail")
+            
+            render_pager('all_diseases', next_cursor)
         
         if st.button("一覧を閉じる", key="close_all_list"):
             if 'show_all_diseases' in st.session_state:
                 del st.session_state.show_all_diseases
-            st.rerun()
+            rerun_fragment()
 
 def show_detail_page():
     """疾患詳細ページ（最終完成版）"""
@@ -1154,18 +2734,14 @@ def show_detail_page():
     if 'selected_sick_id' not in st.session_state:
         st.error("疾患が選択されていません")
         if st.button("検索に戻る", key="detail_back_no_selection"):
-            st.session_state.page = "search"
-            st.rerun()
+            navigate_to_page("search")
         return
     
     sick_data = get_sick_by_id(st.session_state.selected_sick_id)
     if not sick_data:
         st.error("疾患データが見つかりません")
         if st.button("検索に戻る", key="detail_back_not_found"):
-            st.session_state.page = "search"
-            if 'selected_sick_id' in st.session_state:
-                del st.session_state.selected_sick_id
-            st.rerun()
+            navigate_to_page("search")
         return
     
     st.title(f"{sick_data[1]}")
@@ -1246,21 +2822,22 @@ def show_detail_page():
         
         st.markdown('</div>', unsafe_allow_html=True)
     
-    # 編集・削除・戻るボタン
+    show_detail_actions(sick_data[0])
+
+@st.fragment
+def show_detail_actions(sick_id):
+    """疾患詳細の編集・削除・戻るボタン（削除確認などの操作ではこの部分だけ再実行する）"""
     col1, col2, col3 = st.columns(3)
     
     with col1:
         if st.button("編集", key="detail_edit_disease", use_container_width=True):
-            st.session_state.edit_sick_id = sick_data[0]
+            st.session_state.edit_sick_id = sick_id
             navigate_to_page("edit_disease")
     
     with col2:
         if st.button("削除", key="detail_delete_disease", use_container_width=True):
             if st.session_state.get('confirm_delete', False):
-                delete_sick(sick_data[0])
-                # キャッシュクリア追加
-                get_all_sicks.clear()
-                search_sicks.clear()
+                delete_sick(sick_id)
                 st.success("疾患データを削除しました")
                 if 'confirm_delete' in st.session_state:
                     del st.session_state.confirm_delete
@@ -1290,25 +2867,21 @@ def show_notices_page():
         if st.button("新規お知らせ作成", key="notices_create_notice"):
             navigate_to_page("create_notice")
     
-    df = get_all_forms()
-    if not df.empty:
-        for idx, row in df.iterrows():
-            st.markdown('<div class="notice-card">', unsafe_allow_html=True)
-            col1, col2 = st.columns([4, 1])
-            
-            with col1:
-                st.markdown(f"### {row['title']}")
-                # リッチテキストのプレビュー表示
-                preview_text = row['main'][:200] + "..." if len(str(row['main'])) > 200 else row['main']
-                display_rich_content(preview_text)
-                st.caption(f"作成日: {row['created_at']}")
-            
-            with col2:
-                if st.button("詳細", key=f"notices_detail_{row['id']}"):
-                    st.session_state.selected_notice_id = row['id']
-                    navigate_to_page("notice_detail")
+    show_notice_list_panel()
 
-            st.markdown('</div>', unsafe_allow_html=True)
+@st.fragment
+def show_notice_list_panel():
+    """お知らせ一覧（ページ送りではこの部分だけ再実行する）"""
+    page_size = select_page_size('notices')
+    df, next_cursor = get_forms_page(get_page_cursor('notices'), page_size)
+    if not df.empty:
+        st.caption("行を選択すると詳細を表示します")
+        notice_id = select_from_list(df, NOTICE_LIST_COLUMNS, "notice_list")
+        if notice_id is not None:
+            st.session_state.selected_notice_id = notice_id
+            navigate_to_page("notice_detail")
+        
+        render_pager('notices', next_cursor)
     else:
         st.info("お知らせがありません")
 
@@ -1324,10 +2897,7 @@ def show_notice_detail_page():
     if not form_data:
         st.error("お知らせが見つかりません")
         if st.button("お知らせ一覧に戻る", key="notice_detail_back_not_found"):
-            st.session_state.page = "notices"
-            if 'selected_notice_id' in st.session_state:
-                del st.session_state.selected_notice_id
-            st.rerun()
+            navigate_to_page("notices")
         return
     
     st.title(f"{form_data[1]}")
@@ -1344,16 +2914,18 @@ def show_notice_detail_page():
     st.caption(f"更新日: {form_data[5]}")
     st.markdown('</div>', unsafe_allow_html=True)
     
-    # 編集・削除・戻るボタン（本文下、縦並び）
+    show_notice_detail_actions(form_data[0])
+
+@st.fragment
+def show_notice_detail_actions(notice_id):
+    """お知らせ詳細の編集・削除・戻るボタン（本文下、縦並び。削除確認などの操作ではこの部分だけ再実行する）"""
     if st.button("編集", key="notice_detail_edit_notice"):
-        st.session_state.edit_notice_id = form_data[0]
+        st.session_state.edit_notice_id = notice_id
         navigate_to_page("edit_notice")
     
     if st.button("削除", key="notice_detail_delete_notice"):
         if st.session_state.get('confirm_delete_notice', False):
-            delete_form(form_data[0])
-            # キャッシュをクリアして最新データを取得
-            get_all_forms.clear()
+            delete_form(notice_id)
             st.success("お知らせを削除しました")
             if 'confirm_delete_notice' in st.session_state:
                 del st.session_state.confirm_delete_notice
@@ -1371,6 +2943,7 @@ def show_notice_detail_page():
         if 'selected_notice_id' in st.session_state:
             del st.session_state.selected_notice_id
         navigate_to_page("notices")
+
 def show_create_notice_page():
    """お知らせ作成ページ"""
    st.markdown('<div class="main-header"><h1>新規お知らせ作成</h1></div>', unsafe_allow_html=True)
@@ -1399,16 +2972,15 @@ def show_create_notice_page():
        if submitted:
            if title and main:
                try:
-                   # 画像をBase64に変換
-                   notice_img_b64 = None
+                   # 画像を保存用に変換
+                   notice_img_data = None
                    if notice_image is not None:
-                       notice_img_b64, error_msg = validate_and_process_image(notice_image)
-                       if notice_img_b64 is None:
+                       notice_img_data, error_msg = validate_and_process_image(notice_image)
+                       if notice_img_data is None:
                            st.error(f"お知らせ画像: {error_msg}")
                            return
                    
-                   add_form(title, main, notice_img_b64)
-                   get_all_forms.clear()
+                   add_form(title, main, notice_img_data)
                    st.success("お知らせを登録しました")
                    navigate_to_page("notices")
                    
@@ -1478,17 +3050,16 @@ def show_edit_notice_page():
             if title and main:
                 try:
                     # 画像処理（既存画像を保持するか新しい画像に更新するか）
-                    notice_img_b64 = form_data[3]  # 既存画像
+                    notice_img_data = None  # 既存画像を維持
                     
                     # 新しい画像がアップロードされた場合のみ更新
                     if notice_image is not None:
-                        notice_img_b64, error_msg = validate_and_process_image(notice_image)
-                        if notice_img_b64 is None:
+                        notice_img_data, error_msg = validate_and_process_image(notice_image)
+                        if notice_img_data is None:
                             st.error(f"お知らせ画像: {error_msg}")
                             return
                     
-                    update_form(st.session_state.edit_notice_id, title, main, notice_img_b64)
-                    get_all_forms.clear()
+                    update_form(st.session_state.edit_notice_id, title, main, notice_img_data)
                     st.success("お知らせを更新しました")
                     st.session_state.selected_notice_id = st.session_state.edit_notice_id
                     del st.session_state.edit_notice_id
@@ -1525,10 +3096,10 @@ def show_create_disease_page():
         keyword = st.text_input("症状・キーワード", placeholder="例：胸痛、背部痛、急性")
         disease_image = st.file_uploader("疾患関連画像をアップロード", type=['png', 'jpg', 'jpeg'], key="create_disease_img_upload",
                                         help="対応形式: PNG, JPEG, JPG（最大5MB）")
-        disease_img_b64 = None
+        disease_img_data = None
         if disease_image:
-            disease_img_b64, error_msg = validate_and_process_image(disease_image)
-            if disease_img_b64 is None:
+            disease_img_data, error_msg = validate_and_process_image(disease_image)
+            if disease_img_data is None:
                 st.error(f"疾患画像: {error_msg}")
             else:
                 st.image(disease_image, caption="疾患関連画像プレビュー", width=300)
@@ -1549,10 +3120,10 @@ def show_create_disease_page():
         
         protocol_image = st.file_uploader("撮影プロトコル画像をアップロード", type=['png', 'jpg', 'jpeg'], key="create_protocol_img_upload",
                                         help="対応形式: PNG, JPEG, JPG（最大5MB）")
-        protocol_img_b64 = None
+        protocol_img_data = None
         if protocol_image:
-            protocol_img_b64, error_msg = validate_and_process_image(protocol_image)
-            if protocol_img_b64 is None:
+            protocol_img_data, error_msg = validate_and_process_image(protocol_image)
+            if protocol_img_data is None:
                 st.error(f"撮影プロトコル画像: {error_msg}")
             else:
                 st.image(protocol_image, caption="撮影プロトコル画像プレビュー", width=300)
@@ -1573,10 +3144,10 @@ def show_create_disease_page():
         
         contrast_image = st.file_uploader("造影プロトコル画像をアップロード", type=['png', 'jpg', 'jpeg'], key="create_contrast_img_upload",
                                         help="対応形式: PNG, JPEG, JPG（最大5MB）")
-        contrast_img_b64 = None
+        contrast_img_data = None
         if contrast_image:
-            contrast_img_b64, error_msg = validate_and_process_image(contrast_image)
-            if contrast_img_b64 is None:
+            contrast_img_data, error_msg = validate_and_process_image(contrast_image)
+            if contrast_img_data is None:
                 st.error(f"造影プロトコル画像: {error_msg}")
             else:
                 st.image(contrast_image, caption="造影プロトコル画像プレビュー", width=300)
@@ -1597,10 +3168,10 @@ def show_create_disease_page():
         
         processing_image = st.file_uploader("画像処理画像をアップロード", type=['png', 'jpg', 'jpeg'], key="create_processing_img_upload",
                                           help="対応形式: PNG, JPEG, JPG（最大5MB）")
-        processing_img_b64 = None
+        processing_img_data = None
         if processing_image:
-            processing_img_b64, error_msg = validate_and_process_image(processing_image)
-            if processing_img_b64 is None:
+            processing_img_data, error_msg = validate_and_process_image(processing_image)
+            if processing_img_data is None:
                 st.error(f"画像処理画像: {error_msg}")
             else:
                 st.image(processing_image, caption="画像処理画像プレビュー", width=300)
@@ -1624,14 +3195,10 @@ def show_create_disease_page():
                     protocol or "", protocol_text or "",
                     processing or "", processing_text or "",
                     contrast or "", contrast_text or "",
-                    disease_img_b64, protocol_img_b64,
-                    processing_img_b64, contrast_img_b64
+                    disease_img_data, protocol_img_data,
+                    processing_img_data, contrast_img_data
                 )
                 
-                # キャッシュクリア追加
-                get_all_sicks.clear()
-                search_sicks.clear()
-                
                 # 作成成功フラグを設定
                 st.session_state.disease_created = True
                 st.session_state.created_disease_name = disease_name
@@ -1681,12 +3248,11 @@ def show_create_disease_page():
             if st.button("👁️ 作成した疾患を確認", key="create_success_view_created", use_container_width=True):
                 # 作成した疾患の詳細ページに移動
                 # 最新の疾患データを取得
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute("SELECT id FROM sicks WHERE diesease = %s ORDER BY created_at DESC LIMIT 1", 
-                              (st.session_state.get('created_disease_name', ''),))
-                result = cursor.fetchone()
-                conn.close()
+                with get_db_connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT id FROM sicks WHERE diesease = %s ORDER BY created_at DESC LIMIT 1", 
+                                  (st.session_state.get('created_disease_name', ''),))
+                    result = cursor.fetchone()
                 
                 if result:
                     st.session_state.selected_sick_id = result[0]
@@ -1863,33 +3429,33 @@ def show_edit_disease_page():
        else:
            try:
                # 画像処理（既存画像を保持するか新しい画像に更新するか）
-               disease_img_b64 = sick_data[10]  # 既存画像
-               protocol_img_b64 = sick_data[11]
-               processing_img_b64 = sick_data[12]
-               contrast_img_b64 = sick_data[13]
+               disease_img_data = None  # None のスロットは既存画像を維持
+               protocol_img_data = None
+               processing_img_data = None
+               contrast_img_data = None
                
                # 新しい画像がアップロードされた場合のみ更新
                if disease_image is not None:
-                   disease_img_b64, error_msg = validate_and_process_image(disease_image)
-                   if disease_img_b64 is None:
+                   disease_img_data, error_msg = validate_and_process_image(disease_image)
+                   if disease_img_data is None:
                        st.error(f"疾患画像: {error_msg}")
                        return
                
                if protocol_image is not None:
-                   protocol_img_b64, error_msg = validate_and_process_image(protocol_image)
-                   if protocol_img_b64 is None:
+                   protocol_img_data, error_msg = validate_and_process_image(protocol_image)
+                   if protocol_img_data is None:
                        st.error(f"撮影プロトコル画像: {error_msg}")
                        return
                
                if contrast_image is not None:
-                   contrast_img_b64, error_msg = validate_and_process_image(contrast_image)
-                   if contrast_img_b64 is None:
+                   contrast_img_data, error_msg = validate_and_process_image(contrast_image)
+                   if contrast_img_data is None:
                        st.error(f"造影プロトコル画像: {error_msg}")
                        return
                
                if processing_image is not None:
-                   processing_img_b64, error_msg = validate_and_process_image(processing_image)
-                   if processing_img_b64 is None:
+                   processing_img_data, error_msg = validate_and_process_image(processing_image)
+                   if processing_img_data is None:
                        st.error(f"画像処理画像: {error_msg}")
                        return
                
@@ -1899,14 +3465,10 @@ def show_edit_disease_page():
                    protocol, protocol_text,
                    processing, processing_text,
                    contrast, contrast_text,
-                   disease_img_b64, protocol_img_b64,
-                   processing_img_b64, contrast_img_b64
+                   disease_img_data, protocol_img_data,
+                   processing_img_data, contrast_img_data
                )
                
-               # キャッシュクリア
-               get_all_sicks.clear()
-               search_sicks.clear()
-               
                st.success("疾患データを更新しました")
                st.session_state.selected_sick_id = st.session_state.edit_sick_id
                del st.session_state.edit_sick_id
@@ -1924,9 +3486,6 @@ def show_protocols_page():
     """CTプロトコル一覧ページ"""
     st.markdown('<div class="main-header"><h1>📋 CTプロトコル管理</h1></div>', unsafe_allow_html=True)
     
-    # カテゴリー定義
-    categories = ["頭部", "頸部", "胸部", "腹部", "下肢", "上肢", "特殊"]
-    
     # 新規作成・検索ボタン
     col1, col2 = st.columns(2)
     with col1:
@@ -1935,7 +3494,8 @@ def show_protocols_page():
     with col2:
         # 検索フォーム
         with st.form("protocol_search_form"):
-            search_term = st.text_input("プロトコル検索", placeholder="タイトル、内容、カテゴリーで検索")
+            search_term = st.text_input("プロトコル検索", placeholder="タイトル、内容、カテゴリーで検索",
+                                        help="スペース区切りは全ての語を含む（AND）、OR 区切りはいずれかを含む（OR）検索になります")
             search_submitted = st.form_submit_button("🔍 検索")
     
     # 検索結果表示
@@ -1944,69 +3504,53 @@ def show_protocols_page():
         st.session_state.protocol_search_results = df
         st.rerun()
     
+    show_protocol_list_panel()
+
+@st.fragment
+def show_protocol_list_panel():
+    """プロトコル検索結果・カテゴリー別一覧（カテゴリー切り替えやクリアではこの部分だけ再実行する）"""
     if 'protocol_search_results' in st.session_state:
         df = st.session_state.protocol_search_results
         if not df.empty:
             st.success(f"{len(df)}件の検索結果が見つかりました")
             
-            for idx, row in df.iterrows():
-                st.markdown(f'<div class="search-result">', unsafe_allow_html=True)
-                col1, col2 = st.columns([3, 1])
-                
-                with col1:
-                    st.markdown(f"**[{row['category']}] {row['title']}**")
-                    preview_text = row['content'][:150] + "..." if len(str(row['content'])) > 150 else row['content']
-                    display_rich_content(preview_text)
-                    st.caption(f"更新日: {row['updated_at']}")
-                
-                with col2:
-                    if st.button("詳細", key=f"search_protocol_detail_{row['id']}"):
-                        st.session_state.selected_protocol_id = int(row['id'])
-                        navigate_to_page("protocol_detail")
-                
-                st.markdown('</div>', unsafe_allow_html=True)
+            st.caption("行を選択すると詳細を表示します")
+            protocol_id = select_from_list(df, PROTOCOL_LIST_COLUMNS, "protocol_search_list")
+            if protocol_id is not None:
+                st.session_state.selected_protocol_id = protocol_id
+                navigate_to_page("protocol_detail")
             
             if st.button("検索結果をクリア", key="clear_protocol_search"):
                 if 'protocol_search_results' in st.session_state:
                     del st.session_state.protocol_search_results
-                st.rerun()
+                rerun_fragment()
         else:
             st.info("該当するプロトコルが見つかりませんでした")
             if st.button("検索結果をクリア", key="clear_no_protocol_results"):
                 if 'protocol_search_results' in st.session_state:
                     del st.session_state.protocol_search_results
-                st.rerun()
+                rerun_fragment()
         return
     
-    # カテゴリータブ表示
-    tabs = st.tabs(categories)
+    # カテゴリー選択（件数はGROUP BYの1クエリ。st.tabs は全タブを描画するため、選択中のカテゴリーだけ取得する）
+    counts = get_protocol_category_counts()
+    category = st.radio("カテゴリー", get_protocol_categories(counts), horizontal=True, key="protocol_category",
+                        format_func=lambda name: f"{name} ({counts.get(name, 0)})", label_visibility="collapsed")
     
-    for i, category in enumerate(categories):
-        with tabs[i]:
-            df = get_protocols_by_category(category)
-            
-            if not df.empty:
-                for idx, row in df.iterrows():
-                    st.markdown('<div class="protocol-section">', unsafe_allow_html=True)
-                    col1, col2 = st.columns([4, 1])
-                    
-                    with col1:
-                        st.markdown(f"### {row['title']}")
-                        preview_text = row['content'][:200] + "..." if len(str(row['content'])) > 200 else row['content']
-                        display_rich_content(preview_text)
-                        st.caption(f"作成日: {row['created_at']} | 更新日: {row['updated_at']}")
-                    
-                    with col2:
-                        if st.button("詳細", key=f"protocol_detail_{row['id']}"):
-                            st.session_state.selected_protocol_id = int(row['id'])  # ←int()を追加
-                            navigate_to_page("protocol_detail")
-                    
-                    st.markdown('</div>', unsafe_allow_html=True)
-            else:
-                st.info(f"{category}のプロトコルはまだ登録されていません")
-                if st.button(f"{category}のプロトコルを作成", key=f"create_{category}_protocol"):
-                    st.session_state.default_category = category
-                    navigate_to_page("create_protocol")
+    df = get_protocols_by_category(category)
+    
+    if not df.empty:
+        st.caption("行を選択すると詳細を表示します")
+        columns = {name: config for name, config in PROTOCOL_LIST_COLUMNS.items() if name != 'category'}
+        protocol_id = select_from_list(df, columns, "protocol_category_list")
+        if protocol_id is not None:
+            st.session_state.selected_protocol_id = protocol_id
+            navigate_to_page("protocol_detail")
+    else:
+        st.info(f"{category}のプロトコルはまだ登録されていません")
+        if st.button(f"{category}のプロトコルを作成", key=f"create_{category}_protocol"):
+            st.session_state.default_category = category
+            navigate_to_page("create_protocol")
 
 def show_protocol_detail_page():
     """CTプロトコル詳細ページ"""
@@ -2056,18 +3600,18 @@ def show_protocol_detail_page():
     
     st.markdown('</div>', unsafe_allow_html=True)
     
-    # 編集・削除・戻るボタン
+    show_protocol_detail_actions(protocol_data[0])
+
+@st.fragment
+def show_protocol_detail_actions(protocol_id):
+    """CTプロトコル詳細の編集・削除・戻るボタン（削除確認などの操作ではこの部分だけ再実行する）"""
     if st.button("編集", key="protocol_detail_edit"):
-        st.session_state.edit_protocol_id = protocol_data[0]
+        st.session_state.edit_protocol_id = protocol_id
         navigate_to_page("edit_protocol")
     
     if st.button("削除", key="protocol_detail_delete"):
         if st.session_state.get('confirm_delete_protocol', False):
-            delete_protocol(protocol_data[0])
-            # 全てのプロトコル関連キャッシュをクリア
-            get_all_protocols.clear()
-            get_protocols_by_category.clear()
-            search_protocols.clear()
+            delete_protocol(protocol_id)
             st.success("プロトコルを削除しました")
             if 'confirm_delete_protocol' in st.session_state:
                 del st.session_state.confirm_delete_protocol
@@ -2090,7 +3634,7 @@ def show_create_protocol_page():
     st.markdown('<div class="main-header"><h1>新規CTプロトコル作成</h1></div>', unsafe_allow_html=True)
     
     # カテゴリー定義
-    categories = ["頭部", "頸部", "胸部", "腹部", "下肢", "上肢", "特殊"]
+    categories = get_protocol_categories()
     
     with st.form("create_protocol_form"):
         # カテゴリー選択
@@ -2139,16 +3683,15 @@ def show_create_protocol_page():
             st.error("タイトルとプロトコル内容は必須項目です")
         else:
             try:
-                # 画像をBase64に変換
-                protocol_img_b64 = None
+                # 画像を保存用に変換
+                protocol_img_data = None
                 if protocol_image is not None:
-                    protocol_img_b64, error_msg = validate_and_process_image(protocol_image)
-                    if protocol_img_b64 is None:
+                    protocol_img_data, error_msg = validate_and_process_image(protocol_image)
+                    if protocol_img_data is None:
                         st.error(f"プロトコル画像: {error_msg}")
                         return
                 
-                add_protocol(category, title, content, protocol_img_b64)
-                get_all_protocols.clear()  # キャッシュクリア
+                add_protocol(category, title, content, protocol_img_data)
                 
                 # 作成成功フラグを設定
                 st.session_state.protocol_created = True
@@ -2158,6 +3701,8 @@ def show_create_protocol_page():
                     del st.session_state.default_category
                 st.rerun()
                 
+            except psycopg2.errors.UniqueViolation:
+                st.error("同じカテゴリに同名のプロトコルがあります")
             except Exception as e:
                 st.error(f"データ作成中にエラーが発生しました: {str(e)}")
     
@@ -2203,12 +3748,11 @@ def show_create_protocol_page():
         with col3:
             if st.button("👁️ 作成したプロトコルを確認", key="create_protocol_success_view", use_container_width=True):
                 # 作成したプロトコル詳細ページに移動
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute("SELECT id FROM protocols WHERE title = %s AND category = %s ORDER BY created_at DESC LIMIT 1", 
-                              (st.session_state.get('created_protocol_title', ''), st.session_state.get('created_protocol_category', '')))
-                result = cursor.fetchone()
-                conn.close()
+                with get_db_connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT id FROM protocols WHERE title = %s AND category = %s ORDER BY created_at DESC LIMIT 1", 
+                                  (st.session_state.get('created_protocol_title', ''), st.session_state.get('created_protocol_category', '')))
+                    result = cursor.fetchone()
                 
                 if result:
                     st.session_state.selected_protocol_id = result[0]
@@ -2248,7 +3792,7 @@ def show_edit_protocol_page():
     st.markdown('<div class="main-header"><h1>CTプロトコル編集</h1></div>', unsafe_allow_html=True)
     
     # カテゴリー定義
-    categories = ["頭部", "頸部", "胸部", "腹部", "下肢", "上肢", "特殊"]
+    categories = get_protocol_categories()
     
     with st.form("edit_protocol_form"):
         # カテゴリー選択
@@ -2300,22 +3844,23 @@ def show_edit_protocol_page():
             if title and content:
                 try:
                     # 画像処理（既存画像を保持するか新しい画像に更新するか）
-                    protocol_img_b64 = protocol_data[4]  # 既存画像
+                    protocol_img_data = None  # 既存画像を維持
                     
                     # 新しい画像がアップロードされた場合のみ更新
                     if protocol_image is not None:
-                        protocol_img_b64, error_msg = validate_and_process_image(protocol_image)
-                        if protocol_img_b64 is None:
+                        protocol_img_data, error_msg = validate_and_process_image(protocol_image)
+                        if protocol_img_data is None:
                             st.error(f"プロトコル画像: {error_msg}")
                             return
                     
-                    update_protocol(st.session_state.edit_protocol_id, category, title, content, protocol_img_b64)
-                    get_all_protocols.clear()  # キャッシュクリア
+                    update_protocol(st.session_state.edit_protocol_id, category, title, content, protocol_img_data)
                     st.success("プロトコルを更新しました")
                     st.session_state.selected_protocol_id = st.session_state.edit_protocol_id
                     del st.session_state.edit_protocol_id
                     navigate_to_page("protocol_detail")
                     
+                except psycopg2.errors.UniqueViolation:
+                    st.error("同じカテゴリに同名のプロトコルがあります")
                 except Exception as e:
                     st.error(f"データの保存中にエラーが発生しました: {str(e)}")
             else:
@@ -2367,29 +3912,7 @@ def show_sidebar():
             st.markdown("---")
             
             if st.button("🚪 ログアウト", use_container_width=True, key="sidebar_logout"):
-    # ログアウト時にセッション情報をクリア
-                if 'user' in st.session_state:
-                    user_id = st.session_state.user['id']
-                    try:
-                        conn = get_db_connection()
-                        cursor = conn.cursor()
-                        cursor.execute('DELETE FROM user_sessions WHERE user_id = %s', (user_id,))
-                        conn.commit()
-                        cursor.close()
-                        conn.close()
-                    except:
-                        pass
-                
-                # 全てのセッション状態をクリア
-                for key in list(st.session_state.keys()):
-                    if key != 'db_initialized':  # DB初期化状態は保持
-                        del st.session_state[key]
-                
-                # ログインページに遷移
-                st.session_state.page = "login"
-                st.query_params.clear()             
-                st.query_params['page'] = "login"
-                st.rerun()
+                logout()
 
             # 管理者メニュー（管理者のみ表示）
             if is_admin_user():
@@ -2413,439 +3936,567 @@ def show_sidebar():
             st.markdown("でインストールしてください")
 
 
-def export_all_data():
-    """全データをJSONでエクスポート（PostgreSQL版）"""
+# バックアップZIP（ver 3.0）: テーブルごとのNDJSONと、内容ハッシュをファイル名にした画像ファイル
+# 増分バックアップは前回のウォーターマーク以降に更新された行と、削除記録（deleted.ndjson）だけを含む
+BACKUP_FORMAT_VERSION = '3.0'
+BACKUP_BATCH_SIZE = 200  # サーバーサイドカーソルから一度に取得する行数
+BACKUP_WATERMARK_OVERLAP_SECONDS = 60  # ウォーターマーク直前にコミットされた書き込みも拾うための重なり（復元はupsertなので重複しても問題ない）
+BACKUP_TEMP_PREFIX = 'ct_system_backup_'  # ダウンロード待ちのZIPを置く一時ファイルの接頭辞
+BACKUP_TEMP_MAX_AGE_HOURS = 24  # ダウンロード待ちのZIPを残しておく時間
+BACKUP_RETAINED_FULL = 3  # 増分の基準として削除記録を残す完全バックアップの数（それより前の change_log は消す）
+BACKUP_TABLES = {
+    'sicks': (SICK_COLUMNS, SICK_COLUMN_NAMES),
+    'forms': (FORM_COLUMNS, FORM_COLUMN_NAMES),
+    'protocols': (PROTOCOL_COLUMNS, PROTOCOL_COLUMN_NAMES),
+    'users': ("id, name, email, created_at, updated_at", ['id', 'name', 'email', 'created_at', 'updated_at']),
+}
+
+def iter_server_cursor(conn, name, query, params=None, batch_size=BACKUP_BATCH_SIZE):
+    """サーバーサイド（名前付き）カーソルで batch_size 行ずつ取得しながら1行ずつ返す"""
+    cursor = conn.cursor(name=name)
+    cursor.itersize = batch_size
     try:
-        conn = get_db_connection()
+        cursor.execute(query, params)
+        yield from cursor
+    finally:
+        cursor.close()
+
+def backup_record(names, row):
+    """バックアップ用の1行（画像スロットの値は images/<ハッシュ>.jpg のハッシュ）"""
+    record = dict(zip(names, row))
+    for key in ('created_at', 'updated_at'):
+        record[key] = str(record[key]) if record.get(key) else ''
+    return record
+
+def write_backup_zip(target, since=None):
+    """バックアップZIPを target に書き出し、manifest の内容を返す（メモリ使用量はデータ量ではなく BACKUP_BATCH_SIZE で決まる）
+
+    since を指定すると、その時刻より後に更新された行と削除記録だけを書き出す増分バックアップになる。
+    """
+    counts = {}
+    with get_db_connection() as conn, zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED) as zip_file:
         if not conn:
-            return None, "PostgreSQL接続に失敗しました"
+            raise RuntimeError("PostgreSQL接続に失敗しました")
         
+        # 全テーブルを同じ時点のスナップショットで読み、その時刻を次回の増分の基準（ウォーターマーク）にする
         cursor = conn.cursor()
-        
-        data = {
-            'export_info': {
-                'export_date': datetime.now().isoformat(),
-                'version': '2.0',
-                'app_name': 'How to CT Medical System',
-                'database_type': 'PostgreSQL'
-            },
-            'users': [],
-            'sicks': [],
-            'forms': [],
-            'protocols': []
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+        cursor.execute("SELECT LOCALTIMESTAMP")
+        watermark = cursor.fetchone()[0]
+        cursor.close()
+        params = {'since': since}
+        changed = "WHERE updated_at > %(since)s" if since else ""
+        
+        for table, (columns, names) in BACKUP_TABLES.items():
+            counts[table] = 0
+            with zip_file.open(f"{table}.ndjson", 'w') as entry:
+                for row in iter_server_cursor(conn, f"backup_{table}", f"SELECT {columns} FROM {table} {changed} ORDER BY id", params):
+                    entry.write((json.dumps(backup_record(names, row), ensure_ascii=False) + "\n").encode('utf-8'))
+                    counts[table] += 1
+        
+        # 画像は内容ごとに1ファイル（JPEGは圧縮済みなので無圧縮で格納）。増分では書き出した行の画像と更新された画像のみ
+        image_filter = ""
+        if since:
+            owners = " OR ".join(f"(owner_table = '{table}' AND owner_id IN (SELECT id FROM {table} WHERE updated_at > %(since)s))"
+                                 for table in IMAGE_SLOTS)
+            image_filter = f"AND (updated_at > %(since)s OR {owners})"
+        counts['images'] = 0
+        for content_hash, data in iter_server_cursor(conn, "backup_images", f'''
+            SELECT DISTINCT ON (content_hash) content_hash, data FROM images
+            WHERE content_hash IS NOT NULL {image_filter} ORDER BY content_hash
+        ''', params, batch_size=20):
+            info = zipfile.ZipInfo(f"images/{content_hash}.jpg", date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            with zip_file.open(info, 'w') as entry:
+                entry.write(data)
+            counts['images'] += 1
+        
+        # 増分では前回以降に削除（またはキーを変更）された行のキーを書き出す
+        if since:
+            counts['deleted'] = 0
+            with zip_file.open("deleted.ndjson", 'w') as entry:
+                for table_name, row_id, row_key, changed_at in iter_server_cursor(conn, "backup_deleted", '''
+                    SELECT table_name, row_id, row_key, changed_at FROM change_log
+                    WHERE changed_at > %(since)s ORDER BY id
+                ''', params):
+                    record = {'table': table_name, 'id': row_id, 'key': row_key, 'deleted_at': str(changed_at)}
+                    entry.write((json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8'))
+                    counts['deleted'] += 1
+        
+        manifest = {
+            'export_date': datetime.now().isoformat(),
+            'version': BACKUP_FORMAT_VERSION,
+            'app_name': 'How to CT Medical System',
+            'database_type': 'PostgreSQL',
+            'kind': 'incremental' if since else 'full',
+            'since': since.isoformat() if since else None,
+            'watermark': watermark.isoformat(),
+            'counts': counts,
         }
+        zip_file.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False, indent=2))
         
-        # ユーザーデータ（SQLiteから取得）
-        try:
-            sqlite_conn = sqlite3.connect('medical_ct.db')
-            sqlite_cursor = sqlite_conn.cursor()
-            sqlite_cursor.execute("SELECT id, name, email, created_at, updated_at FROM users")
-            users = sqlite_cursor.fetchall()
-            for user in users:
-                data['users'].append({
-                    'id': user[0], 'name': user[1], 'email': user[2],
-                    'created_at': str(user[3]) if user[3] else '',
-                    'updated_at': str(user[4]) if user[4] else ''
-                })
-            sqlite_conn.close()
-        except Exception as e:
-            st.warning(f"ユーザーデータの取得に失敗: {str(e)}")
-        
-        # 疾患データ（PostgreSQLから取得）
-        cursor.execute("SELECT * FROM sicks ORDER BY id")
-        sicks = cursor.fetchall()
-        for sick in sicks:
-            data['sicks'].append({
-                'id': sick[0], 'diesease': sick[1], 'diesease_text': sick[2],
-                'keyword': sick[3], 'protocol': sick[4], 'protocol_text': sick[5],
-                'processing': sick[6], 'processing_text': sick[7],
-                'contrast': sick[8], 'contrast_text': sick[9],
-                'diesease_img': sick[10], 'protocol_img': sick[11],
-                'processing_img': sick[12], 'contrast_img': sick[13],
-                'created_at': str(sick[14]) if len(sick) > 14 and sick[14] else '',
-                'updated_at': str(sick[15]) if len(sick) > 15 and sick[15] else ''
-            })
-        
-        # お知らせデータ（PostgreSQLから取得）
-        cursor.execute("SELECT * FROM forms ORDER BY id")
-        forms = cursor.fetchall()
-        for form in forms:
-            data['forms'].append({
-                'id': form[0], 'title': form[1], 'main': form[2],
-                'post_img': form[3],
-                'created_at': str(form[4]) if len(form) > 4 and form[4] else '',
-                'updated_at': str(form[5]) if len(form) > 5 and form[5] else ''
-            })
-        
-        # プロトコルデータ（PostgreSQLから取得）
-        cursor.execute("SELECT * FROM protocols ORDER BY id")
-        protocols = cursor.fetchall()
-        for protocol in protocols:
-            data['protocols'].append({
-                'id': protocol[0], 'category': protocol[1], 'title': protocol[2],
-                'content': protocol[3], 'protocol_img': protocol[4],
-                'created_at': str(protocol[5]) if len(protocol) > 5 and protocol[5] else '',
-                'updated_at': str(protocol[6]) if len(protocol) > 6 and protocol[6] else ''
-            })
-        
-        conn.close()
-        return data, "OK"
-        
-    except Exception as e:
-        return None, f"データエクスポート中にエラー: {str(e)}"
-
-def create_backup_zip():
-    """バックアップZIPファイルを作成"""
-    try:
-        # データをエクスポート
-        data, error = export_all_data()
-        if not data:
-            return None, error
-        
-        # ZIPファイルをメモリ上で作成
-        zip_buffer = BytesIO()
-        
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            # JSONデータを追加
-            json_data = json.dumps(data, ensure_ascii=False, indent=2)
-            zip_file.writestr('backup_data.json', json_data)
-            
-            # README.txtを追加
-            readme_content = f"""How to CT Medical System - Backup File
+        # README.txtを追加
+        readme_content = f"""How to CT Medical System - Backup File
 ==================================================
 
 作成日時: {datetime.now().strftime('%Y年%m月%d日 %H時%M分%S秒')}
-バージョン: 2.0
-データベース: PostgreSQL + SQLite (ハイブリッド)
+バージョン: {BACKUP_FORMAT_VERSION}
+データベース: PostgreSQL
+種類: {'増分（' + manifest['since'] + ' 以降の変更）' if since else '完全'}
 
 含まれるデータ:
-- 疾患データ: {len(data['sicks'])}件
-- お知らせ: {len(data['forms'])}件  
-- CTプロトコル: {len(data['protocols'])}件
-- ユーザー情報: {len(data['users'])}件 (パスワード除く)
+- 疾患データ: {counts['sicks']}件 (sicks.ndjson)
+- お知らせ: {counts['forms']}件 (forms.ndjson)
+- CTプロトコル: {counts['protocols']}件 (protocols.ndjson)
+- ユーザー情報: {counts['users']}件 (users.ndjson、パスワード除く)
+- 画像: {counts['images']}件 (images/<内容ハッシュ>.jpg)
+- 削除記録: {counts.get('deleted', 0)}件 (deleted.ndjson、増分のみ)
 
 復元方法:
 1. 管理者ページの「データ管理」タブを開く
 2. 「データ復元」セクションでこのZIPファイルをアップロード
+   （増分バックアップは、元になる完全バックアップと間の増分をまとめて選択）
 3. 「データを復元」ボタンをクリック
 
 注意: 復元時は既存データに追加されます。重複する場合は上書きされる可能性があります。
 """
-            zip_file.writestr('README.txt', readme_content)
-        
-        zip_buffer.seek(0)
-        return zip_buffer.getvalue(), None
-        
-    except Exception as e:
-        return None, f"バックアップZIP作成中にエラー: {str(e)}"
+        zip_file.writestr('README.txt', readme_content)
+    return manifest
 
-def restore_from_json(json_data):
-    """JSONデータから復元（PostgreSQL版）"""
-    try:
-        conn = get_db_connection()
+def get_last_backup_watermark():
+    """前回のバックアップのウォーターマーク（なければ None）"""
+    with get_db_connection() as conn:
         if not conn:
-            return False, "PostgreSQL接続に失敗しました"
-        
+            return None
         cursor = conn.cursor()
-        restored_counts = {'sicks': 0, 'forms': 0, 'protocols': 0}
-        
-        # 疾患データ復元
-        if 'sicks' in json_data:
-            for sick in json_data['sicks']:
-                try:
-                    cursor.execute('''
-                        INSERT INTO sicks (
-                            diesease, diesease_text, keyword, protocol, protocol_text,
-                            processing, processing_text, contrast, contrast_text,
-                            diesease_img, protocol_img, processing_img, contrast_img
-                        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                        ON CONFLICT (diesease) DO UPDATE SET
-                            diesease_text = EXCLUDED.diesease_text,
-                            keyword = EXCLUDED.keyword,
-                            protocol = EXCLUDED.protocol,
-                            protocol_text = EXCLUDED.protocol_text,
-                            processing = EXCLUDED.processing,
-                            processing_text = EXCLUDED.processing_text,
-                            contrast = EXCLUDED.contrast,
-                            contrast_text = EXCLUDED.contrast_text,
-                            diesease_img = EXCLUDED.diesease_img,
-                            protocol_img = EXCLUDED.protocol_img,
-                            processing_img = EXCLUDED.processing_img,
-                            contrast_img = EXCLUDED.contrast_img,
-                            updated_at = CURRENT_TIMESTAMP
-                    ''', (
-                        sick.get('diesease', ''),
-                        sick.get('diesease_text', ''),
-                        sick.get('keyword', ''),
-                        sick.get('protocol', ''),
-                        sick.get('protocol_text', ''),
-                        sick.get('processing', ''),
-                        sick.get('processing_text', ''),
-                        sick.get('contrast', ''),
-                        sick.get('contrast_text', ''),
-                        sick.get('diesease_img', ''),
-                        sick.get('protocol_img', ''),
-                        sick.get('processing_img', ''),
-                        sick.get('contrast_img', '')
-                    ))
-                    restored_counts['sicks'] += 1
-                except Exception as e:
-                    st.warning(f"疾患データスキップ: {sick.get('diesease', 'Unknown')} - {str(e)}")
-        
-        # お知らせデータ復元
-        if 'forms' in json_data:
-            for form in json_data['forms']:
-                try:
-                    cursor.execute('''
-                        INSERT INTO forms (title, main, post_img)
-                        VALUES (%s, %s, %s)
-                        ON CONFLICT (title) DO UPDATE SET
-                            main = EXCLUDED.main,
-                            post_img = EXCLUDED.post_img,
-                            updated_at = CURRENT_TIMESTAMP
-                    ''', (
-                        form.get('title', ''),
-                        form.get('main', ''),
-                        form.get('post_img', '')
-                    ))
-                    restored_counts['forms'] += 1
-                except Exception as e:
-                    st.warning(f"お知らせデータスキップ: {form.get('title', 'Unknown')} - {str(e)}")
-        
-        # プロトコルデータ復元
-        if 'protocols' in json_data:
-            for protocol in json_data['protocols']:
-                try:
-                    cursor.execute('''
-                        INSERT INTO protocols (category, title, content, protocol_img)
-                        VALUES (%s, %s, %s, %s)
-                        ON CONFLICT (title) DO UPDATE SET
-                            category = EXCLUDED.category,
-                            content = EXCLUDED.content,
-                            protocol_img = EXCLUDED.protocol_img,
-                            updated_at = CURRENT_TIMESTAMP
-                    ''', (
-                        protocol.get('category', ''),
-                        protocol.get('title', ''),
-                        protocol.get('content', ''),
-                        protocol.get('protocol_img', '')
-                    ))
-                    restored_counts['protocols'] += 1
-                except Exception as e:
-                    st.warning(f"プロトコルデータスキップ: {protocol.get('title', 'Unknown')} - {str(e)}")
-        
-        # コミット
+        cursor.execute("SELECT MAX(watermark) FROM backup_runs")
+        watermark = cursor.fetchone()[0]
+        cursor.close()
+    return watermark
+
+def record_backup_run(manifest):
+    """ダウンロードしたバックアップのウォーターマークを記録
+
+    完全バックアップの場合は、直近 BACKUP_RETAINED_FULL 件の完全バックアップのうち最も古いものより前の削除記録を消す。
+    記録できた場合は True を返す。
+    """
+    with get_db_connection() as conn:
+        if not conn:
+            return False
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO backup_runs (kind, watermark) VALUES (%s, %s)", (manifest['kind'], manifest['watermark']))
+        if manifest['kind'] == 'full':
+            cursor.execute('''
+                DELETE FROM change_log WHERE changed_at < (
+                    SELECT watermark FROM backup_runs WHERE kind = 'full'
+                    ORDER BY watermark DESC OFFSET %s LIMIT 1
+                ) - make_interval(secs => %s)
+            ''', (BACKUP_RETAINED_FULL - 1, BACKUP_WATERMARK_OVERLAP_SECONDS))
         conn.commit()
-        conn.close()
-        
-        # キャッシュクリア
-        if 'all_sicks_data' in st.session_state:
-            del st.session_state['all_sicks_data']
-        if 'all_forms_data' in st.session_state:
-            del st.session_state['all_forms_data']
-        if 'all_protocols_data' in st.session_state:
-            del st.session_state['all_protocols_data']
-        
-        return True, restored_counts
-        
+        cursor.close()
+    return True
+
+def confirm_backup_download():
+    """ダウンロードボタンのコールバック: 作成済みのバックアップを記録し、次回の増分の基準にする（記録できなければ保持したまま）"""
+    pending = st.session_state.get('pending_backup')
+    if pending and record_backup_run(pending['manifest']):
+        del st.session_state.pending_backup
+
+def read_backup_file(path):
+    """ダウンロード待ちのバックアップZIPを読み込む"""
+    with open(path, 'rb') as backup_file:
+        return backup_file.read()
+
+def discard_backup_files(max_age_hours=BACKUP_TEMP_MAX_AGE_HOURS):
+    """ダウンロードされずに残った古いバックアップZIPの一時ファイルを削除"""
+    cutoff = time.time() - max_age_hours * 3600
+    directory = tempfile.gettempdir()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if name.startswith(BACKUP_TEMP_PREFIX) and os.path.getmtime(path) < cutoff:
+                os.unlink(path)
+        except OSError:
+            pass
+
+def create_backup_zip(incremental=False):
+    """バックアップZIPを一時ファイルに作成し、(ファイルのパス, manifest, エラー) を返す
+
+    incremental=True でも前回のバックアップがなければ完全バックアップになる。
+    ウォーターマークはここでは記録せず、ダウンロードされた時点で confirm_backup_download が記録する。
+    """
+    since = None
+    if incremental:
+        last_watermark = get_last_backup_watermark()
+        if last_watermark:
+            since = last_watermark - timedelta(seconds=BACKUP_WATERMARK_OVERLAP_SECONDS)
+    discard_backup_files()
+    backup_file = tempfile.NamedTemporaryFile(prefix=BACKUP_TEMP_PREFIX, suffix='.zip', delete=False)
+    try:
+        with backup_file:
+            manifest = write_backup_zip(backup_file, since)
+        return backup_file.name, manifest, None
     except Exception as e:
-        return False, f"データ復元中にエラー: {str(e)}"
+        os.unlink(backup_file.name)
+        return None, None, f"バックアップZIP作成中にエラー: {str(e)}"
+
+def iter_ndjson(zip_file, name):
+    """ZIP内のNDJSONファイルを1行ずつ読み込む"""
+    with zip_file.open(name) as entry:
+        for line in entry:
+            if line.strip():
+                yield json.loads(line)
+
+def read_backup_zip(zip_file):
+    """バックアップZIPから (復元データ, 画像読み込み関数) を取得（旧形式の backup_data.json にも対応）"""
+    names = set(zip_file.namelist())
+    if 'backup_data.json' in names:
+        return json.loads(zip_file.read('backup_data.json').decode('utf-8')), None
+    
+    # 行はリストにせず、復元時に1行ずつ読み込む
+    json_data = {'export_info': json.loads(zip_file.read('manifest.json').decode('utf-8')) if 'manifest.json' in names else {}}
+    for table in list(RESTORE_TABLES) + ['deleted']:
+        if f"{table}.ndjson" in names:
+            json_data[table] = iter_ndjson(zip_file, f"{table}.ndjson")
+    
+    def load_image(content_hash):
+        name = f"images/{content_hash}.jpg"
+        return zip_file.read(name) if name in names else None
+    return json_data, load_image
 
-def import_sqlite_data(sqlite_file_path):
-    """SQLite（Laravel版）からPostgreSQLにデータを移行（完成版）"""
+def load_backup_file(uploaded_file):
+    """アップロードされたバックアップ（JSON/ZIP）から (復元データ, 画像読み込み関数) を取得"""
+    if uploaded_file.name.lower().endswith('.zip'):
+        # 画像は復元時に1件ずつZIPから読み込む
+        return read_backup_zip(zipfile.ZipFile(uploaded_file, 'r'))
+    return json.loads(uploaded_file.read().decode('utf-8')), None
+
+def backup_watermark(json_data):
+    """バックアップの時点（旧形式は作成日時）"""
+    info = json_data.get('export_info') or {}
     try:
-        # SQLite接続
-        sqlite_conn = sqlite3.connect(sqlite_file_path)
-        sqlite_cursor = sqlite_conn.cursor()
-        
-        # デバッグ: テーブル構造を確認
-        st.write("🔍 sicksテーブル構造確認:")
-        
-        # sicksテーブル構造確認のみ
-        try:
-            sqlite_cursor.execute("PRAGMA table_info(sicks)")
-            sick_columns = sqlite_cursor.fetchall()
-            st.write("📋 sicksテーブル:")
-            for col in sick_columns:
-                st.write(f"  - {col[0]}: {col[1]} ({col[2]})")
+        return datetime.fromisoformat(info.get('watermark') or info.get('export_date'))
+    except (TypeError, ValueError):
+        return datetime.min
+
+def order_backup_chain(backups):
+    """[(ファイル名, 復元データ, 画像読み込み関数), ...] を 完全 → 増分 の順に並べ、(並べた一覧, エラー) を返す
+
+    増分の since が1つ前のバックアップの時点より後なら、間の増分が欠けているのでエラーにする。
+    """
+    ordered = sorted(backups, key=lambda backup: backup_watermark(backup[1]))
+    kinds = [(backup[1].get('export_info') or {}).get('kind', 'full') for backup in ordered]
+    if kinds.count('full') > 1:
+        return None, "完全バックアップは1つだけ選択してください"
+    if 'full' in kinds and kinds[0] != 'full':
+        return None, "完全バックアップより前の時点の増分バックアップが含まれています"
+    for previous, current in zip(ordered, ordered[1:]):
+        since = (current[1].get('export_info') or {}).get('since')
+        if since and datetime.fromisoformat(since) > backup_watermark(previous[1]):
+            return None, f"{previous[0]} と {current[0]} の間の増分バックアップが不足しています"
+    return ordered, None
+
+# JSON復元の対象列（key の列で既存行と突き合わせ、一致すれば上書きする）
+RESTORE_TABLES = {
+    'sicks': {'key': ['diesease'],
+              'columns': ['diesease', 'diesease_text', 'keyword', 'protocol', 'protocol_text',
+                          'processing', 'processing_text', 'contrast', 'contrast_text']},
+    # お知らせはタイトルが重複してよいので、作成日時と合わせて同じお知らせを特定する
+    'forms': {'key': ['title', 'created_at'], 'columns': ['title', 'main', 'created_at'], 'unique': False},
+    'protocols': {'key': ['category', 'title'], 'columns': ['category', 'title', 'content']},
+}
+RESTORE_COLUMN_TYPES = {'created_at': 'timestamp'}  # 一時テーブル（TEXT）から反映するときに型変換する列
+RESTORE_IMAGE_BATCH_SIZE = 100
+RESTORE_SPOOL_BYTES = 4 * 1024 * 1024  # 復元用CSVをメモリに置く上限（超えると一時ファイルに書き出す）
+
+def restore_column(alias, column):
+    """一時テーブル・削除記録の列を、復元先の列と比較・代入できる式にする"""
+    if column in RESTORE_COLUMN_TYPES:
+        return f"{alias}.{column}::{RESTORE_COLUMN_TYPES[column]}"
+    return f"{alias}.{column}"
+
+def restore_timestamp(value):
+    """バックアップの日時を PostgreSQL の timestamp と同じ表記にそろえる（読めない値は None）"""
+    try:
+        return str(datetime.fromisoformat(value).replace(tzinfo=None))
+    except ValueError:
+        return None
+
+def iter_restore_rows(table, records, restored_at, counts, images):
+    """バックアップの行を1行ずつ復元用の値にそろえて返す
+
+    キーのない行と、UNIQUE制約のあるキーの重複（後の行を採用）は counts['skipped'] に数える。
+    制約のないテーブル（お知らせ）は全行を返す。画像スロットの値は images に {行の識別: (キー, {スロット: 値})} で集める。
+    """
+    spec = RESTORE_TABLES[table]
+    unique = spec.get('unique', True)
+    seen = set()
+    for index, record in enumerate(records):
+        row = {column: str(record.get(column) or '') for column in spec['columns']}
+        row.update(normalize_rich_values(table, row))
+        if 'created_at' in row:
+            # 作成日時のない行は復元時刻で補う（同名の行どうしが重ならないよう1マイクロ秒ずつずらす）
+            row['created_at'] = (restore_timestamp(row['created_at'])
+                                 or str(restored_at + timedelta(microseconds=index)))
+        row_key = tuple(row[column] for column in spec['key'])
+        if not all(row_key):
+            counts['skipped'] += 1
+            continue
+        if unique:
+            if row_key in seen:
+                counts['skipped'] += 1
+            seen.add(row_key)
+        image_values = {slot: record[slot] for slot in IMAGE_SLOTS[table] if record.get(slot)}
+        if image_values:
+            images[row_key if unique else index] = (row_key, image_values)
+        else:
+            images.pop(row_key if unique else index, None)
+        yield row
+
+def stage_restore_rows(cursor, table, rows):
+    """復元する行を一時テーブルに COPY で流し込み、(一時テーブル名, 列, 行数) を返す
+
+    行はディスクに溢れる一時ファイルを経由するので、バックアップの件数によらずメモリ使用量は一定。
+    restore_seq はバックアップ内の順番（重複したキーは後の行を採用する）。
+    """
+    columns = RESTORE_TABLES[table]['columns'] + [f"{field}_plain" for field in RICH_TEXT_FIELDS[table]] + ['preview']
+    staging = f"restore_{table}"
+    cursor.execute(f"CREATE TEMP TABLE {staging} ({', '.join(f'{column} TEXT' for column in columns)}, restore_seq INTEGER) "
+                   "ON COMMIT DROP")
+    count = 0
+    with tempfile.SpooledTemporaryFile(max_size=RESTORE_SPOOL_BYTES, mode='w+', encoding='utf-8', newline='') as buffer:
+        writer = csv.writer(buffer)
+        for row in rows:
+            plain = plain_text_values(table, row)
+            writer.writerow([row[column] for column in RESTORE_TABLES[table]['columns']] + list(plain.values())
+                            + [preview_value(table, plain), count])
+            count += 1
+        buffer.seek(0)
+        # CSVの空欄をNULLではなく空文字として読み込む
+        cursor.copy_expert(f"COPY {staging} ({', '.join(columns)}, restore_seq) FROM STDIN "
+                           f"WITH (FORMAT csv, FORCE_NOT_NULL ({', '.join(columns)}))", buffer)
+    return staging, columns, count
+
+def delete_restore_rows(cursor, table, keys):
+    """削除記録のキーに一致する行とその画像を削除し、削除件数を返す"""
+    key = RESTORE_TABLES[table]['key']
+    deleted = execute_values(cursor, f'''
+        DELETE FROM {table} AS t USING (VALUES %s) AS d({', '.join(key)})
+        WHERE {' AND '.join(f"t.{column} = {restore_column('d', column)}" for column in key)}
+        RETURNING t.id
+    ''', [tuple(row_key.get(column) for column in key) for row_key in keys], fetch=True)
+    ids = [row[0] for row in deleted]
+    if ids:
+        cursor.execute("DELETE FROM images WHERE owner_table = %s AND owner_id = ANY(%s)", (table, ids))
+    return len(ids)
+
+def merge_restore_rows(cursor, table, staging, columns):
+    """一時テーブルから反映し、({キー: ID}, 追加件数, 更新件数) を返す
+
+    キーにUNIQUE制約があるテーブルは1回のupsert（重複するキーは restore_seq が最後の行）、ないテーブル（'unique': False）はキーが一致する既存行の更新と
+    一致しない行の追加の2文で反映する。
+    """
+    key = RESTORE_TABLES[table]['key']
+    if RESTORE_TABLES[table].get('unique', True):
+        assignments = ", ".join(f"{column} = EXCLUDED.{column}" for column in columns if column not in key)
+        cursor.execute(f'''
+            INSERT INTO {table} ({', '.join(columns)})
+            SELECT DISTINCT ON ({', '.join(key)}) {', '.join(columns)} FROM {staging}
+            ORDER BY {', '.join(key)}, restore_seq DESC
+            ON CONFLICT ({', '.join(key)}) DO UPDATE SET {assignments}, updated_at = CURRENT_TIMESTAMP
+            RETURNING id, (xmax = 0) AS inserted, {', '.join(key)}
+        ''')
+        rows = cursor.fetchall()
+    else:
+        match = " AND ".join(f"t.{column} = {restore_column('s', column)}" for column in key)
+        assignments = ", ".join(f"{column} = {restore_column('s', column)}" for column in columns if column not in key)
+        cursor.execute(f'''
+            UPDATE {table} AS t SET {assignments}, updated_at = CURRENT_TIMESTAMP
+            FROM {staging} AS s WHERE {match}
+            RETURNING t.id, false, {', '.join(f"t.{column}" for column in key)}
+        ''')
+        rows = cursor.fetchall()
+        cursor.execute(f'''
+            INSERT INTO {table} ({', '.join(columns)})
+            SELECT {', '.join(restore_column('s', column) for column in columns)} FROM {staging} AS s
+            WHERE NOT EXISTS (SELECT 1 FROM {table} AS t WHERE {match})
+            RETURNING id, true, {', '.join(key)}
+        ''')
+        rows += cursor.fetchall()
+    ids, inserted = {}, 0
+    for row_id, was_inserted, *key_values in rows:
+        ids[tuple(str(value) for value in key_values)] = row_id
+        inserted += was_inserted
+    return ids, inserted, len(rows) - inserted
+
+def restore_from_json(json_data, load_image=None):
+    """JSONデータから復元（PostgreSQL版）
+
+    テーブルごとに行を1行ずつ読みながら一時テーブルへ COPY し、1回のupsertで反映する。全体が1トランザクションなので、
+    失敗した場合は何も反映されない。成功時は {テーブル: {'inserted', 'updated', 'skipped', 'deleted'}} を返す。
+    画像スロットの値はBase64文字列。load_image を渡した場合は画像の内容ハッシュとして扱う。
+    増分バックアップの削除記録（json_data['deleted']）は、同じバックアップの行より先に反映する。
+    """
+    migration_error = run_schema_migrations()
+    if migration_error:
+        return False, f"スキーマが最新ではないため復元できません: {migration_error}"
+    try:
+        with get_db_connection() as conn:
+            if not conn:
+                return False, "PostgreSQL接続に失敗しました"
+        
+            cursor = conn.cursor()
+            restored_counts = {}
+            restored_at = datetime.now()
+            image_rows, skipped_images = [], 0
+            deletions = defaultdict(list)
+            for entry in json_data.get('deleted') or []:
+                if entry.get('table') in RESTORE_TABLES:
+                    deletions[entry['table']].append(entry['key'])
+        
+            for table in RESTORE_TABLES:
+                deleted = delete_restore_rows(cursor, table, deletions[table]) if deletions[table] else 0
+
+                counts, images = {'skipped': 0}, {}
+                rows = iter_restore_rows(table, json_data.get(table) or [], restored_at, counts, images)
+                staging, columns, staged = stage_restore_rows(cursor, table, rows)
+                ids, inserted, updated = merge_restore_rows(cursor, table, staging, columns) if staged else ({}, 0, 0)
+                restored_counts[table] = {'inserted': inserted, 'updated': updated, 'skipped': counts['skipped'], 'deleted': deleted}
             
-            # sicksサンプルデータ
-            sqlite_cursor.execute("SELECT * FROM sicks LIMIT 1")
-            sick_samples = sqlite_cursor.fetchall()
-            st.write("📋 sicksサンプルデータ:")
-            for i, sample in enumerate(sick_samples):
-                st.write(f"  Row {i+1}: {sample}")
-        except Exception as e:
-            st.warning(f"sicksテーブル確認エラー: {e}")
-        
-        # PostgreSQL接続
-        pg_conn = get_db_connection()
-        if not pg_conn:
-            return False, "PostgreSQL接続に失敗しました"
-        
-        pg_cursor = pg_conn.cursor()
-        
-        imported_counts = {'sicks': 0, 'forms': 0, 'protocols': 0}
-        
-        # UNIQUE制約を追加
-        try:
-            pg_cursor.execute('''
-                ALTER TABLE sicks ADD CONSTRAINT unique_diesease UNIQUE (diesease)
-            ''')
-            st.write("✅ 疾患テーブルにUNIQUE制約を追加しました")
-        except Exception as e:
-            if "already exists" in str(e) or "unique_diesease" in str(e):
-                st.write("ℹ️ 疾患テーブルのUNIQUE制約は既に存在します")
+                # 画像（バックアップにないスロットは既存画像を維持）
+                for row_key, image_values in images.values():
+                    for slot, value in image_values.items():
+                        try:
+                            image = load_image(value) if load_image else decode_image_data(value)
+                            image_rows.append(image_row(table, ids[row_key], slot, image))
+                        except Exception:
+                            skipped_images += 1
+                        if len(image_rows) >= RESTORE_IMAGE_BATCH_SIZE:
+                            upsert_image_rows(cursor, image_rows)
+                            image_rows = []
+            upsert_image_rows(cursor, image_rows)
+            restored_counts['skipped_images'] = skipped_images
+        
+            # コミット
+            notify_change(cursor, ['sicks', 'forms', 'protocols'])
+            conn.commit()
+        
+        # 一括変更のためインメモリ検索インデックスは再構築
+        get_search_index.clear()
+        bump_table_versions('sicks', 'forms', 'protocols')
         
-        pg_conn.commit()
+        return True, restored_counts
         
-        # 疾患データ移行（強化版）
+    except Exception as e:
+        return False, f"データ復元中にエラー: {str(e)}"
+
+# Laravel版SQLiteの取り込み（テーブル: 取り込む列, 重複判定に使う列）
+IMPORT_TABLES = {
+    'sicks': (['diesease', 'diesease_text', 'keyword', 'protocol', 'protocol_text',
+               'processing', 'processing_text', 'contrast', 'contrast_text'], 'diesease'),
+    'protocols': (['category', 'title', 'content'], 'title'),
+}
+IMPORT_BATCH_SIZE = 500
+# 日付・時刻だけの値（Laravel版の疾患データで別の列の値が入っていたもの）は取り込まない
+IMPORT_DATETIME_PATTERN = r'^(?:\d{4}-\d{2}-\d{2}[\s\d:.-]*$|\d{4}/\d{2}/\d{2}(?:\s+\d{2}:\d{2}(?::\d{2})?)?$|\d{2}:\d{2}:\d{2}$)'
+IMPORT_DATETIME_COLUMNS = {'sicks': IMPORT_TABLES['sicks'][0]}  # 日付だけの値を除く列（プロトコルの本文などはそのまま取り込む）
+
+def read_sqlite_table(sqlite_conn, table, columns):
+    """SQLiteのテーブルを1回で読み込み、columns の列だけの DataFrame を返す（テーブルがなければ None）"""
+    exists = sqlite_conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name = ?", (table,)).fetchone()
+    if not exists:
+        return None
+    return pd.read_sql_query(f"SELECT * FROM {table}", sqlite_conn).reindex(columns=columns)
+
+def clean_import_frame(frame, table, key, log):
+    """全列の前後の空白を除き、IMPORT_DATETIME_COLUMNS の列の日付・時刻だけの値を空文字にする（列単位で一括処理）"""
+    frame = frame.fillna('').astype(str).apply(lambda column: column.str.strip())
+    for column in IMPORT_DATETIME_COLUMNS.get(table, []):
+        is_datetime = frame[column].str.match(IMPORT_DATETIME_PATTERN)
+        for name, value in zip(frame.loc[is_datetime, key], frame.loc[is_datetime, column]):
+            log.append(f"日付データ除去 ({table}.{column}) {name}: {value}")
+        frame.loc[is_datetime, column] = ''
+    return frame
+
+def drop_import_duplicates(cursor, table, key, frame, log):
+    """キーが空の行、ファイル内の重複、既存データとの重複を除く（既存データとの照合は1回のクエリ）"""
+    empty = frame[key] == ''
+    in_file = frame.duplicated(subset=[key], keep='first')
+    cursor.execute(f"SELECT {key} FROM {table} WHERE {key} = ANY(%s)", (frame.loc[~empty, key].unique().tolist(),))
+    in_db = frame[key].isin({row[0] for row in cursor.fetchall()})
+    if empty.any():
+        log.append(f"{key} が空のためスキップ ({table}): {int(empty.sum())}件")
+    for name in frame.loc[~empty & (in_file | in_db), key]:
+        log.append(f"重複スキップ ({table}): {name}")
+    return frame[~(empty | in_file | in_db)]
+
+def import_sqlite_data(sqlite_file_path, progress=None):
+    """SQLite（Laravel版）からPostgreSQLにデータを移行
+
+    各テーブルを1回で読み込み、列単位で整形し、重複を1回のクエリで除いてから IMPORT_BATCH_SIZE 件ずつ登録する。
+    全件を1トランザクションで登録するため、失敗した場合は何も反映されない。
+    progress(割合, メッセージ) を渡すと登録の進捗を通知する。成功時は件数と取り込みログ（'log'）を返す。
+    """
+    progress = progress or (lambda value, text: None)
+    log = []
+    try:
+        sqlite_conn = sqlite3.connect(sqlite_file_path)
         try:
-            sqlite_cursor.execute("SELECT COUNT(*) FROM sicks")
-            sick_count = sqlite_cursor.fetchone()[0]
-            st.write(f"📊 SQLite疾患データ件数: {sick_count}件")
-            
-            sqlite_cursor.execute("SELECT * FROM sicks")
-            sicks = sqlite_cursor.fetchall()
-            
-            for sick in sicks:
-                try:
-                    # 重複チェック
-                    pg_cursor.execute("SELECT COUNT(*) FROM sicks WHERE diesease = %s", (sick[1],))
-                    exists = pg_cursor.fetchone()[0] > 0
-                    
-                    if exists:
-                        st.write(f"⚠️ 疾患データ重複スキップ: {sick[1]}")
-                        continue
-                    
-                    # 強化された日付検出関数
-                    def is_datetime_string(value):
-                        if not value:
-                            return False
-                        if isinstance(value, str):
-                            # より厳密な日付パターンをチェック
-                            datetime_patterns = [
-                                r'^\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}:\d{2}$',  # 2023-09-19 08:09:37
-                                r'^\d{4}-\d{2}-\d{2}[\s\d:.-]*$',  # その他の日付パターン
-                                r'^\d{4}/\d{2}/\d{2}',  # 2023/09/19形式
-                                r'^\d{2}:\d{2}:\d{2}$',  # 08:09:37のみ
-                            ]
-                            for pattern in datetime_patterns:
-                                if re.match(pattern, str(value).strip()):
-                                    return True
-                        return False
-                    
-                    # より詳細なフィールド処理
-                    def clean_field(value, field_name=""):
-                        if not value:
-                            return ""
-                        
-                        value_str = str(value).strip()
-                        
-                        # 日付文字列の場合は除去
-                        if is_datetime_string(value_str):
-                            st.write(f"  🗑️ 日付データ除去 ({field_name}): {value_str}")
-                            return ""
-                        
-                        # 非常に短い意味のない文字列の場合も除去（ただし1文字以上は保持）
-                        if len(value_str) < 1:
-                            return ""
-                        
-                        return value_str
-                    
-                    # 各フィールドを適切に処理（フィールド名付きでログ出力）
-                    diesease = clean_field(sick[1], "疾患名")
-                    diesease_text = clean_field(sick[2], "疾患詳細")
-                    keyword = clean_field(sick[3], "キーワード")
-                    protocol = clean_field(sick[4], "撮影プロトコル")
-                    protocol_text = clean_field(sick[5], "撮影詳細")
-                    processing = clean_field(sick[6], "画像処理")
-                    processing_text = clean_field(sick[7], "画像処理詳細")  # ←重要
-                    contrast = clean_field(sick[8], "造影プロトコル")
-                    contrast_text = clean_field(sick[9], "造影詳細")
-                    
-                    # デバッグ: 処理結果を表示（全フィールド）
-                    st.write(f"📋 処理結果 - {diesease}:")
-                    st.write(f"  - 疾患詳細: '{diesease_text[:50]}...' ({len(diesease_text)}文字)")
-                    st.write(f"  - キーワード: '{keyword}'")
-                    st.write(f"  - 撮影プロトコル: '{protocol}'")
-                    st.write(f"  - 撮影詳細: '{protocol_text[:50]}...' ({len(protocol_text)}文字)")
-                    st.write(f"  - 画像処理: '{processing}'")
-                    st.write(f"  - 画像処理詳細: '{processing_text[:50]}...' ({len(processing_text)}文字)")
-                    st.write(f"  - 造影プロトコル: '{contrast}'")
-                    st.write(f"  - 造影詳細: '{contrast_text[:50]}...' ({len(contrast_text)}文字)")
-                    
-                    # 新規挿入
-                    pg_cursor.execute('''
-                        INSERT INTO sicks (
-                            diesease, diesease_text, keyword, protocol, protocol_text,
-                            processing, processing_text, contrast, contrast_text
-                        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    ''', (
-                        diesease, diesease_text, keyword, protocol, protocol_text,
-                        processing, processing_text, contrast, contrast_text
-                    ))
-                    imported_counts['sicks'] += 1
-                    st.write(f"✅ 疾患データ登録: {diesease}")
-                    
-                except Exception as e:
-                    st.warning(f"❌ 疾患データエラー: {sick[1] if len(sick) > 1 else 'Unknown'} - {str(e)}")
-                    pg_conn.rollback()
+            frames = {}
+            for table, (columns, key) in IMPORT_TABLES.items():
+                frame = read_sqlite_table(sqlite_conn, table, columns)
+                if frame is None:
+                    log.append(f"Laravel版SQLiteに {table} テーブルは存在しません")
                     continue
-        except Exception as e:
-            st.warning(f"疾患テーブル処理エラー: {str(e)}")
+                log.append(f"SQLite {table}: {len(frame)}件")
+                frame = clean_import_frame(frame, table, key, log)
+                for field in RICH_TEXT_FIELDS[table]:
+                    frame[field] = frame[field].map(normalize_rich_html)
+                frames[table] = frame
+        finally:
+            sqlite_conn.close()
+        log.append("お知らせデータの取り込みはスキップされます")
         
-        # お知らせデータ移行（スキップ）
-        st.info("ℹ️ お知らせデータの取り込みはスキップされます")
+        if 'protocols' in frames:
+            frames['protocols']['category'] = frames['protocols']['category'].replace('', '一般')
         
-        # プロトコルデータ移行（テーブル存在チェック）
-        try:
-            sqlite_cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='protocols'")
-            protocol_table_exists = sqlite_cursor.fetchone() is not None
+        imported_counts = {'sicks': 0, 'forms': 0, 'protocols': 0}
+        with get_db_connection() as pg_conn:
+            if not pg_conn:
+                return False, "PostgreSQL接続に失敗しました"
+            pg_cursor = pg_conn.cursor()
             
-            if protocol_table_exists:
-                sqlite_cursor.execute("SELECT COUNT(*) FROM protocols")
-                protocol_count = sqlite_cursor.fetchone()[0]
-                st.write(f"📊 SQLiteプロトコル件数: {protocol_count}件")
-                
-                if protocol_count > 0:
-                    sqlite_cursor.execute("SELECT * FROM protocols")
-                    protocols = sqlite_cursor.fetchall()
-                    
-                    for protocol in protocols:
-                        try:
-                            # 重複チェック
-                            pg_cursor.execute("SELECT COUNT(*) FROM protocols WHERE title = %s", (protocol[2],))
-                            exists = pg_cursor.fetchone()[0] > 0
-                            
-                            if exists:
-                                st.write(f"⚠️ プロトコル重複スキップ: {protocol[2]}")
-                                continue
-                            
-                            # 新規挿入
-                            pg_cursor.execute('''
-                                INSERT INTO protocols (category, title, content) VALUES (%s, %s, %s)
-                            ''', (protocol[1] or '一般', protocol[2], protocol[3] or ''))
-                            imported_counts['protocols'] += 1
-                            st.write(f"✅ プロトコル登録: {protocol[2]}")
-                            
-                        except Exception as e:
-                            st.warning(f"❌ プロトコルエラー: {protocol[2]} - {str(e)}")
-                            pg_conn.rollback()
-                            continue
-            else:
-                st.info("ℹ️ Laravel版SQLiteにプロトコルテーブルは存在しません")
-        except Exception as e:
-            st.warning(f"プロトコルテーブル処理エラー: {str(e)}")
-        
-        # 最終コミット
-        pg_conn.commit()
-        sqlite_conn.close()
-        pg_conn.close()
+            for table, frame in frames.items():
+                frames[table] = drop_import_duplicates(pg_cursor, table, IMPORT_TABLES[table][1], frame, log)
+            total = sum(len(frame) for frame in frames.values())
+            done = 0
+            
+            for table, frame in frames.items():
+                columns = list(frame.columns) + [f"{field}_plain" for field in RICH_TEXT_FIELDS[table]] + ['preview']
+                records = frame.to_dict('records')
+                for start in range(0, len(records), IMPORT_BATCH_SIZE):
+                    batch = records[start:start + IMPORT_BATCH_SIZE]
+                    rows = []
+                    for record in batch:
+                        plain = plain_text_values(table, record)
+                        rows.append(tuple(record.values()) + tuple(plain.values()) + (preview_value(table, plain),))
+                    # 照合後に他の画面から同じキーが登録されていた場合もエラーにせずスキップする
+                    execute_values(pg_cursor, f'''
+                        INSERT INTO {table} ({', '.join(columns)}) VALUES %s ON CONFLICT DO NOTHING
+                    ''', rows, page_size=len(rows))
+                    imported_counts[table] += pg_cursor.rowcount
+                    done += len(batch)
+                    progress(done / total, f"{table}: {done}/{total}件")
+                log.append(f"登録 ({table}): {imported_counts[table]}件")
+            
+            notify_change(pg_cursor, ['sicks', 'protocols'])
+            pg_conn.commit()
         
-        # キャッシュクリア（疾患データのみ）
-        get_all_sicks.clear()
+        # キャッシュ無効化（取り込むのは疾患・プロトコルのみ）
+        bump_table_versions('sicks', 'protocols')
+        get_search_index.clear()
         
+        imported_counts['log'] = "\n".join(log)
         return True, imported_counts
         
     except Exception as e:
@@ -2930,230 +4581,286 @@ def show_admin_page():
                     st.error("❌ 全ての必須項目を入力してください")
     
     with tab2:
-        st.markdown("### 👥 ユーザー管理")
-        
-        # 全ユーザー一覧表示
-        df_users = get_all_users()
+        show_admin_user_management()
+    
+    with tab3:
+        show_admin_data_management()
+
+@st.fragment
+def show_admin_user_management():
+    """管理者ページ: ユーザー管理タブ（削除などの操作ではこのタブだけ再実行する）"""
+    st.markdown("### 👥 ユーザー管理")
+    
+    # 全ユーザー一覧表示
+    df_users = get_all_users()
+    
+    if not df_users.empty:
+        st.markdown(f"**登録ユーザー数:** {len(df_users)}人")
         
-        if not df_users.empty:
-            st.markdown(f"**登録ユーザー数:** {len(df_users)}人")
+        # ユーザー一覧をカード形式で表示
+        for idx, user in df_users.iterrows():
+            st.markdown('<div class="search-result">', unsafe_allow_html=True)
             
-            # ユーザー一覧をカード形式で表示
-            for idx, user in df_users.iterrows():
-                st.markdown('<div class="search-result">', unsafe_allow_html=True)
-                
-                col1, col2, col3 = st.columns([3, 1, 1])
-                
-                with col1:
-                    st.markdown(f"**👤 {user['name']}**")
-                    st.markdown(f"📧 {user['email']}")
-                    st.caption(f"登録日: {user['created_at']}")
-                
-                with col2:
-                    # 現在のユーザー自身は削除できないようにする
-                    if user['email'] != st.session_state.user['email']:
-                        if st.button("編集", key=f"edit_user_{user['id']}", disabled=True):
-                            st.info("編集機能は今後追加予定です")
-                    else:
-                        st.markdown("**(現在のユーザー)**")
-                
-                with col3:
-                    # 管理者ユーザーと現在のユーザー自身は削除不可
-                    admin_emails = ['admin@hospital.jp']
-                    if user['email'] not in admin_emails and user['email'] != st.session_state.user['email']:
-                        if st.button("削除", key=f"delete_user_{user['id']}"):
-                            # 削除確認
-                            if st.session_state.get(f'confirm_delete_user_{user["id"]}', False):
-                                delete_user(user['id'])
-                                st.success(f"ユーザー「{user['name']}」を削除しました")
-                                st.rerun()
-                            else:
-                                st.session_state[f'confirm_delete_user_{user["id"]}'] = True
-                                st.warning("もう一度削除ボタンを押すと削除されます")
-                    elif user['email'] in admin_emails:
-                        st.markdown("**(管理者)**")
-                    else:
-                        st.markdown("**(現在のユーザー)**")
-                
-                st.markdown('</div>', unsafe_allow_html=True)
-        else:
-            st.info("登録ユーザーがいません")
-        
-        # ユーザー統計情報
-        if not df_users.empty:
-            st.markdown("---")
-            st.markdown("### 📊 ユーザー統計")
+            col1, col2, col3 = st.columns([3, 1, 1])
             
-            col1, col2, col3 = st.columns(3)
             with col1:
-                st.metric("総ユーザー数", len(df_users))
+                st.markdown(f"**👤 {user['name']}**")
+                st.markdown(f"📧 {user['email']}")
+                st.caption(f"登録日: {user['created_at']}")
+            
             with col2:
-                # 今月の新規登録数
-                current_month = datetime.now().strftime('%Y-%m')
-                monthly_users = len([u for u in df_users['created_at'] if current_month in str(u)])
-                st.metric("今月の新規登録", f"{monthly_users}人")
+                # 現在のユーザー自身は削除できないようにする
+                if user['email'] != st.session_state.user['email']:
+                    if st.button("編集", key=f"edit_user_{user['id']}", disabled=True):
+                        st.info("編集機能は今後追加予定です")
+                else:
+                    st.markdown("**(現在のユーザー)**")
+            
             with col3:
-                # 管理者数
-                admin_count = len([u for u in df_users['email'] if u in ['admin@hospital.jp']])
-                st.metric("管理者数", f"{admin_count}人")
+                # 管理者ユーザーと現在のユーザー自身は削除不可
+                admin_emails = ['admin@hospital.jp']
+                if user['email'] not in admin_emails and user['email'] != st.session_state.user['email']:
+                    if st.button("削除", key=f"delete_user_{user['id']}"):
+                        # 削除確認
+                        if st.session_state.get(f'confirm_delete_user_{user["id"]}', False):
+                            delete_user(user['id'])
+                            st.success(f"ユーザー「{user['name']}」を削除しました")
+                            rerun_fragment()
+                        else:
+                            st.session_state[f'confirm_delete_user_{user["id"]}'] = True
+                            st.warning("もう一度削除ボタンを押すと削除されます")
+                elif user['email'] in admin_emails:
+                    st.markdown("**(管理者)**")
+                else:
+                    st.markdown("**(現在のユーザー)**")
+            
+            st.markdown('</div>', unsafe_allow_html=True)
+    else:
+        st.info("登録ユーザーがいません")
     
-    with tab3:
-        st.markdown("### 📊 データ管理")
-        
-        # データエクスポート
-        st.markdown("#### 📤 データバックアップ")
+    # ユーザー統計情報
+    if not df_users.empty:
+        st.markdown("---")
+        st.markdown("### 📊 ユーザー統計")
         
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("総ユーザー数", len(df_users))
+        with col2:
+            # 今月の新規登録数
+            current_month = datetime.now().strftime('%Y-%m')
+            monthly_users = len([u for u in df_users['created_at'] if current_month in str(u)])
+            st.metric("今月の新規登録", f"{monthly_users}人")
+        with col3:
+            # 管理者数
+            admin_count = len([u for u in df_users['email'] if u in ['admin@hospital.jp']])
+            st.metric("管理者数", f"{admin_count}人")
+
+@st.fragment
+def show_admin_data_management():
+    """管理者ページ: データ管理タブ（バックアップ・復元などの操作ではこのタブだけ再実行する）"""
+    st.markdown("### 📊 データ管理")
+    
+    if run_schema_migrations():
+        if st.button("🔁 スキーマ移行を再試行", key="retry_schema_migrations"):
+            run_schema_migrations.clear()
+            get_search_extension.clear()
+            st.rerun()
+    
+    # データエクスポート
+    st.markdown("#### 📤 データバックアップ")
+    
+    col1, col2 = st.columns([2, 1])
+    with col1:
+        st.info("""
+        **バックアップに含まれるデータ:**
+        - 疾患データ（画像含む）
+        - お知らせ（画像含む）
+        - CTプロトコル（画像含む）
+        - ユーザー情報（パスワード除く）
+        
+        **増分バックアップ:** 前回のバックアップ以降に変更・削除されたデータだけを書き出します
+        """)
+        last_watermark = get_last_backup_watermark()
+        st.caption(f"前回のバックアップ時点: {last_watermark.strftime('%Y/%m/%d %H:%M:%S') if last_watermark else 'なし'}")
+    
+    with col2:
+        backup_kind = st.radio("バックアップの種類", ["完全", "増分"], horizontal=True, key="backup_kind")
+        if st.button("📤 バックアップ作成", use_container_width=True, key="create_backup"):
+            with st.spinner("バックアップを作成中..."):
+                backup_path, manifest, error = create_backup_zip(incremental=backup_kind == "増分")
+                
+                if backup_path:
+                    # ダウンロードされるまで完成したZIPを一時ファイルに残し、セッションにはパスだけを保持する
+                    previous = st.session_state.get('pending_backup')
+                    if previous and os.path.exists(previous['path']):
+                        os.unlink(previous['path'])
+                    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+                    kind_suffix = "_incremental" if manifest['kind'] == 'incremental' else ""
+                    st.session_state.pending_backup = {
+                        'path': backup_path,
+                        'filename': f"ct_system_backup{kind_suffix}_{timestamp}.zip",
+                        'manifest': manifest,
+                    }
+                else:
+                    st.error(f"❌ {error}")
+        
+        pending_backup = st.session_state.get('pending_backup')
+        if pending_backup and not os.path.exists(pending_backup['path']):
+            st.warning("ダウンロード待ちのバックアップの有効期限が切れました。もう一度作成してください")
+            del st.session_state.pending_backup
+            pending_backup = None
+        if pending_backup:
+            # ZIPはクリックされた時点で一時ファイルから読み込む
+            st.download_button(
+                label="📥 バックアップをダウンロード",
+                data=functools.partial(read_backup_file, pending_backup['path']),
+                file_name=pending_backup['filename'],
+                mime="application/zip",
+                use_container_width=True,
+                on_click=confirm_backup_download,
+                key="download_backup"
+            )
+            manifest = pending_backup['manifest']
+            counts = manifest['counts']
+            st.success(f"✅ {'増分' if manifest['kind'] == 'incremental' else '完全'}バックアップが作成されました！"
+                       f"（疾患 {counts['sicks']}件 / お知らせ {counts['forms']}件 / プロトコル {counts['protocols']}件 / "
+                       f"画像 {counts['images']}件 / 削除 {counts.get('deleted', 0)}件）")
+            st.caption("ダウンロードした時点で、次回の増分バックアップの基準になります")
+    
+    st.markdown("---")
+    
+    # データ復元
+    st.markdown("#### 📥 データ復元")
+    
+    uploaded_files = st.file_uploader(
+        "バックアップファイルを選択",
+        type=['json', 'zip'],
+        accept_multiple_files=True,
+        help="backup_data.json またはバックアップZIPファイル。完全バックアップと、それに続く増分バックアップをまとめて選択できます",
+        key="backup_file_uploader"
+    )
+    
+    if uploaded_files:
         col1, col2 = st.columns([2, 1])
+        
         with col1:
-            st.info("""
-            **バックアップに含まれるデータ:**
-            - 疾患データ（画像含む）
-            - お知らせ（画像含む）
-            - CTプロトコル（画像含む）
-            - ユーザー情報（パスワード除く）
+            st.warning("""
+            ⚠️ **復元時の注意事項:**
+            - 既存のデータと重複する場合は上書きされます
+            - 増分バックアップは 完全 → 増分 の順に自動で並べて適用します
+            - 復元前に現在のデータをバックアップすることを推奨します
+            - ユーザーデータは復元されません（手動で再作成が必要）
             """)
         
         with col2:
-            if st.button("📤 バックアップ作成", use_container_width=True, key="create_backup"):
-                with st.spinner("バックアップを作成中..."):
-                    backup_data, error = create_backup_zip()
+            if st.button("📥 データを復元", use_container_width=True, key="restore_data"):
+                try:
+                    backups = [(uploaded_file.name, *load_backup_file(uploaded_file)) for uploaded_file in uploaded_files]
+                    chain, error = order_backup_chain(backups)
                     
-                    if backup_data:
-                        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                        filename = f"ct_system_backup_{timestamp}.zip"
-                        
-                        st.download_button(
-                            label="📥 バックアップをダウンロード",
-                            data=backup_data,
-                            file_name=filename,
-                            mime="application/zip",
-                            use_container_width=True
-                        )
-                        st.success("✅ バックアップが作成されました！")
-                    else:
+                    if error:
                         st.error(f"❌ {error}")
-        
-        st.markdown("---")
-        
-        # データ復元
-        st.markdown("#### 📥 データ復元")
-        
-        uploaded_file = st.file_uploader(
-            "バックアップファイルを選択",
-            type=['json', 'zip'],
-            help="backup_data.json または バックアップZIPファイルをアップロード",
-            key="backup_file_uploader"
-        )
-        
-        if uploaded_file is not None:
-            file_type = uploaded_file.name.split('.')[-1].lower()
-            
-            col1, col2 = st.columns([2, 1])
-            
-            with col1:
-                st.warning("""
-                ⚠️ **復元時の注意事項:**
-                - 既存のデータと重複する場合は上書きされます
-                - 復元前に現在のデータをバックアップすることを推奨します
-                - ユーザーデータは復元されません（手動で再作成が必要）
-                """)
-            
-            with col2:
-                if st.button("📥 データを復元", use_container_width=True, key="restore_data"):
-                    try:
-                        if file_type == 'json':
-                            # JSONファイルから直接復元
-                            json_content = uploaded_file.read().decode('utf-8')
-                            json_data = json.loads(json_content)
-                            
-                        elif file_type == 'zip':
-                            # ZIPファイルから復元
-                            with zipfile.ZipFile(uploaded_file, 'r') as zip_file:
-                                json_content = zip_file.read('backup_data.json').decode('utf-8')
-                                json_data = json.loads(json_content)
-                        
-                        # 復元実行
+                    else:
+                        if (chain[0][1].get('export_info') or {}).get('kind') == 'incremental':
+                            st.info("完全バックアップが選択されていないため、現在のデータに増分を適用します")
+                        # 復元実行（1ファイルずつ、失敗したらそこで止める）
                         with st.spinner("データを復元中..."):
-                            success, result = restore_from_json(json_data)
-                            
-                            if success:
-                                st.success("🎉 データの復元が完了しました！")
-                                st.info(f"""
-                                **📊 復元結果:**
-                                - 疾患データ: {result['sicks']}件
-                                - お知らせ: {result['forms']}件
-                                - CTプロトコル: {result['protocols']}件
-                                """)
-                                st.balloons()
+                            labels = {'sicks': '疾患データ', 'forms': 'お知らせ', 'protocols': 'CTプロトコル'}
+                            for name, json_data, load_image in chain:
+                                success, result = restore_from_json(json_data, load_image)
+                                if not success:
+                                    st.error(f"❌ {name}: {result}")
+                                    break
+                                lines = "\n".join(
+                                    f"- {label}: 追加 {result[table]['inserted']}件 / 更新 {result[table]['updated']}件 / "
+                                    f"削除 {result[table]['deleted']}件 / スキップ {result[table]['skipped']}件"
+                                    for table, label in labels.items()
+                                )
+                                st.info(f"**📊 復元結果（{name}）:**\n{lines}")
+                                if result['skipped_images']:
+                                    st.warning(f"読み込めなかった画像 {result['skipped_images']}件をスキップしました")
                             else:
-                                st.error(f"❌ {result}")
-                    
-                    except Exception as e:
-                        st.error(f"❌ ファイルの処理中にエラーが発生しました: {str(e)}")
-        
-        st.markdown("---")
-        
-        # SQLiteデータ取り込み
-        st.markdown("#### 📂 Laravel版SQLiteデータ取り込み")
-        
-        sqlite_uploaded_file = st.file_uploader(
-            "Laravel版SQLiteファイルを選択",
-            type=['db', 'sqlite', 'sqlite3'],
-            help="Laravel版で使用していたSQLiteデータベースファイルをアップロード",
-            key="sqlite_import_uploader"
-        )
-        
-        if sqlite_uploaded_file is not None:
-            col1, col2 = st.columns([2, 1])
-            
-            with col1:
-                st.info("""
-                **Laravel版SQLiteデータ取り込み:**
-                - 既存のPostgreSQLデータに追加されます
-                - 重複データがある場合はスキップされます
-                - 疾患、お知らせ、CTプロトコルデータが対象です
-                """)
-            
-            with col2:
-                if st.button("📂 SQLiteデータを取り込み", use_container_width=True, key="import_sqlite"):
-                    with st.spinner("SQLiteデータを取り込み中..."):
-                        try:
-                            # 一時ファイルに保存
-                            import tempfile
-                            import os
-                            with tempfile.NamedTemporaryFile(delete=False, suffix='.db') as tmp_file:
-                                tmp_file.write(sqlite_uploaded_file.read())
-                                tmp_file_path = tmp_file.name
-                            
-                            # データ移行実行
-                            success, result = import_sqlite_data(tmp_file_path)
-                            
-                            # 一時ファイル削除
-                            os.unlink(tmp_file_path)
-                            
-                            if success:
-                                st.success("🎉 SQLiteデータの取り込みが完了しました！")
-                                st.info(f"""
-                                **📊 取り込み結果:**
-                                - 疾患データ: {result['sicks']}件
-                                - お知らせ: {result['forms']}件
-                                - CTプロトコル: {result['protocols']}件
-                                """)
+                                st.success("🎉 データの復元が完了しました！")
                                 st.balloons()
-                            else:
-                                st.error(f"❌ {result}")
-                        
-                        except Exception as e:
-                            st.error(f"❌ ファイル処理中にエラー: {str(e)}")
-        
-        st.markdown("---")
+                
+                except Exception as e:
+                    st.error(f"❌ ファイルの処理中にエラーが発生しました: {str(e)}")
+    
+    st.markdown("---")
+    
+    # SQLiteデータ取り込み
+    st.markdown("#### 📂 Laravel版SQLiteデータ取り込み")
+    
+    sqlite_uploaded_file = st.file_uploader(
+        "Laravel版SQLiteファイルを選択",
+        type=['db', 'sqlite', 'sqlite3'],
+        help="Laravel版で使用していたSQLiteデータベースファイルをアップロード",
+        key="sqlite_import_uploader"
+    )
+    
+    if sqlite_uploaded_file is not None:
+        col1, col2 = st.columns([2, 1])
         
-        # システム情報
-        st.markdown("#### ℹ️ システム情報")
+        with col1:
+            st.info("""
+            **Laravel版SQLiteデータ取り込み:**
+            - 既存のPostgreSQLデータに追加されます
+            - 重複データがある場合はスキップされます
+            - 疾患、お知らせ、CTプロトコルデータが対象です
+            """)
         
-        try:
-            # PostgreSQLからデータベース統計を取得
-            conn = get_db_connection()
+        with col2:
+            if st.button("📂 SQLiteデータを取り込み", use_container_width=True, key="import_sqlite"):
+                progress_bar = st.progress(0.0, text="SQLiteデータを取り込み中...")
+                try:
+                    # 一時ファイルに保存
+                    with tempfile.NamedTemporaryFile(delete=False, suffix='.db') as tmp_file:
+                        tmp_file.write(sqlite_uploaded_file.read())
+                        tmp_file_path = tmp_file.name
+                    
+                    # データ移行実行
+                    try:
+                        success, result = import_sqlite_data(
+                            tmp_file_path, progress=lambda value, text: progress_bar.progress(value, text=text)
+                        )
+                    finally:
+                        # 一時ファイル削除
+                        os.unlink(tmp_file_path)
+                    
+                    if success:
+                        progress_bar.progress(1.0, text="取り込み完了")
+                        st.success("🎉 SQLiteデータの取り込みが完了しました！")
+                        st.info(f"""
+                        **📊 取り込み結果:**
+                        - 疾患データ: {result['sicks']}件
+                        - お知らせ: {result['forms']}件
+                        - CTプロトコル: {result['protocols']}件
+                        """)
+                        st.download_button(
+                            label="📄 取り込みログをダウンロード",
+                            data=result['log'],
+                            file_name=f"sqlite_import_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
+                            mime="text/plain",
+                            key="download_import_log"
+                        )
+                        st.balloons()
+                    else:
+                        progress_bar.empty()
+                        st.error(f"❌ {result}")
+                
+                except Exception as e:
+                    progress_bar.empty()
+                    st.error(f"❌ ファイル処理中にエラー: {str(e)}")
+    
+    st.markdown("---")
+    
+    # システム情報
+    st.markdown("#### ℹ️ システム情報")
+    
+    try:
+        # PostgreSQLからデータベース統計を取得
+        with get_db_connection() as conn:
             if conn:
                 cursor = conn.cursor()
                 
@@ -3168,38 +4875,80 @@ def show_admin_page():
                 
                 cursor.execute("SELECT COUNT(*) FROM users")
                 user_count = cursor.fetchone()[0]
-                
-                conn.close()
-                
-                col1, col2, col3, col4 = st.columns(4)
-                with col1:
-                    st.metric("疾患データ", f"{sick_count}件")
-                with col2:
-                    st.metric("お知らせ", f"{form_count}件")
-                with col3:
-                    st.metric("CTプロトコル", f"{protocol_count}件")
-                with col4:
-                    st.metric("ユーザー", f"{user_count}人")
-            else:
-                st.error("データベース接続に失敗しました")
-                
-        except Exception as e:
-            st.error(f"システム情報の取得に失敗しました: {str(e)}")
-        
-        st.caption("💡 定期的なバックアップを推奨します（週1回以上）")
-        
-        st.markdown("---")
-        
-        # データクリア（危険な操作）
-        st.markdown("#### 🗑️ データクリア（危険）")
-        st.error("⚠️ **危険な操作**: 全てのデータ（疾患、お知らせ、CTプロトコル）が完全に削除されます")
         
-        if st.checkbox("データクリアを実行することを理解しました", key="confirm_clear_data"):
-            if st.button("🗑️ 全データを削除", key="clear_all_data"):
-                if st.session_state.get('final_confirm_clear', False):
-                    with st.spinner("データを削除中..."):
-                        try:
-                            conn = get_db_connection()
+        if conn:
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                st.metric("疾患データ", f"{sick_count}件")
+            with col2:
+                st.metric("お知らせ", f"{form_count}件")
+            with col3:
+                st.metric("CTプロトコル", f"{protocol_count}件")
+            with col4:
+                st.metric("ユーザー", f"{user_count}人")
+        else:
+            st.error("データベース接続に失敗しました")
+            
+    except Exception as e:
+        st.error(f"システム情報の取得に失敗しました: {str(e)}")
+    
+    st.caption("💡 定期的なバックアップを推奨します（週1回以上）")
+    
+    st.markdown("---")
+    
+    # クエリプラン検査（合成データで主要クエリがインデックスを使うか確認）
+    st.markdown("#### 🔎 クエリプラン検査")
+    # 小さいテーブルではシーケンシャルスキャンの方が速く、検査にならないため下限を設ける
+    plan_rows = st.number_input("合成データ件数（各テーブル）", min_value=5000, max_value=1000000, value=10000, step=5000,
+                                key="query_plan_rows")
+    if st.button("実行計画を検査", key="check_query_plans"):
+        with st.spinner("合成データで実行計画を検査中..."):
+            try:
+                plan_results = check_query_plans(plan_rows)
+                if plan_results is not None:
+                    st.dataframe(pd.DataFrame(plan_results, columns=["クエリ", "インデックス使用", "走査"]),
+                                 use_container_width=True, hide_index=True)
+                    failed = [label for label, uses_index, _ in plan_results if not uses_index]
+                    if failed:
+                        st.error(f"インデックスを使わないクエリがあります: {', '.join(failed)}")
+                    else:
+                        st.success(f"✅ {plan_rows}件の合成データで全てのクエリがインデックスを使用しています")
+            except Exception as e:
+                st.error(f"実行計画の検査に失敗しました: {str(e)}")
+    
+    st.markdown("---")
+    
+    # リッチテキスト正規化（保存済みデータに1度実行すれば、以降は保存時に正規化される）
+    st.markdown("#### 🧹 リッチテキスト正規化")
+    st.caption("Laravel版から取り込んだフォント指定などの装飾を取り除き、文字色・太字などの強調だけを残します")
+    if st.button("保存済みデータを正規化", key="normalize_rich_text"):
+        with st.spinner("リッチテキストを正規化中..."):
+            try:
+                report = normalize_stored_rich_text()
+                if report is not None:
+                    labels = {'sicks': '疾患データ', 'forms': 'お知らせ', 'protocols': 'CTプロトコル'}
+                    st.dataframe(pd.DataFrame(
+                        [(labels[table], stats['rows'], stats['before'], stats['after'], stats['before'] - stats['after'])
+                         for table, stats in report.items()],
+                        columns=["テーブル", "更新行数", "正規化前(バイト)", "正規化後(バイト)", "削減(バイト)"]
+                    ), use_container_width=True, hide_index=True)
+                    saved = sum(stats['before'] - stats['after'] for stats in report.values())
+                    st.success(f"✅ 合計 {saved:,} バイト削減しました")
+            except Exception as e:
+                st.error(f"リッチテキストの正規化に失敗しました: {str(e)}")
+    
+    st.markdown("---")
+    
+    # データクリア（危険な操作）
+    st.markdown("#### 🗑️ データクリア（危険）")
+    st.error("⚠️ **危険な操作**: 全てのデータ（疾患、お知らせ、CTプロトコル）が完全に削除されます")
+    
+    if st.checkbox("データクリアを実行することを理解しました", key="confirm_clear_data"):
+        if st.button("🗑️ 全データを削除", key="clear_all_data"):
+            if st.session_state.get('final_confirm_clear', False):
+                with st.spinner("データを削除中..."):
+                    try:
+                        with get_db_connection() as conn:
                             if conn:
                                 cursor = conn.cursor()
                                 
@@ -3207,39 +4956,49 @@ def show_admin_page():
                                 cursor.execute("DELETE FROM sicks")
                                 cursor.execute("DELETE FROM forms") 
                                 cursor.execute("DELETE FROM protocols")
+                                cursor.execute("DELETE FROM images")
                                 
+                                notify_change(cursor, ['sicks', 'forms', 'protocols'])
                                 conn.commit()
-                                conn.close()
-                                
-                                st.success("✅ 全データを削除しました")
-                                if 'final_confirm_clear' in st.session_state:
-                                    del st.session_state.final_confirm_clear
-                            else:
-                                st.error("❌ データベース接続に失敗しました")
-                        except Exception as e:
-                            st.error(f"❌ データ削除に失敗しました: {str(e)}")
-                else:
-                    st.session_state.final_confirm_clear = True
-                    st.warning("⚠️ もう一度ボタンを押すと完全に削除されます")
+                        get_search_index.clear()
+                        bump_table_versions('sicks', 'forms', 'protocols')
+                        
+                        if conn:
+                            st.success("✅ 全データを削除しました")
+                            if 'final_confirm_clear' in st.session_state:
+                                del st.session_state.final_confirm_clear
+                        else:
+                            st.error("❌ データベース接続に失敗しました")
+                    except Exception as e:
+                        st.error(f"❌ データ削除に失敗しました: {str(e)}")
+            else:
+                st.session_state.final_confirm_clear = True
+                st.warning("⚠️ もう一度ボタンを押すと完全に削除されます")
 
 def logout():
-    """ログアウト処理"""
-    # ユーザー情報をクリア
+    """ログアウト処理（保存済みのセッションを削除し、セッション状態をクリアしてログインページに戻す）"""
+    error = None
     if 'user' in st.session_state:
-        del st.session_state.user
-    
-    # その他の状態もクリア
-    states_to_clear = [
-        'page', 'page_history', 'login_attempted',
-        'selected_sick_id', 'edit_sick_id',
-        'selected_notice_id', 'edit_notice_id',
-        'selected_protocol_id', 'edit_protocol_id',
-        'search_results', 'show_all_diseases', 'protocol_search_results'
-    ]
+        token = st.session_state.get('session_token')
+        get_session_writer().discard(token)
+        try:
+            with get_db_connection() as conn:
+                if conn:
+                    cursor = conn.cursor()
+                    cursor.execute('DELETE FROM browser_sessions WHERE token = %s', (token,))
+                    conn.commit()
+                    cursor.close()
+        except Exception as e:
+            error = f"セッション情報の削除中にエラーが発生しました: {e}"
+    
+    # 全てのセッション状態をクリア
+    for key in list(st.session_state.keys()):
+        if key != 'db_initialized':  # DB初期化状態は保持
+            del st.session_state[key]
     
-    for state in states_to_clear:
-        if state in st.session_state:
-            del st.session_state[state]
+    # エラーは再実行後のログインページで表示する
+    if error:
+        st.session_state.logout_error = error
     
     # ログインページに戻す
     st.session_state.page = 'login'
@@ -3251,9 +5010,17 @@ def logout():
 
 def initialize_session():
     """セッション初期化"""
+    # 移行の失敗は全セッションに表示する。接続エラーは次の実行で再試行し、
+    # それ以外（重複データなど）は原因の解消後に管理者ページから再試行する
+    migration_error = run_schema_migrations()
+    if migration_error:
+        st.error(f"❌ {migration_error}")
+        if migration_error == MIGRATION_CONNECTION_ERROR:
+            run_schema_migrations.clear()
+            get_search_extension.clear()
     if 'db_initialized' not in st.session_state:
-        init_database()
-        insert_sample_data()
+        get_search_extension()
+        get_change_listener()
         st.session_state.db_initialized = True
     return True
 
@@ -3267,80 +5034,8 @@ def get_custom_css():
     """カスタムCSS取得"""
     return ""  # 既存のCSSを返すか、空文字でもOK
 
-# ============================================
-# 不足している2つの関数のみ - main()関数の直前に追加してください
-# ============================================
-
-def clear_page_states(page):
-    """ページ遷移時に不要な状態をクリア"""
-    clear_states = {
-        "search": ['selected_sick_id', 'edit_sick_id'],
-        "notices": ['selected_notice_id', 'edit_notice_id'], 
-        "protocols": ['selected_protocol_id', 'edit_protocol_id']
-    }
-    
-    if page in clear_states:
-        for state in clear_states[page]:
-            if state in st.session_state:
-                del st.session_state[state]
-
-def navigate_to_page(page):
-    """ページナビゲーション - 確実版（ページトップスクロール対応）"""
-    # セッション状態を更新
-    st.session_state.page = page
-    
-    # URLを更新（複数の方法で確実に）
-    st.query_params.clear()
-    st.query_params["page"] = page
-    
-    # ページトップにスクロール
-    st.markdown("""
-    <script>
-    setTimeout(function() {
-        window.scrollTo(0, 0);
-        document.documentElement.scrollTop = 0;
-        document.body.scrollTop = 0;
-    }, 100);
-    </script>
-    """, unsafe_allow_html=True)
-    
-    # 強制再読み込み
-    st.rerun()
-
 def main():
-    """メイン関数 - JavaScript併用版（セッション復元対応）"""
-    
-    # JavaScript でブラウザイベントを監視
-    st.markdown("""
-    <script>
-    // ページが読み込まれたときに実行
-    window.addEventListener('load', function() {
-        console.log('Page loaded, current URL:', window.location.search);
-    });
-    
-    // ブラウザの戻る/進むボタンを検知
-    window.addEventListener('popstate', function(event) {
-        console.log('Browser navigation detected');
-        console.log('Current URL:', window.location.search);
-        
-        // Streamlitに強制リロードを要求
-        setTimeout(function() {
-            window.location.reload();
-        }, 50);
-    });
-    
-    // URLパラメータの変化を監視
-    let lastUrl = window.location.search;
-    setInterval(function() {
-        if (window.location.search !== lastUrl) {
-            console.log('URL changed from', lastUrl, 'to', window.location.search);
-            lastUrl = window.location.search;
-            // ページを強制リロード
-            window.location.reload();
-        }
-    }, 500); // 0.5秒間隔で監視
-    </script>
-    """, unsafe_allow_html=True)
+    """メイン関数（セッション復元対応）"""
     
     # セッション状態の初期化
     if not initialize_session():
@@ -3349,9 +5044,11 @@ def main():
     
     # セッション復元を最初に試行
     if 'user' not in st.session_state:
-        restored_session = load_session_from_db()
+        session_token = st.query_params.get(SESSION_TOKEN_PARAM)
+        restored_session = load_session_from_db(session_token)
         if restored_session:
             st.session_state.user = restored_session['user']
+            st.session_state.session_token = session_token
             # 復元時は既存のページ設定を優先
             if 'page' not in st.session_state:
                 st.session_state.page = restored_session.get('page', 'home')
@@ -3370,19 +5067,8 @@ def main():
             if restored_session.get('edit_protocol_id'):
                 st.session_state.edit_protocol_id = restored_session['edit_protocol_id']
     
-    # URL同期処理（現在のページを保持）
-    query_params = st.query_params
-    url_page = query_params.get('page')
-    
-    # URLに明示的にページが指定されている場合のみ、そのページに移動
-    if url_page and 'user' in st.session_state:
-        st.session_state.page = url_page
-    elif 'user' in st.session_state and 'page' not in st.session_state:
-        # ログイン済みだがページが設定されていない場合のみホームに設定
-        st.session_state.page = 'home'
-    
-    # ページ変更時の状態クリア
-    clear_page_states(url_page)
+    # URLとページの同期（戻る/進むはここで検知する）
+    sync_page_route()
     
     # ログイン処理
     if not check_login():
@@ -3431,51 +5117,11 @@ def main():
             show_edit_protocol_page()
         elif current_page == 'admin':
             show_admin_page()
-        else:
-            # 不明なページの場合は現在のページを保持（変更しない）
-            if st.session_state.get('page') not in ['login', 'welcome', 'home', 'search', 'detail', 'create_disease', 'edit_disease', 'notices', 'notice_detail', 'create_notice', 'edit_notice', 'protocols', 'protocol_detail', 'create_protocol', 'edit_protocol', 'admin']:
-                st.session_state.page = 'home'
-            st.query_params["page"] = st.session_state.page
             
     except Exception as e:
         st.error(f"ページ表示エラー: {str(e)}")
-        # エラー時は現在のページを保持
-        if 'page' not in st.session_state:
-            st.session_state.page = 'home'
-        st.query_params["page"] = st.session_state.page
-
-
-def clear_page_states(page):
-    """ページ遷移時に不要な状態をクリア"""
-    clear_states = {
-        "search": ['selected_sick_id', 'edit_sick_id'],
-        "notices": ['selected_notice_id', 'edit_notice_id'], 
-        "protocols": ['selected_protocol_id', 'edit_protocol_id']
-    }
-    
-    if page in clear_states:
-        for state in clear_states[page]:
-            if state in st.session_state:
-                del st.session_state[state]
-
 
 
-def navigate_to_page(page):
-    """ページナビゲーション - 確実版（URL同期対応）"""
-    # セッション状態を更新
-    st.session_state.page = page
-    
-    # URLパラメータを更新
-    st.query_params.clear()
-    st.query_params["page"] = page
-    
-    # セッションをDBに保存
-    if 'user' in st.session_state:
-        update_session_in_db()
-    
-    # 強制再読み込み
-    st.rerun()
-
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
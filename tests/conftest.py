@@ -0,0 +1,38 @@
+import os
+import sys
+import uuid
+
+import psycopg2
+import psycopg2.extensions
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+# 接続先は secrets.toml ではなく環境変数で指定する（本番DBに繋がないため）
+TEST_DSN = os.environ.get("CT_TEST_POSTGRES")
+
+
+@pytest.fixture
+def pg(monkeypatch):
+    """テスト用PostgreSQLに向けた main モジュール（CT_TEST_POSTGRES 未設定ならスキップ）"""
+    if not TEST_DSN:
+        pytest.skip("CT_TEST_POSTGRES が未設定")
+    monkeypatch.setattr(main.st, "secrets", {
+        "postgres": psycopg2.extensions.parse_dsn(TEST_DSN),
+        "search": {"backend": "postgres"},
+    })
+    for cached in (main.get_connection_pool, main.run_schema_migrations, main.get_search_extension):
+        cached.clear()
+    main.st.cache_data.clear()
+    assert main.run_schema_migrations() is None
+    yield main
+    main.get_connection_pool().closeall()
+    main.get_connection_pool.clear()
+
+
+@pytest.fixture
+def unique_label():
+    """テストデータの識別用ラベル"""
+    return f"test-{uuid.uuid4().hex[:8]}"
@@ -0,0 +1,134 @@
+import os
+import zipfile
+from datetime import datetime, timedelta
+
+import main
+
+
+def count_backup_runs(pg):
+    with pg.get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM backup_runs")
+        return cursor.fetchone()[0]
+
+
+def test_creating_a_backup_does_not_move_the_watermark(pg):
+    before = count_backup_runs(pg)
+    backup_path, manifest, error = pg.create_backup_zip(incremental=False)
+    assert error is None
+    os.unlink(backup_path)
+    assert manifest['kind'] == 'full'
+    assert count_backup_runs(pg) == before
+
+
+def test_backup_zip_round_trip_reads_rows_lazily(pg, unique_label):
+    pg.add_form(unique_label, "<p>バックアップ</p>")
+    backup_path, manifest, error = pg.create_backup_zip(incremental=False)
+    assert error is None
+    try:
+        with pg.get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM forms WHERE title = %s", (unique_label,))
+            conn.commit()
+        with zipfile.ZipFile(backup_path) as zip_file:
+            json_data, load_image = pg.read_backup_zip(zip_file)
+            assert not isinstance(json_data['forms'], list)
+            ok, counts = pg.restore_from_json(json_data, load_image)
+        assert ok, counts
+        assert counts['forms']['inserted'] == 1
+        with pg.get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT main_plain FROM forms WHERE title = %s", (unique_label,))
+            assert cursor.fetchall() == [("バックアップ",)]
+    finally:
+        os.unlink(backup_path)
+        with pg.get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM forms WHERE title = %s", (unique_label,))
+            conn.commit()
+
+
+def test_full_backup_prunes_change_log_before_retained_fulls(pg, unique_label):
+    base = datetime(2100, 1, 1)
+    with pg.get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO change_log (table_name, row_id, row_key, changed_at)
+            VALUES ('sicks', 1, %s, %s), ('sicks', 2, %s, %s)
+        """, (f'{{"diesease": "{unique_label}-old"}}', base - timedelta(hours=1),
+              f'{{"diesease": "{unique_label}-new"}}', base + timedelta(hours=1)))
+        conn.commit()
+    try:
+        for days in range(pg.BACKUP_RETAINED_FULL):
+            pg.record_backup_run({'kind': 'full', 'watermark': (base + timedelta(days=days)).isoformat()})
+        with pg.get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT row_key->>'diesease' FROM change_log WHERE row_key->>'diesease' LIKE %s",
+                           (f"{unique_label}%",))
+            assert [row[0] for row in cursor.fetchall()] == [f"{unique_label}-new"]
+    finally:
+        with pg.get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM change_log WHERE row_key->>'diesease' LIKE %s", (f"{unique_label}%",))
+            cursor.execute("DELETE FROM backup_runs WHERE watermark >= %s", (base,))
+            conn.commit()
+
+
+def test_incremental_deletion_removes_only_that_notice(pg, unique_label):
+    rows = [{"title": unique_label, "main": f"<p>{n}</p>", "created_at": f"2024-01-0{n} 09:00:00"} for n in (1, 2)]
+    ok, counts = pg.restore_from_json({"forms": rows})
+    assert ok, counts
+    try:
+        with pg.get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id FROM forms WHERE title = %s ORDER BY created_at", (unique_label,))
+            first_id = cursor.fetchone()[0]
+        pg.delete_form(first_id)
+        with pg.get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT row_key FROM change_log WHERE table_name = 'forms' AND row_id = %s", (first_id,))
+            key = cursor.fetchone()[0]
+        assert key == {"title": unique_label, "created_at": "2024-01-01T09:00:00"}
+
+        # 削除前の状態に戻してから、増分バックアップの削除記録を反映する
+        ok, counts = pg.restore_from_json({"forms": rows})
+        assert ok, counts
+        ok, counts = pg.restore_from_json({"forms": [], "deleted": [{"table": "forms", "id": first_id, "key": key}]})
+        assert ok, counts
+        assert counts["forms"]["deleted"] == 1
+        with pg.get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT main_plain FROM forms WHERE title = %s", (unique_label,))
+            assert [row[0] for row in cursor.fetchall()] == ["2"]
+    finally:
+        with pg.get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM forms WHERE title = %s", (unique_label,))
+            cursor.execute("DELETE FROM change_log WHERE row_key->>'title' = %s", (unique_label,))
+            conn.commit()
+
+
+def chain_entry(name, kind, watermark, since=None):
+    return (name, {"export_info": {"kind": kind, "watermark": watermark, "since": since}}, None)
+
+
+def test_order_backup_chain_sorts_full_before_incrementals():
+    full = chain_entry("full.zip", "full", "2025-01-01T00:00:00")
+    first = chain_entry("inc1.zip", "incremental", "2025-01-02T00:00:00", since="2024-12-31T23:59:00")
+    second = chain_entry("inc2.zip", "incremental", "2025-01-03T00:00:00", since="2025-01-01T23:59:00")
+    chain, error = main.order_backup_chain([second, full, first])
+    assert error is None
+    assert [name for name, _, _ in chain] == ["full.zip", "inc1.zip", "inc2.zip"]
+
+
+def test_order_backup_chain_rejects_gaps_and_extra_fulls():
+    full = chain_entry("full.zip", "full", "2025-01-01T00:00:00")
+    late = chain_entry("inc2.zip", "incremental", "2025-01-03T00:00:00", since="2025-01-01T23:59:00")
+    chain, error = main.order_backup_chain([full, late])
+    assert chain is None and "full.zip" in error and "inc2.zip" in error
+
+    other_full = chain_entry("full2.zip", "full", "2025-01-05T00:00:00")
+    assert main.order_backup_chain([full, other_full])[0] is None
+
+    early = chain_entry("inc0.zip", "incremental", "2024-12-01T00:00:00", since="2024-11-30T00:00:00")
+    assert main.order_backup_chain([full, early])[0] is None
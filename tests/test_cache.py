@@ -0,0 +1,35 @@
+import main
+
+
+def test_table_versions_bump_only_named_tables():
+    versions = main.TableVersions()
+    assert versions.get(["sicks", "forms"]) == (0, 0)
+    versions.bump(["sicks"])
+    versions.bump(["sicks", "protocols"])
+    assert versions.get(["sicks", "forms", "protocols"]) == (2, 0, 1)
+
+
+def test_versioned_cache_refetches_after_bump(monkeypatch):
+    versions = main.TableVersions()
+    monkeypatch.setattr(main, "get_table_versions", lambda: versions)
+    calls = []
+
+    @main.versioned_cache("test_table")
+    def read_rows(limit):
+        calls.append(limit)
+        return list(range(limit))
+
+    try:
+        assert read_rows(3) == [0, 1, 2]
+        assert read_rows(3) == [0, 1, 2]
+        assert calls == [3]
+
+        main.bump_table_versions("other_table")
+        read_rows(3)
+        assert calls == [3]
+
+        main.bump_table_versions("test_table")
+        assert read_rows(3) == [0, 1, 2]
+        assert calls == [3, 3]
+    finally:
+        read_rows.clear()
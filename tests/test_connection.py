@@ -0,0 +1,84 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def db_down(monkeypatch):
+    """プールから接続を借りられない状態（get_db_connection が None を返す）"""
+    def unavailable():
+        raise main.psycopg2.OperationalError("connection refused")
+
+    monkeypatch.setattr(main, "get_connection_pool", unavailable)
+    monkeypatch.setattr(main, "run_schema_migrations", lambda: main.MIGRATION_CONNECTION_ERROR)
+    main.get_search_index.clear()
+    yield
+    main.get_search_index.clear()
+
+
+def test_writers_and_maintenance_report_outage(db_down):
+    assert main.normalize_stored_rich_text() is None
+    assert main.record_backup_run({'kind': 'full', 'watermark': '2100-01-01T00:00:00'}) is False
+    assert main.check_query_plans(rows=10) is None
+
+
+def test_search_index_is_not_cached_empty_during_outage(db_down):
+    with pytest.raises(RuntimeError):
+        main.get_search_index()
+
+
+def test_sync_search_index_falls_back_to_rebuild(db_down, monkeypatch):
+    class Listener:
+        def drain(self):
+            return [('sicks', 1)]
+
+    cleared = []
+    monkeypatch.setattr(main, "get_change_listener", lambda: Listener())
+    monkeypatch.setattr(main.get_search_index, "clear", lambda: cleared.append(True))
+    main.sync_search_index()
+    assert cleared
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+        self.rolled_back = 0
+        self.info = type("Info", (), {"transaction_status": main.psycopg2.extensions.TRANSACTION_STATUS_IDLE})()
+
+    def rollback(self):
+        self.rolled_back += 1
+        self.info.transaction_status = main.psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool(main.ConnectionPool):
+    """接続の代わりに FakeConnection を作るプール"""
+
+    def _connect(self):
+        return FakeConnection()
+
+
+def test_pool_reuses_returned_connections_and_rolls_back():
+    pool = FakePool({}, minconn=1, maxconn=2)
+    first = pool.getconn()
+    second = pool.getconn()
+    assert first is not second
+
+    first.info.transaction_status = main.psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+    pool.putconn(first)
+    assert first.rolled_back == 1
+    assert pool.getconn() is first
+
+
+def test_pool_discards_broken_connections_and_bounds_checkouts():
+    pool = FakePool({}, minconn=0, maxconn=1, checkout_timeout=0.01)
+    conn = pool.getconn()
+    with pytest.raises(main.psycopg2.pool.PoolError):
+        pool.getconn()
+
+    conn.info.transaction_status = main.psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN
+    pool.putconn(conn)
+    assert conn.closed
+    assert pool.getconn() is not conn
@@ -0,0 +1,28 @@
+import main
+
+
+class Reruns:
+    """st.rerun の代わりに scope を記録する（in_fragment=False ならフラグメント外の実行として失敗させる）"""
+
+    def __init__(self, in_fragment):
+        self.in_fragment = in_fragment
+        self.scopes = []
+
+    def __call__(self, scope="app"):
+        self.scopes.append(scope)
+        if scope == "fragment" and not self.in_fragment:
+            raise main.StreamlitAPIException('scope="fragment" can only be specified from fragment reruns')
+
+
+def test_rerun_fragment_reruns_only_the_fragment(monkeypatch):
+    reruns = Reruns(in_fragment=True)
+    monkeypatch.setattr(main.st, "rerun", reruns)
+    main.rerun_fragment()
+    assert reruns.scopes == ["fragment"]
+
+
+def test_rerun_fragment_falls_back_to_full_rerun(monkeypatch):
+    reruns = Reruns(in_fragment=False)
+    monkeypatch.setattr(main.st, "rerun", reruns)
+    main.rerun_fragment()
+    assert reruns.scopes == ["fragment", "app"]
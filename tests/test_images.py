@@ -0,0 +1,21 @@
+import hashlib
+
+
+def test_missing_image_variant_is_not_cached(pg, unique_label):
+    content_hash = hashlib.sha256(unique_label.encode()).hexdigest()
+    assert pg.get_image_variant(content_hash, 'display') is None
+
+    with pg.get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO images (owner_table, owner_id, slot, data, content_hash, display)
+            VALUES ('forms', -1, %s, %s, %s, %s)
+        """, (unique_label, b'full', content_hash, b'display'))
+        conn.commit()
+    try:
+        assert pg.get_image_variant(content_hash, 'display') == b'display'
+    finally:
+        with pg.get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM images WHERE content_hash = %s", (content_hash,))
+            conn.commit()
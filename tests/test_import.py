@@ -0,0 +1,19 @@
+import pandas as pd
+
+import main
+
+
+def test_only_sick_columns_lose_date_only_values():
+    sicks = pd.DataFrame({column: [""] for column in main.IMPORT_TABLES["sicks"][0]})
+    sicks.loc[0, ["diesease", "keyword", "protocol", "processing_text"]] = [
+        "脳梗塞", "2023-09-19 08:09:37", "2023/09/19", "2023/09/19 造影後に再撮影"]
+    protocols = pd.DataFrame({"category": ["頭部"], "title": ["2023/09/19"], "content": [" 2023-09-19 "]})
+    log = []
+
+    sicks = main.clean_import_frame(sicks, "sicks", "diesease", log)
+    protocols = main.clean_import_frame(protocols, "protocols", "title", log)
+
+    assert sicks.loc[0, ["keyword", "protocol"]].tolist() == ["", ""]
+    assert sicks.loc[0, "processing_text"] == "2023/09/19 造影後に再撮影"
+    assert protocols.loc[0].tolist() == ["頭部", "2023/09/19", "2023-09-19"]
+    assert len(log) == 2
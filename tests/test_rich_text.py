@@ -0,0 +1,47 @@
+import main
+
+QUILL_HTML = (
+    '<p class="ql-align-center">中央</p>'
+    '<ol><li class="ql-indent-1">字下げ</li></ol>'
+    '<p><span class="ql-size-large">大きい</span><span class="ql-font-serif">明朝</span></p>'
+    '<p class="ql-align-right ql-direction-rtl">右寄せ</p>'
+)
+
+
+def test_quill_classes_round_trip():
+    assert main.normalize_rich_html(QUILL_HTML) == QUILL_HTML
+    assert main.normalize_rich_html(main.normalize_rich_html(QUILL_HTML)) == QUILL_HTML
+
+
+def test_non_quill_classes_are_dropped():
+    assert main.normalize_rich_html('<p class="MsoNormal ql-align-justify">本文</p>') == '<p class="ql-align-justify">本文</p>'
+    assert main.normalize_rich_html('<p><span class="MsoNormal">本文</span></p>') == '<p>本文</p>'
+
+
+def test_build_preview_counts_full_width_as_two_columns():
+    assert main.build_preview("", 10) == ""
+    assert main.build_preview("abcdefghij", 10) == "abcdefghij"
+    assert main.build_preview("abcdefghijk", 10) == "abcdefg..."
+    assert main.build_preview("あいうえお", 10) == "あいうえお"
+    assert main.build_preview("あいうえおか", 10) == "あいう..."
+    assert main.build_preview("abcd  efghij", 9) == "abcd..."
+
+
+def test_normalizing_stored_rich_text_bumps_updated_at(pg, unique_label):
+    with pg.get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO forms (title, main, created_at, updated_at)
+            VALUES (%s, %s, '2024-01-01', '2024-01-01') RETURNING id
+        """, (unique_label, '<p class="MsoNormal">本文</p>'))
+        form_id = cursor.fetchone()[0]
+        conn.commit()
+    try:
+        report = pg.normalize_stored_rich_text()
+        assert report['forms']['rows'] >= 1
+        with pg.get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT main, updated_at > '2024-01-01' FROM forms WHERE id = %s", (form_id,))
+            assert cursor.fetchone() == ('<p>本文</p>', True)
+    finally:
+        pg.delete_form(form_id)
@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+# 実行計画を検査するときの合成データ件数（少なすぎると全件走査の方が安くなる）
+PLAN_CHECK_ROWS = int(os.environ.get("CT_TEST_PLAN_ROWS", "10000"))
+SEARCH_PLAN_LABELS = {"疾患検索", "プロトコル検索"}
+
+
+def fetch_forms(pg, title):
+    with pg.get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, main_plain, created_at FROM forms WHERE title = %s ORDER BY id", (title,))
+        return cursor.fetchall()
+
+
+def test_notice_titles_may_repeat_and_restore_each_notice(pg, unique_label):
+    pg.add_form(unique_label, "<p>1回目</p>")
+    pg.add_form(unique_label, "<p>2回目</p>")
+    try:
+        (_, first, first_at), (_, second, second_at) = fetch_forms(pg, unique_label)
+        assert (first, second) == ("1回目", "2回目")
+
+        new_title = f"{unique_label}-new"
+        ok, counts = pg.restore_from_json({"forms": [
+            {"title": unique_label, "main": "<p>1回目を復元</p>", "created_at": str(first_at)},
+            {"title": unique_label, "main": "<p>2回目を復元</p>", "created_at": str(second_at)},
+            {"title": new_title, "main": "<p>追加1</p>", "created_at": "2024-01-01 09:00:00"},
+            {"title": new_title, "main": "<p>追加2</p>", "created_at": "2024-01-02 09:00:00"},
+            {"title": new_title, "main": "<p>作成日時なし</p>"},
+        ]})
+        assert ok, counts
+        assert counts["forms"] == {"inserted": 3, "updated": 2, "skipped": 0, "deleted": 0}
+        assert [main for _, main, _ in fetch_forms(pg, unique_label)] == ["1回目を復元", "2回目を復元"]
+        assert [main for _, main, _ in fetch_forms(pg, new_title)] == ["追加1", "追加2", "作成日時なし"]
+    finally:
+        for title in (unique_label, f"{unique_label}-new"):
+            for form_id, _, _ in fetch_forms(pg, title):
+                pg.delete_form(form_id)
+
+
+def test_failed_migration_does_not_block_later_ones(pg, monkeypatch):
+    applied = []
+
+    def broken(conn):
+        raise ValueError("broken")
+
+    monkeypatch.setattr(pg, "SCHEMA_MIGRATIONS", pg.SCHEMA_MIGRATIONS + [
+        (9001, "test_broken", broken),
+        (9002, "test_after", lambda conn: applied.append(9002)),
+    ])
+    pg.run_schema_migrations.clear()
+    try:
+        error = pg.run_schema_migrations()
+        assert "9001" in error and "broken" in error
+        assert applied == [9002]
+    finally:
+        with pg.get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM schema_migrations WHERE version >= 9000")
+            conn.commit()
+        pg.run_schema_migrations.clear()
+
+
+def test_every_query_plan_uses_an_index(pg):
+    results = pg.check_query_plans(rows=PLAN_CHECK_ROWS)
+    assert [label for label, _, _ in results] == [label for label, _, _ in pg.QUERY_PLAN_CHECKS]
+    assert all(scans for _, _, scans in results)
+    # GIN用の拡張機能（pg_trgm/pg_bigm）がない環境では、検索クエリは全件走査になる
+    allowed = set() if pg.get_search_extension() else SEARCH_PLAN_LABELS
+    assert {label for label, uses_index, _ in results if not uses_index} <= allowed, results
+
+
+def test_duplicate_protocol_title_in_category_is_rejected(pg, unique_label):
+    first_id = pg.add_protocol(unique_label, "重複", "<p>1</p>")
+    other_id = pg.add_protocol(unique_label, "別名", "<p>2</p>")
+    try:
+        with pytest.raises(pg.psycopg2.errors.UniqueViolation):
+            pg.add_protocol(unique_label, "重複", "<p>3</p>")
+        with pytest.raises(pg.psycopg2.errors.UniqueViolation):
+            pg.update_protocol(other_id, unique_label, "重複", "<p>2</p>")
+        assert pg.add_protocol(f"{unique_label}-other", "重複", "<p>4</p>")
+    finally:
+        with pg.get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM protocols WHERE category LIKE %s", (f"{unique_label}%",))
+            conn.commit()
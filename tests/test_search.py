@@ -0,0 +1,104 @@
+import main
+
+
+def test_parse_search_query_folds_full_width():
+    assert main.parse_search_query("４D OR （PTE）") == [["4d"], ["(pte)"]]
+    assert main.parse_search_query("脳  CT|肺") == [["脳", "ct"], ["肺"]]
+
+
+def make_index():
+    index = main.NgramIndex({"title": 3.0, "body": 1.0})
+    index.upsert(1, {"title": "脳梗塞", "body": "頭部CT"})
+    index.upsert(2, {"title": "肺炎", "body": "脳梗塞の既往あり。胸部CT"})
+    index.upsert(3, {"title": "骨折", "body": "四肢"})
+    return index
+
+
+def test_ngram_index_ranks_title_matches_first():
+    index = make_index()
+    assert [doc_id for doc_id, _ in index.search("脳梗塞")] == [1, 2]
+    assert [doc_id for doc_id, _ in index.search("ＣＴ 脳")] == [1, 2]
+    assert {doc_id for doc_id, _ in index.search("骨折 OR 肺炎")} == {2, 3}
+    assert index.search("腹部") == []
+
+
+def test_ngram_index_updates_incrementally():
+    index = make_index()
+    index.upsert(3, {"title": "脳出血", "body": ""})
+    assert [doc_id for doc_id, _ in index.search("脳出血")] == [3]
+    index.remove(1)
+    assert [doc_id for doc_id, _ in index.search("脳梗塞")] == [2]
+    assert len(index) == 2
+
+
+def test_postgres_search_matches_full_width_text(pg, unique_label):
+    sick_id = pg.add_sick(f"肺血栓塞栓症（PTE）{unique_label}", "<p>造影CT</p>", "", "", "", "", "", "", "")
+    protocol_id = pg.add_protocol("腹部", f"腹部CTA　４D（EVER後エンドリーク評価）{unique_label}", "<p>動脈相</p>")
+    try:
+        for term in ("（PTE）", "(pte)"):
+            assert sick_id in pg.search_sicks(f"{term} {unique_label}")["id"].tolist()
+        for term in ("４D", "4d", "（EVER後"):
+            assert protocol_id in pg.search_protocols(f"{term} {unique_label}")["id"].tolist()
+    finally:
+        pg.delete_sick(sick_id)
+        pg.delete_protocol(protocol_id)
+
+
+def test_change_listener_pending_is_bounded():
+    class Versions:
+        def bump(self, tables):
+            pass
+
+    listener = main.ChangeListener({}, Versions())
+    for doc_id in range(listener.MAX_PENDING * 3):
+        listener._apply({'tables': ['sicks', 'forms'], 'id': doc_id})
+    assert len(listener._pending) <= listener.MAX_PENDING
+    pending = listener.drain()
+    assert ('sicks', None) in pending
+    assert all(table in main.SEARCH_FIELD_WEIGHTS for table, _ in pending)
+
+
+def test_change_listener_reconnect_bumps_every_versioned_table(monkeypatch):
+    class Connection:
+        notifies = []
+
+        def set_isolation_level(self, level):
+            pass
+
+        def cursor(self):
+            return self
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def execute(self, query):
+            pass
+
+        def close(self):
+            pass
+
+    versions = main.TableVersions()
+    versions.get(["sessions"])
+    listener = main.ChangeListener({}, versions, reconnect_seconds=0)
+    connects = []
+
+    def connect(**params):
+        connects.append(params)
+        if len(connects) == 2:
+            listener.stop()
+        return Connection()
+
+    def lost(*args):
+        raise main.psycopg2.OperationalError("connection lost")
+
+    monkeypatch.setattr(main.psycopg2, "connect", connect)
+    monkeypatch.setattr(main.select, "select", lost)
+    listener.run()
+
+    assert len(connects) == 2
+    tables = ["sicks", "forms", "protocols", "images", "users", "sessions"]
+    assert versions.get(tables) == (1,) * len(tables)
+    assert sorted(listener.drain()) == [("protocols", None), ("sicks", None)]
@@ -0,0 +1,68 @@
+import pytest
+
+import main
+
+
+class FakeCursor:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FakeConnection:
+    def cursor(self):
+        return FakeCursor()
+
+    def commit(self):
+        pass
+
+
+class FakePool:
+    def __init__(self):
+        self.available = True
+
+    def getconn(self):
+        if not self.available:
+            raise main.psycopg2.OperationalError("connection refused")
+        return FakeConnection()
+
+    def putconn(self, conn):
+        pass
+
+
+@pytest.fixture
+def writes(monkeypatch):
+    """SessionWriter が execute_values に渡した行の一覧"""
+    batches = []
+    monkeypatch.setattr(main, "execute_values", lambda cursor, query, rows, **kwargs: batches.append(rows))
+    return batches
+
+
+def test_session_writer_coalesces_changes_per_token(writes):
+    writer = main.SessionWriter(FakePool())
+    writer.submit("a", 1, {"page": "home"})
+    writer.submit("a", 1, {"page": "search"})
+    writer.submit("b", 2, {"page": "admin"})
+    writer.discard("b")
+    writer.flush()
+    assert writes == [[("a", 1, '{"page": "search"}')]]
+
+    writer.flush()
+    assert len(writes) == 1
+
+
+def test_session_writer_retries_failed_writes_without_overwriting_newer(writes):
+    pool = FakePool()
+    writer = main.SessionWriter(pool)
+    pool.available = False
+    writer.submit("a", 1, {"page": "home"})
+    writer.submit("b", 2, {"page": "home"})
+    writer.flush()
+    assert writes == []
+
+    writer.submit("a", 1, {"page": "notices"})
+    pool.available = True
+    writer.flush()
+    assert sorted(writes[0]) == [("a", 1, '{"page": "notices"}'), ("b", 2, '{"page": "home"}')]